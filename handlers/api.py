@@ -1 +1,123 @@
-# handlers.api.py
\ No newline at end of file
+# handlers.api.py
+"""
+Сессии панелей 3x-ui.
+
+Раньше каждая операция с ключом создавала новый AsyncApi и выполняла login()
+(иногда дважды за один сценарий). Теперь для каждого сервера хранится один
+авторизованный клиент: login выполняется при первом обращении и повторяется
+только после ошибки авторизации (истекшая cookie-сессия).
+"""
+import asyncio
+import json
+import logging
+
+import httpx
+from py3xui import AsyncApi
+
+logger = logging.getLogger(__name__)
+
+# Ответы панели, после которых сессия считается истекшей: 3x-ui отвечает 401/404
+# на запросы к API без сессии или перенаправляет на HTML-страницу входа
+AUTH_FAILURE_STATUSES = {401, 403, 404}
+
+
+def _is_auth_failure(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in AUTH_FAILURE_STATUSES
+    return isinstance(error, json.JSONDecodeError)
+
+
+class _SessionSection:
+    """
+    Раздел API панели (client, inbound, server, database): при ошибке авторизации
+    выполняет повторный вход и один раз повторяет вызов.
+    """
+
+    __slots__ = ('_session', '_section')
+
+    def __init__(self, session: 'PanelSession', section):
+        self._session = session
+        self._section = section
+
+    def __getattr__(self, name):
+        attr = getattr(self._section, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            await self._session.login()
+            try:
+                return await attr(*args, **kwargs)
+            except Exception as e:
+                if not _is_auth_failure(e):
+                    raise
+                logger.info(f"Сессия панели {self._session.address} истекла ({e}), выполняю повторный вход")
+                await self._session.login(force=True)
+                return await attr(*args, **kwargs)
+
+        return call
+
+
+class PanelSession:
+    """
+    Авторизованный клиент панели одного сервера.
+
+    Поддерживает тот же интерфейс, что и AsyncApi (api.client.add(...) и т. д.);
+    login() без force ничего не делает, если вход уже выполнен.
+    """
+
+    def __init__(self, address: str, username: str, password: str):
+        self.address = address
+        self.credentials = (username, password)
+        self._api = AsyncApi(f"http://{address}", username, password, use_tls_verify=False)
+        self._login_lock = asyncio.Lock()
+        self._logged_in = False
+        self.client = _SessionSection(self, self._api.client)
+        self.inbound = _SessionSection(self, self._api.inbound)
+        self.server = _SessionSection(self, self._api.server)
+        self.database = _SessionSection(self, self._api.database)
+
+    async def login(self, force: bool = False):
+        """Выполняет вход, если он еще не выполнен (или принудительно при force=True)."""
+        if self._logged_in and not force:
+            return
+        stale_session = self._api.session
+        async with self._login_lock:
+            # Пока ждали блокировку, вход мог выполнить другой вызов
+            if self._logged_in and (not force or self._api.session != stale_session):
+                return
+            self._logged_in = False
+            await self._api.login()
+            self._logged_in = True
+            logger.debug(f"Выполнен вход в панель {self.address}")
+
+
+class PanelSessions:
+    """Реестр сессий панелей: адрес сервера -> PanelSession."""
+
+    def __init__(self):
+        self._sessions: dict[str, PanelSession] = {}
+
+    async def get(self, address: str, username: str, password: str) -> PanelSession:
+        """
+        Возвращает авторизованную сессию панели сервера. Если учетные данные
+        сервера изменились, создается новая сессия.
+        """
+        session = self.session(address, username, password)
+        await session.login()
+        return session
+
+    def session(self, address: str, username: str, password: str) -> PanelSession:
+        """Возвращает сессию панели без входа (вход выполнится при первом запросе)."""
+        session = self._sessions.get(address)
+        if session is None or session.credentials != (username, password):
+            session = PanelSession(address, username, password)
+            self._sessions[address] = session
+        return session
+
+    def forget(self, address: str):
+        """Удаляет сессию сервера (например, после удаления сервера)."""
+        self._sessions.pop(address, None)
+
+
+panel_sessions = PanelSessions()
@@ -1,9 +1,10 @@
 # handlers.cryptopay.py
 from aiocryptopay import AioCryptoPay, Networks
-import aiohttp
 from config import API_CRYPTO_TOKEN, CRYPTOCLOUD_API_KEY, CRYPTOCLOUD_SHOP_ID
 from datetime import datetime, timedelta
 
+from handlers.http_client import http_client
+
 crypto = AioCryptoPay(token=API_CRYPTO_TOKEN, network=Networks.MAIN_NET)
 
 # Словарь для маппинга криптовалют с их coingecko id и минимальными суммами
@@ -66,24 +67,23 @@ async def get_crypto_rate(currency: str, target_currency: str = 'rub'):
             # API запрос к CoinGecko
             url = f"https://api.coingecko.com/api/v3/simple/price?ids={coin_id}&vs_currencies={target_currency}"
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if coin_id in data and target_currency in data[coin_id]:
-                            # Получаем курс и применяем скидку 20%
-                            original_rate = data[coin_id][target_currency]
-                            discounted_rate = original_rate * _rate_discount
-                            _crypto_rates_cache[cache_key] = discounted_rate
-                            _last_update_time = current_time
-                            print(f"Курс {currency}/{target_currency}: {original_rate} -> {discounted_rate} (скидка 20%)")
-                            return discounted_rate
-                        else:
-                            # Альтернативный источник или резервное значение
-                            return _get_fallback_rate(currency, target_currency)
+            async with http_client.session.get(url) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    if coin_id in data and target_currency in data[coin_id]:
+                        # Получаем курс и применяем скидку 20%
+                        original_rate = data[coin_id][target_currency]
+                        discounted_rate = original_rate * _rate_discount
+                        _crypto_rates_cache[cache_key] = discounted_rate
+                        _last_update_time = current_time
+                        print(f"Курс {currency}/{target_currency}: {original_rate} -> {discounted_rate} (скидка 20%)")
+                        return discounted_rate
                     else:
-                        # Если API недоступен, используем резервное значение
+                        # Альтернативный источник или резервное значение
                         return _get_fallback_rate(currency, target_currency)
+                else:
+                    # Если API недоступен, используем резервное значение
+                    return _get_fallback_rate(currency, target_currency)
         except Exception as e:
             print(f"Ошибка при получении курса криптовалюты: {e}")
             return _get_fallback_rate(currency, target_currency)
@@ -217,17 +217,16 @@ async def create_cryptocloud_payment(amount: float):
     }
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return {
-                        'payment_url': result['result']['link'],
-                        'uuid': result['result']['uuid']
-                    }
-                else:
-                    print(f"Ошибка CryptoCloud API: {response.status}")
-                    raise Exception(f"CryptoCloud API error: {response.status}")
+        async with http_client.session.post(url, headers=headers, json=data) as response:
+            if response.status == 200:
+                result = await response.json()
+                return {
+                    'payment_url': result['result']['link'],
+                    'uuid': result['result']['uuid']
+                }
+            else:
+                print(f"Ошибка CryptoCloud API: {response.status}")
+                raise Exception(f"CryptoCloud API error: {response.status}")
     except Exception as e:
         print(f"Ошибка при создании платежа через CryptoCloud: {e}")
         raise
@@ -246,19 +245,18 @@ async def check_cryptocloud_payment(uuid: str):
     data = {"uuid": [uuid]}
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://api.cryptocloud.plus/v2/invoice/merchant/info", 
-                headers=headers, 
-                json=data
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    # CryptoCloud считает платеж успешным при статусах "paid" или "overpaid"
-                    return result['result'][0]['status'] in ('paid', 'overpaid')
-                else:
-                    print(f"Ошибка проверки платежа CryptoCloud: {response.status}")
-                    return False
+        async with http_client.session.get(
+            "https://api.cryptocloud.plus/v2/invoice/merchant/info", 
+            headers=headers, 
+            json=data
+        ) as response:
+            if response.status == 200:
+                result = await response.json()
+                # CryptoCloud считает платеж успешным при статусах "paid" или "overpaid"
+                return result['result'][0]['status'] in ('paid', 'overpaid')
+            else:
+                print(f"Ошибка проверки платежа CryptoCloud: {response.status}")
+                return False
     except Exception as e:
         print(f"Ошибка при проверке платежа CryptoCloud: {e}")
         return False
\ No newline at end of file
@@ -1,11 +1,13 @@
 # handlers.database.py
 import asyncio
+import json
 import logging
 import os
-import shutil
+import re
+import time
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List
 
 import aiohttp
 import aiosqlite
@@ -13,16 +15,228 @@ from aiogram.types import FSInputFile
 from aiohttp.client_exceptions import ClientError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from py3xui import AsyncApi
 
-from handlers.utils import extract_key_data, unix_to_str
+from handlers.api import panel_sessions
+from handlers.db_utils.backup import create_backup, get_data_version, split_file
+from handlers.db_utils.batch_writer import BatchWriter
+from handlers.db_utils.migrations import run_migrations
+from handlers.db_utils.models import Key, PaymentMethod, Server, Transaction, User
+from handlers.db_utils.pool import ConnectionPool
+from handlers.db_utils.query_plans import (
+    EXPIRED_KEY_NAMES_SQL,
+    EXPIRING_KEYS_SQL,
+    EXPIRY_QUERIES,
+    KEYS_TO_EXPIRE_SQL,
+    NEXT_EXPIRATION_SQL,
+    USERS_WITH_EXPIRING_KEYS_SQL,
+    USERS_WITHOUT_ACTIVE_KEYS_SQL,
+    explain_query_plan,
+    reads_keys_by_index,
+)
+from handlers.db_utils.user_cache import UserCache
+from handlers.http_client import http_client
+from handlers.utils import extract_key_data, normalize_server_host, parse_key_fields, unix_to_str
 from config import NEW_LOGIN, NEW_PASSWORD
 
 logger = logging.getLogger(__name__)
 
 DB_PATH = 'local_database.db'
 BACKUP_DIR = 'database_backups'
+# Копии основной и вспомогательной баз одного бэкапа: database_backup_<время>.db.gz и .aux.db.gz
+BACKUP_NAME_PATTERN = re.compile(r'^database_backup_(\d{8}_\d{6})\.((?:aux\.)?db)')
+# Сколько бэкапов хранить: по одному на каждый из последних N часов, дней и недель
+BACKUP_RETENTION = {'hourly': 24, 'daily': 7, 'weekly': 4}
+# Bot API принимает от бота файлы до 50 МБ
+BACKUP_UPLOAD_LIMIT = 49 * 1024 * 1024
+
+# Размер пула: одно соединение на запись + DB_POOL_READERS на чтение
+DB_POOL_READERS = 4
+DB_POOL_ACQUIRE_TIMEOUT = 30.0
+
+# Настройки каждого соединения пула. WAL позволяет читать во время записи,
+# а synchronous=NORMAL в режиме WAL не теряет целостность при сбое процесса
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,          # мс ожидания блокировки вместо ошибки "database is locked"
+    'cache_size': -8000,           # ~8 МБ кэша страниц на соединение
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+
+# Вспомогательные таблицы (топики форума, напоминания о ключах, статистика отмен,
+# метаданные бэкапов) хранятся в отдельном файле со своим writer, чтобы их запись
+# не ждала платежи и ключи. None — хранить их в основной базе DB_PATH.
+AUX_DB_PATH = 'local_database_aux.db'
+# Псевдоним, под которым AUX_DB_PATH присоединяется к соединениям на чтение основной базы
+AUX_DB_ALIAS = 'aux'
+AUX_TABLES = ('forum_topics', 'key_usage_reminders', 'card_cancel_stats', 'backups', 'key_traffic', 'server_health')
+AUX_POOL_READERS = 1
+
+db_pool = ConnectionPool(
+    DB_PATH,
+    readers=DB_POOL_READERS,
+    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+    pragmas=DB_PRAGMAS,
+    attach={AUX_DB_ALIAS: AUX_DB_PATH} if AUX_DB_PATH else None,
+)
+
+# Запись во вспомогательные таблицы идет через aux_pool. Чтение может идти и через
+# db_pool: таблицы без указания схемы находятся в присоединенной базе, поэтому
+# JOIN с keys работает. Если AUX_DB_PATH не задан, aux_pool — это db_pool.
+aux_pool = ConnectionPool(
+    AUX_DB_PATH,
+    readers=AUX_POOL_READERS,
+    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+    pragmas=DB_PRAGMAS,
+) if AUX_DB_PATH else db_pool
+
+# Мелкие частые записи (трафик ключей, флаги, имена) фиксируются пачками:
+# не реже раза в BATCH_WRITE_INTERVAL секунд или по BATCH_WRITE_MAX записей
+BATCH_WRITE_INTERVAL = 0.1
+BATCH_WRITE_MAX = 200
+
+batch_writer = BatchWriter(db_pool, flush_interval=BATCH_WRITE_INTERVAL, max_batch=BATCH_WRITE_MAX)
+aux_batch_writer = BatchWriter(aux_pool, flush_interval=BATCH_WRITE_INTERVAL, max_batch=BATCH_WRITE_MAX)
+
+# Кэш строк users для get_user: функции, меняющие пользователя, вызывают user_cache.invalidate()
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60.0
+
+user_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Количество строк, которое потоковые функции iter_* читают из БД за один запрос
+STREAM_CHUNK_SIZE = 500
+
+# ID администраторов; загружается load_admins() и обновляется при изменении is_admin
+_admin_ids: set[int] | None = None
+
+# Сколько запросов удаления клиентов remove_keys() одновременно отправляет на одну панель
+PANEL_DELETE_CONCURRENCY = 4
+
+# Порт панели 3x-ui. Доступность панелей проверяет фоновый монитор probe_servers()
+# раз в SERVER_HEALTH_INTERVAL секунд и записывает результат в таблицу server_health;
+# результаты старше SERVER_HEALTH_STALE секунд не учитываются (сервер считается доступным)
+SERVER_PANEL_PORT = 2053
+SERVER_HEALTH_INTERVAL = 30
+SERVER_HEALTH_TIMEOUT = 5
+SERVER_HEALTH_STALE = 5 * SERVER_HEALTH_INTERVAL
+
+# Трафик клиентов панелей собирает collect_inbound_traffic() в таблицу key_traffic
+# раз в TRAFFIC_COLLECT_INTERVAL секунд. Пока в ней нет сбора новее TRAFFIC_STALE секунд,
+# ключи с нулевым трафиком определяются по key_usage_reminders.last_traffic
+TRAFFIC_COLLECT_INTERVAL = 60 * 60
+TRAFFIC_STALE = 3 * TRAFFIC_COLLECT_INTERVAL
+
+# Время жизни резерва места на инбаунде: за это время ключ должен быть создан на панели
+# и сохранен через add_active_key, иначе место снова считается свободным
+SLOT_RESERVATION_TTL = timedelta(minutes=10)
+
+# Количество действующих резервов инбаунда i (параметр — текущее время в миллисекундах)
+_ACTIVE_RESERVATIONS_SQL = """(
+    SELECT COUNT(*) FROM slot_reservations r
+    WHERE r.inbound_row_id = i.id AND r.expires_at > ?
+)"""
+
+# Сервер s доступен по данным монитора: последняя проверка успешна или свежих проверок нет
+# (параметр — время в миллисекундах, раньше которого проверки считаются устаревшими)
+_SERVER_ALIVE_SQL = """COALESCE((
+    SELECT h.is_alive FROM server_health h
+    WHERE h.host = s.host AND h.last_checked >= ?
+), 1) = 1"""
 _bot_instance = None
+# Путь к базе -> PRAGMA data_version на момент ее последнего бэкапа
+_last_backup_data_versions: Dict[str, int] = {}
+
+
+def _dict_row(cursor, row) -> dict:
+    """row_factory, возвращающий строку как словарь."""
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+async def _fetch_page(query: str, params: tuple = (), *, key: str, limit: int, after=None, before=None,
+                      descending: bool = False, row_factory=_dict_row,
+                      attached: bool = False) -> tuple[list, object, object]:
+    """
+    Читает одну страницу результата запроса по курсору (keyset pagination).
+
+    Вместо OFFSET страница начинается сразу за значением колонки key последней строки
+    предыдущей страницы, поэтому стоимость запроса не зависит от номера страницы.
+    Читается limit + 1 строка: лишняя строка показывает, есть ли страница дальше.
+
+    Args:
+        query (str): SELECT без ORDER BY и LIMIT
+        params (tuple): Параметры запроса
+        key (str): Колонка результата с уникальными значениями, задающая порядок
+        limit (int): Размер страницы
+        after: Курсор next_cursor — вернуть страницу после этого значения
+        before: Курсор prev_cursor — вернуть страницу перед этим значением
+        descending (bool): Порядок страниц по убыванию key
+        row_factory: Фабрика строк (cursor, row) для строк страницы
+        attached (bool): Запрос читает таблицы вспомогательной базы (см. ConnectionPool.reader)
+
+    Returns:
+        tuple: (строки, prev_cursor, next_cursor); курсор равен None, если страницы нет
+    """
+    backward = before is not None
+    cursor_value = before if backward else after
+    ascending = descending == backward
+
+    sql = f"SELECT * FROM ({query})"
+    args = list(params)
+    if cursor_value is not None:
+        sql += f" WHERE {key} {'>' if ascending else '<'} ?"
+        args.append(cursor_value)
+    sql += f" ORDER BY {key} {'ASC' if ascending else 'DESC'} LIMIT ?"
+    args.append(limit + 1)
+
+    async with db_pool.reader(attached=attached) as db:
+        cursor = await db.execute(sql, args)
+        rows = await cursor.fetchall()
+        key_index = [column[0] for column in cursor.description].index(key)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        page = [row_factory(cursor, row) for row in rows] if row_factory else rows
+
+    if not rows:
+        return page, None, None
+    first, last = rows[0][key_index], rows[-1][key_index]
+    if backward:
+        return page, first if has_more else None, last
+    return page, first if after is not None else None, last if has_more else None
+
+
+async def _iter_rows(query: str, params: tuple = (), *, key: str, row_factory=_dict_row,
+                     chunk_size: int = STREAM_CHUNK_SIZE, attached: bool = False) -> AsyncIterator:
+    """
+    Постранично читает результат запроса в порядке возрастания колонки key.
+
+    Каждая порция — отдельная страница _fetch_page, а соединение возвращается в пул
+    до того, как порция отдается вызывающему коду. Поэтому долгая обработка (рассылка,
+    экспорт) не занимает читателя пула и не держит открытым снимок WAL, а в памяти
+    находится не больше одной порции.
+
+    Args:
+        query (str): SELECT без ORDER BY и LIMIT
+        params (tuple): Параметры запроса
+        key (str): Колонка результата с уникальными значениями
+        row_factory: Фабрика строк (cursor, row)
+        chunk_size (int): Количество строк в порции
+        attached (bool): Запрос читает таблицы вспомогательной базы
+    """
+    after = None
+    while True:
+        rows, _, after = await _fetch_page(
+            query, params, key=key, limit=chunk_size, after=after, row_factory=row_factory,
+            attached=attached,
+        )
+        for row in rows:
+            yield row
+        if after is None:
+            return
 
 def set_bot_instance(bot):
     """Устанавливает экземпляр бота для использования в бэкапах"""
@@ -31,85 +245,168 @@ def set_bot_instance(bot):
 
 async def create_database_backup():
     """
-    Создает резервную копию базы данных и отправляет её админам
+    Создает резервные копии основной (DB_PATH) и вспомогательной (AUX_DB_PATH) баз
+    и отправляет их админам.
+
+    Копии снимаются через backup API SQLite в рабочем потоке (см. handlers.db_utils.backup),
+    поэтому соединения на запись не удерживаются и бот продолжает работать во время копирования.
+    Если с прошлого бэкапа данные базы не менялись (PRAGMA data_version), ее копия не снимается.
     """
     try:
-        # Создаем директорию для бэкапов если её нет
-        if not os.path.exists(BACKUP_DIR):
-            os.makedirs(BACKUP_DIR)
-            
+        sources = [(DB_PATH, 'db', db_pool)]
+        if AUX_DB_PATH:
+            sources.append((AUX_DB_PATH, 'aux.db', aux_pool))
+
         # Формируем имя файла бэкапа с текущей датой и временем
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_path = os.path.join(BACKUP_DIR, f'database_backup_{timestamp}.db')
-        
-        # Создаем атомарную копию базы
-        async with aiosqlite.connect(DB_PATH) as source_db:
-            # Ждем завершения всех транзакций
-            await source_db.execute('PRAGMA wal_checkpoint(FULL)')
-            
-            # Создаем бэкап
-            shutil.copy2(DB_PATH, backup_path)
-            
-            logger.info(f"Created database backup: {backup_path}")
-            
-            # Получаем список админов и отправляем им бэкап
+        created = 0
+        # Вспомогательная база копируется последней: в нее пишутся метаданные бэкапа основной
+        for source_path, suffix, pool in sources:
+            data_version = await asyncio.to_thread(get_data_version, source_path)
+            if data_version == _last_backup_data_versions.get(source_path):
+                logger.info(f"Database {source_path} unchanged since last backup, skipping")
+                continue
+
+            # Создаем директорию для бэкапов если её нет
+            os.makedirs(BACKUP_DIR, exist_ok=True)
+            backup_path = os.path.join(BACKUP_DIR, f'database_backup_{timestamp}.{suffix}.gz')
+            backup_info = await create_backup(source_path, backup_path)
+
+            async with pool.writer():
+                # Пока соединение на запись этой базы занято, другие коммиты в нее невозможны.
+                # Если во время копирования коммитов не было, запоминаем data_version уже после
+                # записи метаданных, чтобы сама эта запись не считалась изменением данных
+                unchanged_during_backup = await asyncio.to_thread(get_data_version, source_path) == data_version
+                async with aux_pool.writer() as db:
+                    await db.execute("""
+                        INSERT INTO backups (file_name, created_at, duration_ms, pages, db_bytes,
+                                             compressed_bytes, sha256, integrity)
+                        VALUES (:file_name, :created_at, :duration_ms, :pages, :db_bytes,
+                                :compressed_bytes, :sha256, :integrity)
+                    """, backup_info)
+                    await db.commit()
+                if unchanged_during_backup:
+                    data_version = await asyncio.to_thread(get_data_version, source_path)
+            _last_backup_data_versions[source_path] = data_version
+            created += 1
+
+            logger.info(
+                f"Created database backup: {backup_path} ({backup_info['pages']} pages, "
+                f"{backup_info['db_bytes']} -> {backup_info['compressed_bytes']} bytes, "
+                f"{backup_info['duration_ms']} ms)"
+            )
+
             if _bot_instance:
-                admins = await get_admins()
-                for admin_id in admins:
-                    try:
-                        # Создаем FSInputFile из пути к файлу
-                        document = FSInputFile(backup_path)
-                        await _bot_instance.send_document(
-                            chat_id=admin_id,
-                            document=document,
-                            caption=f"Database backup {timestamp}"
-                        )
-                        logger.info(f"Sent backup to admin {admin_id}")
-                    except Exception as e:
-                        logger.error(f"Failed to send backup to admin {admin_id}: {e}")
-            
-            # Очищаем старые бэкапы (оставляем только за последние 24 часа)
+                await send_backup_to_admins(
+                    backup_path,
+                    caption=f"Database backup {timestamp} ({os.path.basename(source_path)})\nsha256: {backup_info['sha256']}"
+                )
+
+        # Удаляем бэкапы, которые не попадают в BACKUP_RETENTION
+        if created:
             await cleanup_old_backups()
             
     except Exception as e:
         logger.error(f"Failed to create database backup: {e}")
 
+async def send_backup_to_admins(backup_path: str, caption: str):
+    """
+    Отправляет бэкап всем админам. Файл больше BACKUP_UPLOAD_LIMIT режется на части.
+
+    Каждая часть загружается в Telegram один раз, остальным админам она
+    отправляется по file_id из первого успешного ответа.
+    """
+    parts = await asyncio.to_thread(split_file, backup_path, BACKUP_UPLOAD_LIMIT)
+    file_ids = [None] * len(parts)
+    try:
+        for admin_id in await get_admins():
+            try:
+                for index, part_path in enumerate(parts):
+                    part_caption = caption if len(parts) == 1 else f"{caption}\nPart {index + 1}/{len(parts)}"
+                    message = await _bot_instance.send_document(
+                        chat_id=admin_id,
+                        document=file_ids[index] or FSInputFile(part_path),
+                        caption=part_caption
+                    )
+                    file_ids[index] = message.document.file_id
+                logger.info(f"Sent backup to admin {admin_id}")
+            except Exception as e:
+                logger.error(f"Failed to send backup to admin {admin_id}: {e}")
+    finally:
+        if parts != [backup_path]:
+            for part_path in parts:
+                os.remove(part_path)
+
+def _backups_to_keep(timestamps: List[datetime]) -> set:
+    """
+    Выбирает бэкапы, которые нужно оставить: самый новый в каждом из последних
+    BACKUP_RETENTION['hourly'] часов, BACKUP_RETENTION['daily'] дней и BACKUP_RETENTION['weekly'] недель.
+    """
+    keep = set()
+    tiers = (
+        (lambda ts: (ts.date(), ts.hour), BACKUP_RETENTION['hourly']),
+        (lambda ts: ts.date(), BACKUP_RETENTION['daily']),
+        (lambda ts: ts.isocalendar()[:2], BACKUP_RETENTION['weekly']),
+    )
+    ordered = sorted(timestamps, reverse=True)
+    for period_of, count in tiers:
+        periods = set()
+        for ts in ordered:
+            period = period_of(ts)
+            if period in periods:
+                continue
+            if len(periods) >= count:
+                break
+            periods.add(period)
+            keep.add(ts)
+    return keep
+
 async def cleanup_old_backups():
     """
-    Удаляет бэкапы старше 24 часов
+    Удаляет бэкапы, которые не попадают ни в один уровень BACKUP_RETENTION,
+    вместе с их записями в таблице backups. Копии основной и вспомогательной баз
+    отбираются отдельно: их бэкапы снимаются независимо друг от друга
     """
     try:
-        current_time = datetime.now()
         backup_dir = Path(BACKUP_DIR)
         
         if not backup_dir.exists():
             return
             
-        for backup_file in backup_dir.glob('database_backup_*.db'):
-            try:
-                # Получаем время создания файла из имени
-                timestamp_str = backup_file.stem.split('_')[2]
-                file_time = datetime.strptime(timestamp_str, '%Y%m%d')
-                
-                # Удаляем файлы старше 24 часов
-                if current_time - file_time > timedelta(hours=24):
-                    backup_file.unlink()
-                    logger.info(f"Deleted old backup: {backup_file}")
-            except Exception as e:
-                logger.error(f"Error processing backup file {backup_file}: {e}")
+        # База (db / aux.db) -> время бэкапа -> его файлы (сам бэкап и оставшиеся после сбоя части)
+        backups: Dict[str, Dict[datetime, List[Path]]] = {}
+        for backup_file in backup_dir.glob('database_backup_*'):
+            match = BACKUP_NAME_PATTERN.match(backup_file.name)
+            if not match:
+                continue
+            file_time = datetime.strptime(match.group(1), '%Y%m%d_%H%M%S')
+            backups.setdefault(match.group(2), {}).setdefault(file_time, []).append(backup_file)
+        
+        deleted = []
+        for database_backups in backups.values():
+            keep = _backups_to_keep(list(database_backups))
+            for file_time, files in database_backups.items():
+                if file_time in keep:
+                    continue
+                for backup_file in files:
+                    try:
+                        backup_file.unlink()
+                        deleted.append(backup_file.name)
+                        logger.info(f"Deleted old backup: {backup_file}")
+                    except Exception as e:
+                        logger.error(f"Error deleting backup file {backup_file}: {e}")
+        
+        if deleted:
+            async with aux_pool.writer() as db:
+                await db.executemany("DELETE FROM backups WHERE file_name = ?", [(name,) for name in deleted])
+                await db.commit()
                 
     except Exception as e:
         logger.error(f"Error cleaning up old backups: {e}")
 
-async def init_db():
-    db_exists = os.path.exists(DB_PATH)
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        if not db_exists:
-            print(f"База данных {DB_PATH} не существует. Создаем новую базу данных.")
-        else:
-            print(f"База данных {DB_PATH} уже существует. Проверяем и обновляем структуру.")
-
+async def init_aux_db():
+    """Создает вспомогательные таблицы (AUX_TABLES) в базе aux_pool."""
+    async with aux_pool.writer() as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS card_cancel_stats (
                 user_id INTEGER PRIMARY KEY,
@@ -117,6 +414,130 @@ async def init_db():
             )
         """)
 
+        # Создаем таблицу для хранения топиков форума
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS forum_topics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE,
+                topic_id INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Внешний ключ на keys между файлами невозможен: записи удаляемых ключей
+        # удаляются явно (см. _forget_key_reminders)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS key_usage_reminders (
+                key TEXT PRIMARY KEY,
+                last_traffic INTEGER DEFAULT 0,
+                first_reminder_sent INTEGER DEFAULT 0,
+                second_reminder_sent INTEGER DEFAULT 0,
+                third_reminder_sent INTEGER DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS backups (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_name TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                duration_ms INTEGER NOT NULL,
+                pages INTEGER NOT NULL,
+                db_bytes INTEGER NOT NULL,
+                compressed_bytes INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                integrity TEXT NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_backups_created_at ON backups(created_at)")
+
+        # Доступность панелей серверов, которую записывает probe_servers().
+        # rtt_ms — время ответа последней успешной проверки, failures — неудачные проверки подряд
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS server_health (
+                host TEXT PRIMARY KEY,
+                is_alive INTEGER NOT NULL,
+                rtt_ms INTEGER,
+                last_checked INTEGER NOT NULL,
+                last_success INTEGER,
+                failures INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+        # Трафик клиентов панелей, который собирает collect_inbound_traffic().
+        # Ключ связывается со строкой по keys.server_ip = server_host и keys.panel_email
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS key_traffic (
+                server_host TEXT NOT NULL,
+                panel_email TEXT NOT NULL,
+                inbound_id INTEGER,
+                up INTEGER NOT NULL DEFAULT 0,
+                down INTEGER NOT NULL DEFAULT 0,
+                updated_at INTEGER NOT NULL,
+                PRIMARY KEY (server_host, panel_email)
+            )
+        """)
+        await db.commit()
+
+async def _move_aux_tables(db: aiosqlite.Connection):
+    """
+    Переносит строки вспомогательных таблиц из основной базы в присоединенную
+    (для баз, созданных до выделения AUX_DB_PATH) и удаляет таблицы из основной.
+    Переносятся только колонки, которые есть в обеих таблицах.
+    """
+    for table in AUX_TABLES:
+        async with db.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ) as cursor:
+            if await cursor.fetchone() is None:
+                continue
+
+        async with db.execute(f"PRAGMA main.table_info({table})") as cursor:
+            main_columns = [row[1] async for row in cursor]
+        async with db.execute(f"PRAGMA {AUX_DB_ALIAS}.table_info({table})") as cursor:
+            aux_columns = {row[1] async for row in cursor}
+        columns = ", ".join(column for column in main_columns if column in aux_columns)
+
+        await db.execute("BEGIN")
+        try:
+            cursor = await db.execute(
+                f"INSERT OR IGNORE INTO {AUX_DB_ALIAS}.{table} ({columns}) SELECT {columns} FROM main.{table}"
+            )
+            moved = cursor.rowcount
+            await db.execute(f"DROP TABLE main.{table}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        logger.info(f"Таблица {table} перенесена в {AUX_DB_PATH} ({moved} строк)")
+
+def _forget_key_reminders(keys):
+    """
+    Ставит в очередь удаление записей key_usage_reminders для удаленных ключей
+    (внутри единицы работы — после ее commit).
+    """
+    keys = list(keys)
+
+    def enqueue():
+        for key in keys:
+            aux_batch_writer.enqueue("DELETE FROM key_usage_reminders WHERE key = ?", (key,))
+
+    db_pool.after_commit(enqueue)
+
+async def init_db():
+    async with db_pool.writer() as db:
+        cursor = await db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'"
+        )
+        db_exists = await cursor.fetchone() is not None
+
+        if not db_exists:
+            print(f"База данных {DB_PATH} не существует. Создаем новую базу данных.")
+        else:
+            print(f"База данных {DB_PATH} уже существует. Проверяем и обновляем структуру.")
+
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -141,11 +562,18 @@ async def init_db():
                 key TEXT PRIMARY KEY,
                 user_id INTEGER,
                 device_id TEXT,
-                expiration_date TEXT,
+                expiration_date INTEGER,
                 price INTEGER NOT NULL,
                 days INTEGER NOT NULL,
                 payment_id TEXT,
-                name TEXT DEFAULT NULL
+                name TEXT DEFAULT NULL,
+                protocol TEXT,
+                server_ip TEXT,
+                port INTEGER,
+                client_uuid TEXT,
+                panel_email TEXT,
+                unique_id TEXT,
+                device_type TEXT
             )
         """)
 
@@ -158,7 +586,8 @@ async def init_db():
                 password TEXT NOT NULL,
                 country TEXT,
                 max_clients INTEGER DEFAULT 100,
-                is_active INTEGER DEFAULT 1
+                is_active INTEGER DEFAULT 1,
+                host TEXT
             )
         """)
 
@@ -220,55 +649,39 @@ async def init_db():
             )
         """)
 
-        # Создаем таблицу для хранения топиков форума
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS forum_topics (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE,
-                topic_id INTEGER NOT NULL,
-                channel TEXT NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        await db.commit()
+
+        await init_aux_db()
+
+        # Миграции обращаются и к вспомогательным таблицам, поэтому на время
+        # инициализации отдельная база присоединяется и к соединению на запись
+        if aux_pool is not db_pool:
+            await db.execute(f"ATTACH DATABASE ? AS {AUX_DB_ALIAS}", (AUX_DB_PATH,))
+        try:
+            # Колонки и индексы добавляются версионированными миграциями,
+            # уже примененные миграции при запуске пропускаются
+            await run_migrations(db)
+            if aux_pool is not db_pool:
+                await _move_aux_tables(db)
+        finally:
+            if aux_pool is not db_pool:
+                await db.execute(f"DETACH DATABASE {AUX_DB_ALIAS}")
 
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS key_usage_reminders (
-                key TEXT PRIMARY KEY,
-                last_traffic INTEGER DEFAULT 0,
-                first_reminder_sent INTEGER DEFAULT 0,
-                second_reminder_sent INTEGER DEFAULT 0,
-                third_reminder_sent INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(key) REFERENCES keys(key) ON DELETE CASCADE
-            )
-        """)
         await update_server_credentials(NEW_LOGIN, NEW_PASSWORD)
         #await add_channel_column_to_forum_topics()
         await db.commit()
-        
-        await _ensure_column_exists(db, "keys", "price", "INTEGER")
-        await _ensure_column_exists(db, "keys", "days", "INTEGER")
-        await _ensure_column_exists(db, "user_payment_methods", "when_valid", "TEXT")
 
     print("Инициализация базы данных завершена.")
     # await cleanup_expired_keys()
     await sync_server_clients_count()
-    await add_name_column_to_keys()
+    await check_expiry_query_plans()
+    await load_admins()
     #await add_payment_id_column()
     #await add_pay_count_column()
     #await add_channel_column_to_users()
     #await migrate_servers_data()
     #await add_inbound_columns()
 
-async def _ensure_column_exists(
-    db: aiosqlite.Connection, table: str, column: str, col_type: str
-):
-    """Добавляет колонку, если её нет (SQLite не поддерживает IF NOT EXISTS)."""
-    async with db.execute(f"PRAGMA table_info({table})") as cursor:
-        cols = [row[1] async for row in cursor]
-    if column not in cols:
-        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type};")
-
 async def add_name_column_to_keys():
     """
     Adds a name column to the keys table if it doesn't exist
@@ -277,7 +690,7 @@ async def add_name_column_to_keys():
         bool: True if column was added or already exists, False if error occurred
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             # Check if column exists
             cursor = await db.execute("PRAGMA table_info(keys)")
             columns = await cursor.fetchall()
@@ -309,7 +722,7 @@ async def add_payment_id_column():
         bool: True, если колонка успешно добавлена или уже существует, False в случае ошибки
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             # Проверяем, существует ли уже колонка payment_id в таблице keys
             cursor = await db.execute("PRAGMA table_info(keys)")
             columns = await cursor.fetchall()
@@ -350,7 +763,7 @@ async def add_payment_method(user_id: int, payment_method_id: str, issuer_name:
     timestamp_ms = int(date.timestamp() * 1000)
 
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             # Проверяем, существует ли запись
             cursor = await db.execute("""
                 SELECT id FROM user_payment_methods WHERE user_id = ? AND payment_method_id = ?
@@ -385,13 +798,13 @@ async def get_user_payment_methods(user_id: int, include_balance: bool = False):
         user_id (int): ID пользователя
         
     Returns:
-        list: Список словарей с информацией о методах оплаты
+        list[PaymentMethod]: Список методов оплаты
     """
     try:
         current_timestamp_ms = int(datetime.now(tz=timezone.utc).timestamp() * 1000)
 
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with db_pool.reader() as db:
+            db.row_factory = PaymentMethod.row_factory
             cursor = await db.execute("""
                 SELECT id, user_id, payment_method_id, issuer_name, title, created_at
                 FROM user_payment_methods
@@ -399,16 +812,16 @@ async def get_user_payment_methods(user_id: int, include_balance: bool = False):
                 ORDER BY created_at DESC
             """, (user_id, current_timestamp_ms))
             methods = await cursor.fetchall()
-            methods = [dict(row) for row in methods]
 
             if include_balance:
+                db.row_factory = None
                 cursor = await db.execute("""
                     SELECT balance
                     FROM users
                     WHERE user_id = ?
                 """, (user_id,))
                 row = await cursor.fetchone()
-                balance = int(row['balance']) if row else 0
+                balance = int(row[0]) if row else 0
                 return methods, balance
 
             return methods
@@ -424,18 +837,17 @@ async def get_payment_method_by_id(method_id: int):
         method_id (int): ID метода оплаты
         
     Returns:
-        dict: Словарь с информацией о методе оплаты или None если метод не найден
+        PaymentMethod: Метод оплаты или None если метод не найден
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with db_pool.reader() as db:
+            db.row_factory = PaymentMethod.row_factory
             cursor = await db.execute("""
                 SELECT id, user_id, payment_method_id, issuer_name, title, created_at
                 FROM user_payment_methods
                 WHERE id = ?
             """, (method_id,))
-            method = await cursor.fetchone()
-            return dict(method) if method else None
+            return await cursor.fetchone()
     except Exception as e:
         logger.error(f"Ошибка при получении метода оплаты: {e}")
         return None
@@ -451,7 +863,7 @@ async def delete_payment_method(method_id: int):
         bool: True если метод успешно удален, False в противном случае
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute("""
                 DELETE FROM user_payment_methods
                 WHERE id = ?
@@ -473,7 +885,7 @@ async def delete_payment_method_by_id(user_id: str | int, payment_method_id: str
         bool: True если метод успешно удален, False в противном случае
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute("""
                 DELETE FROM user_payment_methods
                 WHERE user_id = ? AND payment_method_id = ?
@@ -493,18 +905,17 @@ async def get_payment_method_by_payment_id(payment_method_id: str):
         payment_method_id (str): Внешний идентификатор метода оплаты
         
     Returns:
-        dict: Словарь с информацией о методе оплаты или None если метод не найден
+        PaymentMethod: Метод оплаты или None если метод не найден
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with db_pool.reader() as db:
+            db.row_factory = PaymentMethod.row_factory
             cursor = await db.execute("""
                 SELECT id, user_id, payment_method_id, issuer_name, title, created_at
                 FROM user_payment_methods
                 WHERE payment_method_id = ?
             """, (payment_method_id,))
-            method = await cursor.fetchone()
-            return dict(method) if method else None
+            return await cursor.fetchone()
     except Exception as e:
         logger.error(f"Ошибка при получении метода оплаты по payment_method_id: {e}")
         return None
@@ -538,55 +949,54 @@ async def update_server_credentials(new_username: str, new_password: str, server
                 'message': "Логин и пароль не могут быть пустыми"
             }
             
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute('BEGIN EXCLUSIVE TRANSACTION'):
-                if server_id is not None:
-                    # Обновляем конкретный сервер
-                    await db.execute(
-                        "UPDATE servers SET username = ?, password = ? WHERE id = ?",
-                        (new_username, new_password, server_id)
-                    )
-                    
-                    # Проверяем, был ли сервер обновлен
-                    cursor = await db.execute(
-                        "SELECT COUNT(*) FROM servers WHERE id = ?", 
-                        (server_id,)
-                    )
-                    count = (await cursor.fetchone())[0]
-                    
-                    if count == 0:
-                        return {
-                            'success': False,
-                            'updated_count': 0,
-                            'message': f"Сервер с ID {server_id} не найден"
-                        }
-                        
-                    await db.commit()
-                    logger.warning(f"Экстренное обновление учетных данных для сервера ID {server_id}")
-                    return {
-                        'success': True,
-                        'updated_count': 1,
-                        'message': f"Учетные данные для сервера ID {server_id} успешно обновлены"
-                    }
-                else:
-                    # Обновляем все серверы
-                    await db.execute(
-                        "UPDATE servers SET username = ?, password = ?",
-                        (new_username, new_password)
-                    )
-                    
-                    # Получаем количество обновленных серверов
-                    cursor = await db.execute("SELECT COUNT(*) FROM servers")
-                    count = (await cursor.fetchone())[0]
-                    
-                    await db.commit()
-                    logger.warning(f"Экстренное обновление учетных данных для ВСЕХ серверов ({count})")
+        async with db_pool.writer() as db:
+            if server_id is not None:
+                # Обновляем конкретный сервер
+                await db.execute(
+                    "UPDATE servers SET username = ?, password = ? WHERE id = ?",
+                    (new_username, new_password, server_id)
+                )
+                
+                # Проверяем, был ли сервер обновлен
+                cursor = await db.execute(
+                    "SELECT COUNT(*) FROM servers WHERE id = ?", 
+                    (server_id,)
+                )
+                count = (await cursor.fetchone())[0]
+                
+                if count == 0:
                     return {
-                        'success': True,
-                        'updated_count': count,
-                        'message': f"Учетные данные для {count} серверов успешно обновлены"
+                        'success': False,
+                        'updated_count': 0,
+                        'message': f"Сервер с ID {server_id} не найден"
                     }
                     
+                await db.commit()
+                logger.warning(f"Экстренное обновление учетных данных для сервера ID {server_id}")
+                return {
+                    'success': True,
+                    'updated_count': 1,
+                    'message': f"Учетные данные для сервера ID {server_id} успешно обновлены"
+                }
+            else:
+                # Обновляем все серверы
+                await db.execute(
+                    "UPDATE servers SET username = ?, password = ?",
+                    (new_username, new_password)
+                )
+                
+                # Получаем количество обновленных серверов
+                cursor = await db.execute("SELECT COUNT(*) FROM servers")
+                count = (await cursor.fetchone())[0]
+                
+                await db.commit()
+                logger.warning(f"Экстренное обновление учетных данных для ВСЕХ серверов ({count})")
+                return {
+                    'success': True,
+                    'updated_count': count,
+                    'message': f"Учетные данные для {count} серверов успешно обновлены"
+                }
+                
     except Exception as e:
         logger.error(f"Ошибка при обновлении учетных данных серверов: {e}", exc_info=True)
         return {
@@ -611,7 +1021,7 @@ async def get_channel_statistics():
             ]
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             # Получаем общее количество пользователей
             cursor = await db.execute("SELECT COUNT(*) FROM users")
             total_users = (await cursor.fetchone())[0]
@@ -654,7 +1064,7 @@ async def add_channel_column_to_users():
         bool: True если колонка добавлена или уже существует, False если произошла ошибка
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             # Проверяем существование колонки
             cursor = await db.execute("PRAGMA table_info(users)")
             columns = await cursor.fetchall()
@@ -685,7 +1095,7 @@ async def add_pay_count_column():
         bool: True если колонка добавлена или уже существует, False если произошла ошибка
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             # Проверяем существование колонки
             cursor = await db.execute("PRAGMA table_info(users)")
             columns = await cursor.fetchall()
@@ -725,59 +1135,62 @@ async def update_user_pay_count(user_id: int = None):
         if user_id is not None and user_id < 0:
             raise ValueError("User ID не может быть отрицательным")
             
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute('BEGIN EXCLUSIVE TRANSACTION'):
-                if user_id:
-                    # Проверяем существование пользователя
-                    cursor = await db.execute(
-                        "SELECT 1 FROM users WHERE user_id = ?", 
-                        (user_id,)
-                    )
-                    if not await cursor.fetchone():
-                        logger.warning(f"Пользователь {user_id} не найден")
-                        return False
-                        
-                    # Обновляем pay_count для конкретного пользователя
-                    await db.execute("""
-                        UPDATE users 
-                        SET pay_count = (
-                            SELECT COUNT(*) 
-                            FROM user_transactions 
-                            WHERE user_id = ? 
-                            AND status = 'succeeded'
-                        )
-                        WHERE user_id = ?
-                    """, (user_id, user_id))
+        async with db_pool.writer() as db:
+            if user_id:
+                # Проверяем существование пользователя
+                cursor = await db.execute(
+                    "SELECT 1 FROM users WHERE user_id = ?", 
+                    (user_id,)
+                )
+                if not await cursor.fetchone():
+                    logger.warning(f"Пользователь {user_id} не найден")
+                    return False
                     
-                    # Проверяем успешность обновления
-                    cursor = await db.execute(
-                        "SELECT pay_count FROM users WHERE user_id = ?", 
-                        (user_id,)
+                # Обновляем pay_count для конкретного пользователя
+                await db.execute("""
+                    UPDATE users 
+                    SET pay_count = (
+                        SELECT COUNT(*) 
+                        FROM user_transactions 
+                        WHERE user_id = ? 
+                        AND status = 'succeeded'
                     )
-                    new_count = await cursor.fetchone()
-                    logger.info(f"Обновлен pay_count для пользователя {user_id}: {new_count[0]}")
-                else:
-                    # Оптимизированное массовое обновление
-                    await db.execute("""
-                        WITH payment_counts AS (
-                            SELECT user_id, COUNT(*) as succeeded_count
-                            FROM user_transactions 
-                            WHERE status = 'succeeded'
-                            GROUP BY user_id
-                        )
-                        UPDATE users 
-                        SET pay_count = COALESCE(
-                            (SELECT succeeded_count 
-                             FROM payment_counts 
-                             WHERE payment_counts.user_id = users.user_id),
-                            0
-                        )
-                    """)
-                    logger.info("Обновлен pay_count для всех пользователей")
-                
-                await db.commit()
-                return True
+                    WHERE user_id = ?
+                """, (user_id, user_id))
                 
+                # Проверяем успешность обновления
+                cursor = await db.execute(
+                    "SELECT pay_count FROM users WHERE user_id = ?", 
+                    (user_id,)
+                )
+                new_count = await cursor.fetchone()
+                logger.info(f"Обновлен pay_count для пользователя {user_id}: {new_count[0]}")
+            else:
+                # Оптимизированное массовое обновление
+                await db.execute("""
+                    WITH payment_counts AS (
+                        SELECT user_id, COUNT(*) as succeeded_count
+                        FROM user_transactions 
+                        WHERE status = 'succeeded'
+                        GROUP BY user_id
+                    )
+                    UPDATE users 
+                    SET pay_count = COALESCE(
+                        (SELECT succeeded_count 
+                         FROM payment_counts 
+                         WHERE payment_counts.user_id = users.user_id),
+                        0
+                    )
+                """)
+                logger.info("Обновлен pay_count для всех пользователей")
+            
+            await db.commit()
+        if user_id:
+            user_cache.invalidate(user_id)
+        else:
+            user_cache.clear()
+        return True
+            
     except ValueError as ve:
         logger.error(f"Ошибка валидации: {ve}")
         return False
@@ -788,18 +1201,17 @@ async def update_user_pay_count(user_id: int = None):
 
 async def set_is_first_payment_done(user_id: int, is_first_payment_done: bool):
     """Устанавливает значение is_first_payment_done для пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            UPDATE users
-            SET is_first_payment_done = ?
-            WHERE user_id = ?
-        """, (is_first_payment_done, user_id))
-        await db.commit()
-        logger.info(f"Значение is_first_payment_done для пользователя {user_id} установлено на {is_first_payment_done}.")
+    await batch_writer.execute("""
+        UPDATE users
+        SET is_first_payment_done = ?
+        WHERE user_id = ?
+    """, (is_first_payment_done, user_id))
+    logger.info(f"Значение is_first_payment_done для пользователя {user_id} установлено на {is_first_payment_done}.")
+    user_cache.invalidate(user_id)
 
 async def get_is_first_payment_done(user_id: int) -> bool:
     """Получает значение is_first_payment_done для пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("""
             SELECT is_first_payment_done
             FROM users
@@ -811,7 +1223,7 @@ async def get_is_first_payment_done(user_id: int) -> bool:
 
 async def add_is_first_payment_done_column():
     """Добавляет колонку is_first_payment_done в таблицу users, если её нет."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         cursor = await db.execute("PRAGMA table_info(users)")
         columns = {row[1] for row in await cursor.fetchall()}
 
@@ -845,16 +1257,35 @@ async def get_user_transactions(user_id: int):
             ...
         ]
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with db_pool.reader() as db:
+        db.row_factory = Transaction.row_factory
         cursor = await db.execute("""
-            SELECT id, amount, status, transaction_id, created_at
+            SELECT id, user_id, amount, status, transaction_id, created_at
             FROM user_transactions 
             WHERE user_id = ?
             ORDER BY created_at DESC
         """, (user_id,))
-        transactions = await cursor.fetchall()
-        return [dict(row) for row in transactions]
+        return await cursor.fetchall()
+
+async def get_user_transactions_page(user_id: int, limit: int, after: int = None, before: int = None):
+    """
+    Получает страницу транзакций пользователя (новые первые).
+
+    Args:
+        user_id (int): ID пользователя
+        limit (int): Количество транзакций на странице
+        after (int): Курсор следующей страницы (id последней показанной транзакции)
+        before (int): Курсор предыдущей страницы (id первой показанной транзакции)
+
+    Returns:
+        tuple: (список Transaction, prev_cursor, next_cursor)
+    """
+    return await _fetch_page("""
+        SELECT id, user_id, amount, status, transaction_id, created_at
+        FROM user_transactions
+        WHERE user_id = ?
+    """, (user_id,), key="id", limit=limit, after=after, before=before,
+        descending=True, row_factory=Transaction.row_factory)
 
 async def add_multiple_payment_methods(user_id: int, payment_methods: List[Dict], days_delay: int = 0):
     for method in payment_methods:
@@ -882,7 +1313,7 @@ async def get_transaction_by_id(transaction_id: str) -> dict | None:
             'created_at': '2024-03-20 12:34:56'
         }
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         db.row_factory = aiosqlite.Row
         
         query = """
@@ -925,12 +1356,14 @@ async def add_transaction(user_id: int, amount: int, transaction_id: str, status
         bool: True если транзакция успешно добавлена, False если произошла ошибка
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute("""
                 INSERT INTO user_transactions (user_id, amount, transaction_id, status)
                 VALUES (?, ?, ?, ?)
             """, (user_id, amount, transaction_id, status))
             await db.commit()
+            # pay_count пользователя меняет триггер
+            user_cache.invalidate(user_id)
             return True
     except Exception as e:
         logger.error(f"Error adding transaction: {e}")
@@ -949,13 +1382,16 @@ async def update_transaction_status(transaction_id: str, new_status: str):
         bool: True если статус успешно обновлен, False если произошла ошибка
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
+        async with db_pool.writer() as db:
+            cursor = await db.execute("""
                 UPDATE user_transactions 
                 SET status = ? 
                 WHERE transaction_id = ?
+                RETURNING user_id
             """, (new_status, transaction_id))
+            user_ids = [row[0] for row in await cursor.fetchall()]
             await db.commit()
+            user_cache.invalidate_many(user_ids)
             return True
     except Exception as e:
         logger.error(f"Error updating transaction status: {e}")
@@ -974,7 +1410,7 @@ async def update_user_channel(user_id: int, from_channel: str):
         bool: True если успешно, False если произошла ошибка
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute(
                 """
                 UPDATE users 
@@ -984,6 +1420,7 @@ async def update_user_channel(user_id: int, from_channel: str):
                 (from_channel, user_id)
             )
             await db.commit()
+            user_cache.invalidate(user_id)
             logger.info(f"Обновлен канал для пользователя {user_id}: {from_channel}")
             return True
     except Exception as e:
@@ -994,7 +1431,7 @@ async def add_inbound_columns():
     """
     Добавляет новые колонки в таблицу inbounds если их нет
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         # Получаем информацию о существующих колонках
         cursor = await db.execute("PRAGMA table_info(inbounds)")
         columns = {row[1] for row in await cursor.fetchall()}
@@ -1019,7 +1456,7 @@ async def migrate_servers_data():
     """
     Миграция данных серверов с переносом всех клиентов в VLESS
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         try:
             # 1. Создаем новые таблицы
             await db.execute("""
@@ -1101,33 +1538,57 @@ async def migrate_servers_data():
             await db.execute("DROP TABLE IF EXISTS inbounds")
             raise
 
-async def get_admins():
+async def load_admins():
     """
-    Получает список ID администраторов
+    Загружает ID администраторов из базы в память. Вызывается при старте
+    и периодически, чтобы подхватить изменения, сделанные в обход бота
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    global _admin_ids
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT user_id FROM users WHERE is_admin = 1")
-        return [row[0] for row in await cursor.fetchall()]
+        _admin_ids = {row[0] for row in await cursor.fetchall()}
+    logger.info(f"Загружено администраторов: {len(_admin_ids)}")
+
+async def get_admins():
+    """
+    Получает список ID администраторов (из памяти, без запроса к БД)
+    """
+    if _admin_ids is None:
+        await load_admins()
+    return list(_admin_ids)
+
+def is_admin_id(user_id) -> bool:
+    """
+    Проверяет, является ли пользователь администратором, по набору в памяти
+    """
+    if _admin_ids is None:
+        return False
+    try:
+        return int(user_id) in _admin_ids
+    except (TypeError, ValueError):
+        return False
 
 async def sync_server_clients_count():
     """
-    Синхронизирует счетчики активных ключей для всех серверов и их инбаундов
-    путем подсчета актуальных ключей в базе данных
+    Сверяет счетчики клиентов инбаундов с количеством ключей в базе данных
+    и исправляет расхождения.
+    
+    Счетчики поддерживаются триггерами таблицы keys, поэтому это проверка
+    согласованности, которая запускается при старте и раз в сутки
     """
     try:
         logger.info("Начало синхронизации счетчиков серверов...")
-        async with aiosqlite.connect(DB_PATH) as db:
-            current_time = int(datetime.now().timestamp() * 1000)
-            
+        async with db_pool.writer() as db:
             # Получаем все активные серверы с их инбаундами
             cursor = await db.execute("""
                 SELECT 
                     s.address,
                     i.inbound_id,
                     i.protocol,
-                    i.server_address
+                    i.id,
+                    i.clients_count
                 FROM servers s
-                JOIN inbounds i ON TRIM(LOWER(s.address)) = TRIM(LOWER(i.server_address))
+                JOIN inbounds i ON i.server_id = s.id
                 WHERE s.is_active = 1
             """)
             server_inbounds = await cursor.fetchall()
@@ -1135,59 +1596,33 @@ async def sync_server_clients_count():
             if not server_inbounds:
                 logger.info("Активные серверы не найдены")
                 return
+
+            # Считаем ключи по инбаундам одним запросом по индексу (как и триггеры, по keys.inbound_row_id)
+            cursor = await db.execute("""
+                SELECT inbound_row_id, COUNT(*)
+                FROM keys
+                WHERE inbound_row_id IS NOT NULL
+                GROUP BY inbound_row_id
+            """)
+            keys_counts = dict(await cursor.fetchall())
                 
-            for server_address, inbound_id, protocol, server_addr in server_inbounds:
+            for server_address, inbound_id, protocol, inbound_row_id, clients_count in server_inbounds:
                 try:
-                    # Получаем базовый адрес сервера без порта
-                    base_address = server_address.split(':')[0].strip().lower()
-                    
-                    # Определяем префикс ключа в зависимости от протокола
-                    key_prefix = 'ss://' if protocol == 'shadowsocks' else 'vless://'
-                    
-                    # Получаем все активные ключи для данного сервера и протокола
-                    cursor = await db.execute("""
-                        SELECT COUNT(*) FROM keys 
-                        WHERE key LIKE ? 
-                        AND expiration_date > ?
-                        AND key LIKE ?
-                    """, (
-                        f"%{base_address}%", 
-                        current_time,
-                        f"{key_prefix}%"
-                    ))
-                    
-                    active_keys_count = (await cursor.fetchone())[0]
-                    
-                    # Проверяем, что счетчик не стал нулевым, если есть активные ключи
-                    if active_keys_count == 0:
-                        # Дополнительная проверка, возможно проблема в формате ключей
-                        cursor = await db.execute("""
-                            SELECT COUNT(*) FROM keys 
-                            WHERE key LIKE ? 
-                            AND expiration_date > ?
-                        """, (f"%{base_address}%", current_time))
-                        total_keys = (await cursor.fetchone())[0]
-                        
-                        if total_keys > 0:
-                            logger.warning(
-                                f"Обнаружено несоответствие: для сервера {server_address}, "
-                                f"инбаунд {inbound_id} ({protocol}) найдено {total_keys} ключей, "
-                                f"но с префиксом {key_prefix} - 0. Возможно, проблема с форматом ключей."
-                            )
+                    active_keys_count = keys_counts.get(inbound_row_id, 0)
+                    if clients_count == active_keys_count:
+                        continue
                     
-                    # Обновляем счетчик в таблице inbounds
+                    # Исправляем счетчик в таблице inbounds
                     await db.execute("""
                         UPDATE inbounds 
                         SET clients_count = ? 
-                        WHERE TRIM(LOWER(server_address)) = TRIM(LOWER(?))
-                        AND inbound_id = ?
-                        AND protocol = ?
-                    """, (active_keys_count, server_addr, inbound_id, protocol))
+                        WHERE id = ?
+                    """, (active_keys_count, inbound_row_id))
                     
-                    logger.info(
+                    logger.warning(
                         f"Сервер {server_address}, "
                         f"инбаунд {inbound_id} ({protocol}): "
-                        f"обновлен счетчик клиентов на {active_keys_count}"
+                        f"счетчик клиентов исправлен с {clients_count} на {active_keys_count}"
                     )
                     
                 except Exception as e:
@@ -1209,81 +1644,27 @@ async def cleanup_expired_keys():
     """
     try:
         logger.info("Начало очистки истекших ключей при запуске...")
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             current_time = int(datetime.now().timestamp() * 1000)
             
             # Получаем все истекшие ключи
-            cursor = await db.execute("""
-                SELECT key FROM keys 
-                WHERE expiration_date < ?
-            """, (current_time,))
+            cursor = await db.execute(EXPIRED_KEY_NAMES_SQL, (current_time,))
             
-            expired_keys = await cursor.fetchall()
+            expired_keys = [row[0] for row in await cursor.fetchall()]
             
-            if not expired_keys:
-                logger.info("Истекших ключей не найдено")
-                return
-                
-            logger.info(f"Найдено {len(expired_keys)} истекших ключей")
-            
-            # Группируем ключи по серверам для оптимизации
-            server_clients = {}
-            for (key,) in expired_keys:
-                try:
-                    _, _, unique_uuid, address, parts = extract_key_data(key)
-                    if address:
-                        if address not in server_clients:
-                            server_clients[address] = []
-                        server_clients[address].append(unique_uuid)
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке ключа {key}: {e}")
-
-            # Обрабатываем каждый сервер
-            for address, uuids in server_clients.items():
-                try:
-                    protocol = 'ss' if key.startswith('ss://') else 'vless'
-                    server = await get_server_by_address(address, protocol = protocol)
-                    if server:
-                        api = AsyncApi(
-                            f"http://{server['address']}",
-                            server['username'],
-                            server['password'],
-                            use_tls_verify=False
-                        )
-                        await api.login()
-                        
-                        # Удаляем клиентов с сервера
-                        for uuid in uuids:
-                            try:
-                                # await api.client.delete(inbound_id=server['inbound_id'], client_uuid=str(uuid))
-                                logger.info(f"Клиент {uuid} удален с сервера {address}")
-                            except Exception as e:
-                                logger.error(f"Ошибка при удалении клиента {uuid} с сервера {address}: {e}")
-                        
-                        # Обновляем количество клиентов на сервере
-                        clients_count = await get_server_count_by_address(address, server['inbound_id'], protocol)
-                        await update_server_clients_count(address, clients_count, server['inbound_id'])
-                        
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке сервера {address}: {e}")
-
-            # Удаляем все истекшие ключи из БД
-            await db.execute("DELETE FROM keys WHERE expiration_date <= ?", (current_time,))
-            
-            # Обновляем счетчики ключей у всех пользователей
-            await db.execute("""
-                UPDATE users 
-                SET keys_count = (
-                    SELECT COUNT(*) FROM keys 
-                    WHERE keys.user_id = users.user_id
-                )
-            """)
+        if not expired_keys:
+            logger.info("Истекших ключей не найдено")
+            return
             
-            await db.commit()
-            logger.info("Очистка истекших ключей завершена")
+        logger.info(f"Найдено {len(expired_keys)} истекших ключей")
+        
+        # Клиенты с панелей при запуске не удаляются (вызов удаления был закомментирован
+        # и раньше), поэтому ключи удаляются только из БД, одной транзакцией
+        deleted = await _delete_keys_from_db(expired_keys)
+        logger.info(f"Очистка истекших ключей завершена, удалено {deleted}")
             
     except Exception as e:
-        logger.error(f"Ошибка при очистке истекших ключей: {e}")
+            logger.error(f"Ошибка при очистке истекших ключей: {e}")
 
 async def get_available_countries(protocol: str = None):
     """
@@ -1297,21 +1678,22 @@ async def get_available_countries(protocol: str = None):
         Пример: [{'code': 'France', 'name': '🇫🇷 Франция', 'slots': 5}, ...]
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Базовый запрос с проверкой доступности
-            query = """
+        async with db_pool.reader() as db:
+            # Базовый запрос с проверкой доступности (занятые места и действующие резервы)
+            current_time = int(datetime.now().timestamp() * 1000)
+            query = f"""
                 SELECT 
                     s.country,
-                    SUM(i.max_clients - i.clients_count) as available_slots
+                    SUM(i.max_clients - i.clients_count - {_ACTIVE_RESERVATIONS_SQL}) as available_slots
                 FROM servers s
-                JOIN inbounds i ON TRIM(LOWER(s.address)) = TRIM(LOWER(i.server_address))
+                JOIN inbounds i ON i.server_id = s.id
                 WHERE s.is_active = 1
-                    AND i.clients_count < i.max_clients
+                    AND i.clients_count + {_ACTIVE_RESERVATIONS_SQL} < i.max_clients
                     AND i.max_clients > 0
                     AND s.country IS NOT NULL
                     AND s.country != ''
             """
-            params = []
+            params = [current_time, current_time]
             
             # Фильтр по протоколу
             if protocol:
@@ -1369,9 +1751,8 @@ async def ping_server(address: str, port: int, timeout: int = 5) -> bool:
     """
     try:
         url = f"http://{address}:{port}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=timeout) as response:
-                return response.status < 500  # Любой ответ кроме 5xx считаем успешным
+        async with http_client.session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            return response.status < 500  # Любой ответ кроме 5xx считаем успешным
     except (ClientError, asyncio.TimeoutError):
         logger.warning(f"Сервер {address}:{port} недоступен")
         return False
@@ -1379,129 +1760,197 @@ async def ping_server(address: str, port: int, timeout: int = 5) -> bool:
         logger.error(f"Ошибка при проверке сервера {address}:{port}: {e}")
         return False
 
+def _health_cutoff() -> int:
+    """Время (мс), раньше которого результаты монитора доступности считаются устаревшими."""
+    return int((time.time() - SERVER_HEALTH_STALE) * 1000)
+
+async def _probe_server(host: str) -> tuple:
+    """
+    Returns:
+        tuple: (host, доступен ли сервер, время ответа в мс или None)
+    """
+    started = time.monotonic()
+    is_alive = await ping_server(host, SERVER_PANEL_PORT, timeout=SERVER_HEALTH_TIMEOUT)
+    rtt_ms = int((time.monotonic() - started) * 1000) if is_alive else None
+    return host, is_alive, rtt_ms
+
+async def _save_server_health(db: aiosqlite.Connection, results: list, checked_at: int):
+    """Записывает результаты _probe_server() в server_health."""
+    await db.executemany("""
+        INSERT INTO server_health (host, is_alive, rtt_ms, last_checked, last_success, failures)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(host) DO UPDATE SET
+            is_alive = excluded.is_alive,
+            rtt_ms = COALESCE(excluded.rtt_ms, server_health.rtt_ms),
+            last_checked = excluded.last_checked,
+            last_success = COALESCE(excluded.last_success, server_health.last_success),
+            failures = CASE WHEN excluded.is_alive THEN 0 ELSE server_health.failures + 1 END
+    """, [
+        (host, int(is_alive), rtt_ms, checked_at, checked_at if is_alive else None, 0 if is_alive else 1)
+        for host, is_alive, rtt_ms in results
+    ])
+
+async def probe_servers() -> Dict[str, bool]:
+    """
+    Фоновый монитор доступности: проверяет панели всех активных серверов параллельно
+    и сохраняет результат в server_health. Выбор сервера (get_api_instance,
+    get_server_by_address) читает эту таблицу, а не проверяет серверы сам.
+
+    Returns:
+        Dict[str, bool]: Хост сервера -> доступен ли он
+    """
+    async with db_pool.reader() as db:
+        async with db.execute("SELECT DISTINCT host FROM servers WHERE is_active = 1") as cursor:
+            hosts = [row[0] async for row in cursor]
+
+    results = await asyncio.gather(*(_probe_server(host) for host in hosts))
+    checked_at = int(time.time() * 1000)
+
+    async with aux_pool.transaction() as db:
+        await _save_server_health(db, results, checked_at)
+        # Строки удаленных и отключенных серверов
+        await db.execute("DELETE FROM server_health WHERE last_checked < ?", (checked_at,))
+
+    down = [host for host, is_alive, _ in results if not is_alive]
+    if down:
+        logger.warning(f"Недоступны серверы ({len(down)} из {len(results)}): {', '.join(down)}")
+    else:
+        logger.debug(f"Все серверы доступны ({len(results)})")
+    return {host: is_alive for host, is_alive, _ in results}
+
+async def check_server_health(address: str, force: bool = False) -> bool:
+    """
+    Возвращает доступность панели сервера по данным монитора (таблица server_health)
+    
+    Args:
+        address (str): Адрес сервера (порт панели отбрасывается)
+        force (bool): Проверить сервер сейчас и записать результат в server_health
+    
+    Returns:
+        bool: True если сервер доступен или свежих данных о нем нет, False если нет
+    """
+    host = normalize_server_host(address)
+    if force:
+        result = await _probe_server(host)
+        async with aux_pool.transaction() as db:
+            await _save_server_health(db, [result], int(time.time() * 1000))
+        return result[1]
+
+    async with db_pool.reader(attached=True) as db:
+        async with db.execute(
+            "SELECT is_alive FROM server_health WHERE host = ? AND last_checked >= ?",
+            (host, _health_cutoff())
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row is None or bool(row[0])
+
 async def get_api_instance(country: str = None, use_shadowsocks: bool = None):
     """
     Получает экземпляр API для доступного сервера с учетом фильтров
     
+    Место на инбаунде резервируется одним условным INSERT ... RETURNING в slot_reservations
+    на SLOT_RESERVATION_TTL. Его id возвращается вызывающему: add_active_key(reservation_id=...)
+    подтверждает именно этот резерв, release_server_slot(reservation_id) освобождает его
+    при ошибке, а если ключ так и не был сохранен, резерв просто истекает. Недоступные серверы отсеиваются запросом
+    по таблице server_health (ее заполняет фоновый probe_servers()), поэтому покупка
+    не ждет проверки панелей.
+    
     Args:
         country (str, optional): Код страны для фильтрации серверов
         use_shadowsocks (bool, optional): True для SS, False или None для VLESS
     
     Returns:
-        tuple: (AsyncApi, address, pbk, sid, sni, port, utls, protocol, country, inbound_id)
+        tuple: (PanelSession, address, pbk, sid, sni, port, utls, protocol, country, inbound_id, reservation_id)
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Начинаем транзакцию для блокировки таблицы на время выбора сервера
-            async with db.execute('BEGIN EXCLUSIVE TRANSACTION'):
-                query = """
+        current_time = int(datetime.now().timestamp() * 1000)
+        async with db_pool.reader(attached=True) as db:
+            query = f"""
+                SELECT * FROM (
                     SELECT 
                         s.address, s.username, s.password,
-                        i.clients_count, i.max_clients,
-                        i.pbk, i.sid, i.sni, i.port, i.utls, i.protocol, s.country, i.inbound_id,
-                        CAST(i.clients_count AS FLOAT) / NULLIF(CAST(i.max_clients AS FLOAT), 0) as load_ratio
+                        i.clients_count + {_ACTIVE_RESERVATIONS_SQL} as used_slots, i.max_clients,
+                        i.pbk, i.sid, i.sni, i.port, i.utls, i.protocol, s.country, i.inbound_id, i.id
                     FROM servers s
-                    INNER JOIN inbounds i ON TRIM(LOWER(s.address)) = TRIM(LOWER(i.server_address))
+                    INNER JOIN inbounds i ON i.server_id = s.id
                     WHERE s.is_active = 1
-                    AND i.clients_count < i.max_clients
                     AND i.max_clients > 0
-                """
-                params = []
-                
-                if country:
-                    query += " AND s.country = ?"
-                    params.append(country)
-                
-                if use_shadowsocks is not None:
-                    query += " AND i.protocol = ?"
-                    params.append('shadowsocks' if use_shadowsocks else 'vless')
-                
-                # Сортировка по загрузке и случайности
-                query += """ 
-                    ORDER BY 
-                        load_ratio ASC,
-                        i.clients_count ASC,
-                        RANDOM()
-                """
-                
-                cursor = await db.execute(query, params)
-                servers = await cursor.fetchall()
-                
-                if not servers:
-                    error_msg = []
-                    if country:
-                        error_msg.append(f"страны {country}")
-                    if use_shadowsocks is not None:
-                        protocol = "Shadowsocks" if use_shadowsocks else "vless"
-                        error_msg.append(f"протокола {protocol}")
-                    
-                    raise Exception(
-                        "Нет доступных серверов" + 
-                        (f" для {' и '.join(error_msg)}" if error_msg else "")
-                    )
-                
-                # Перебираем серверы, пока не найдем доступный
-                for server in servers:
-                    address, username, password, clients_count, max_clients, pbk, sid, sni, port, utls, protocol, country, inbound_id, _ = server
-                    
-                    # Проверяем доступность сервера
-                    if not await ping_server(address.split(':')[0], 2053):
-                        logger.warning(f"Сервер {address} недоступен, пробуем следующий")
-                        continue
-                    
-                    # Дополнительная проверка лимита
-                    if clients_count >= max_clients:
-                        logger.warning(f"Сервер {address} достиг лимита клиентов: {clients_count}/{max_clients}")
-                        continue
-                    
-                    # Резервируем место для нового клиента
-                    await db.execute("""
-                        UPDATE inbounds 
-                        SET clients_count = clients_count + 1
-                        WHERE TRIM(LOWER(server_address)) = TRIM(LOWER(?))
-                        AND inbound_id = ?
-                        AND protocol = ?
-                        AND clients_count < max_clients
-                    """, (address, inbound_id, protocol))
-                    
-                    # Проверяем успешность обновления
-                    cursor = await db.execute("""
-                        SELECT clients_count 
-                        FROM inbounds 
-                        WHERE TRIM(LOWER(server_address)) = TRIM(LOWER(?))
-                        AND inbound_id = ?
-                        AND protocol = ?
-                    """, (address, inbound_id, protocol))
-                    
-                    new_count = await cursor.fetchone()
-                    if not new_count or new_count[0] <= clients_count:
-                        logger.warning(f"Не удалось зарезервировать место на сервере {address}")
-                        continue
-                    
-                    # Нашли доступный сервер
-                    await db.commit()
-                    
-                    logger.info(
-                        f"Выбран сервер: {address} ({protocol}), "
-                        f"загрузка: {new_count[0]}/{max_clients} "
-                        f"({(new_count[0]/max_clients*100):.1f}%), "
-                        f"страна: {country}"
-                    )
-                    
-                    return (
-                        AsyncApi(
-                            f"http://{address}",
-                            username,
-                            password,
-                            use_tls_verify=False
-                        ),
-                        address, pbk, sid, sni, port, utls, protocol, country, inbound_id
-                    )
-                
-                # Если не нашли доступный сервер
-                await db.rollback()
-                raise Exception("Нет доступных серверов, прошедших проверку доступности")
-                
+                    AND {_SERVER_ALIVE_SQL}
+            """
+            params = [current_time, _health_cutoff()]
+            
+            if country:
+                query += " AND s.country = ?"
+                params.append(country)
+            
+            if use_shadowsocks is not None:
+                query += " AND i.protocol = ?"
+                params.append('shadowsocks' if use_shadowsocks else 'vless')
+            
+            # Сортировка по загрузке и случайности
+            query += """ 
+                )
+                WHERE used_slots < max_clients
+                ORDER BY 
+                    CAST(used_slots AS FLOAT) / max_clients ASC,
+                    used_slots ASC,
+                    RANDOM()
+            """
+            
+            cursor = await db.execute(query, params)
+            servers = await cursor.fetchall()
+            
+        if not servers:
+            error_msg = []
+            if country:
+                error_msg.append(f"страны {country}")
+            if use_shadowsocks is not None:
+                protocol = "Shadowsocks" if use_shadowsocks else "vless"
+                error_msg.append(f"протокола {protocol}")
+            
+            raise Exception(
+                "Нет доступных серверов" + 
+                (f" для {' и '.join(error_msg)}" if error_msg else "")
+            )
+
+        # Перебираем серверы, пока не удастся занять место
+        for server in servers:
+            address, username, password, used_slots, max_clients, pbk, sid, sni, port, utls, protocol, country, inbound_id, inbound_row_id = server
+            
+            # Резервируем место одним условным запросом: если инбаунд успели заполнить,
+            # строка не вставится и мы перейдем к следующему серверу
+            current_time = int(datetime.now().timestamp() * 1000)
+            expires_at = current_time + int(SLOT_RESERVATION_TTL.total_seconds() * 1000)
+            async with db_pool.writer() as db:
+                cursor = await db.execute(f"""
+                    INSERT INTO slot_reservations (inbound_row_id, expires_at)
+                    SELECT i.id, ? FROM inbounds i
+                    WHERE i.id = ?
+                    AND i.clients_count + {_ACTIVE_RESERVATIONS_SQL} < i.max_clients
+                    RETURNING id
+                """, (expires_at, inbound_row_id, current_time))
+                reserved = await cursor.fetchall()
+                await db.commit()
+            
+            if not reserved:
+                logger.warning(f"Сервер {address} достиг лимита клиентов, пробуем следующий")
+                continue
+            
+            logger.info(
+                f"Выбран сервер: {address} ({protocol}), "
+                f"загрузка: {used_slots + 1}/{max_clients} "
+                f"({((used_slots + 1)/max_clients*100):.1f}%), "
+                f"страна: {country}, резерв #{reserved[0][0]}"
+            )
+            
+            return (
+                panel_sessions.session(address, username, password),
+                address, pbk, sid, sni, port, utls, protocol, country, inbound_id, reserved[0][0]
+            )
+        
+        # Если не нашли доступный сервер
+        raise Exception("Нет доступных серверов, прошедших проверку доступности")
+            
     except Exception as e:
         logger.error(f"Ошибка при получении API: {e}")
         raise
@@ -1512,11 +1961,12 @@ async def save_or_update_email(user_id: int, email: str):
     Сохраняет или обновляет email пользователя
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute("""
                 UPDATE users SET email = ? WHERE user_id = ?
             """, (email, user_id))
             await db.commit()
+            user_cache.invalidate(user_id)
             logger.info(f"Email {email} сохранен для пользователя {user_id}")
     except Exception as e:
         logger.error(f"Ошибка при сохранении email: {e}")
@@ -1526,7 +1976,7 @@ async def get_user_email(user_id: int) -> str:
     Получает email пользователя
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             cursor = await db.execute("""
                 SELECT email FROM users WHERE user_id = ?
             """, (user_id,))
@@ -1544,7 +1994,7 @@ async def check_unused_free_keys():
         list: Список user_id пользователей с неиспользованными бесплатными ключами
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             cursor = await db.execute("""
                 SELECT user_id FROM users 
                 WHERE free_keys_count > 0 
@@ -1573,14 +2023,9 @@ async def check_expiring_subscriptions():
         start_ms = int(start_of_tomorrow.timestamp() * 1000)
         end_ms = int(end_of_tomorrow.timestamp() * 1000)
 
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             db.row_factory = aiosqlite.Row
-            query = """
-                SELECT *
-                FROM   keys
-                WHERE  expiration_date >= ? AND expiration_date < ?;
-            """
-            cursor = await db.execute(query, (start_ms, end_ms))
+            cursor = await db.execute(EXPIRING_KEYS_SQL, (start_ms, end_ms))
             rows = await cursor.fetchall()
             return [dict(r) for r in rows]
     except Exception as e:
@@ -1601,14 +2046,9 @@ async def check_expiring_in_3_days_subscriptions():
         start_ms = int(start_of_tomorrow.timestamp() * 1000)
         end_ms = int(end_of_tomorrow.timestamp() * 1000)
 
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             db.row_factory = aiosqlite.Row
-            query = """
-                SELECT *
-                FROM   keys
-                WHERE  expiration_date >= ? AND expiration_date < ?;
-            """
-            cursor = await db.execute(query, (start_ms, end_ms))
+            cursor = await db.execute(EXPIRING_KEYS_SQL, (start_ms, end_ms))
             rows = await cursor.fetchall()
             return [dict(r) for r in rows]
     except Exception as e:
@@ -1616,6 +2056,21 @@ async def check_expiring_in_3_days_subscriptions():
         return []
 
 
+async def iter_users_with_unused_free_keys(chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[int]:
+    """
+    Потоково отдает ID пользователей с неиспользованными бесплатными ключами
+    (free_keys_count = 1), порциями по chunk_size.
+    """
+    async for row in _iter_rows("""
+        SELECT user_id FROM users 
+        WHERE free_keys_count = 1 
+        AND user_id NOT IN (
+            SELECT DISTINCT user_id FROM keys 
+            WHERE user_id IS NOT NULL
+        )
+    """, key="user_id", chunk_size=chunk_size):
+        yield row["user_id"]
+
 async def get_users_with_unused_free_keys():
     """
     Получает список пользователей, у которых есть неиспользованные бесплатные ключи
@@ -1625,22 +2080,57 @@ async def get_users_with_unused_free_keys():
         list: Список ID пользователей
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("""
-                SELECT user_id FROM users 
-                WHERE free_keys_count = 1 
-                AND user_id NOT IN (
-                    SELECT DISTINCT user_id FROM keys 
-                    WHERE user_id IS NOT NULL
-                )
-            """)
-            users = await cursor.fetchall()
-            logger.info(f"Найдено {len(users)} пользователей с неиспользованными бесплатными ключами")
-            return [user[0] for user in users]
+        users = [user_id async for user_id in iter_users_with_unused_free_keys()]
+        logger.info(f"Найдено {len(users)} пользователей с неиспользованными бесплатными ключами")
+        return users
     except Exception as e:
         logger.error(f"Ошибка при получении пользователей с неиспользованными ключами: {e}")
         return []
 
+async def _last_traffic_collection() -> int | None:
+    """Время последнего сбора трафика в key_traffic (мс Unix-эпохи) или None."""
+    async with aux_pool.reader() as db:
+        async with db.execute("SELECT MAX(updated_at) FROM key_traffic") as cursor:
+            row = await cursor.fetchone()
+    return row[0]
+
+async def iter_users_with_zero_traffic_keys(chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[tuple]:
+    """
+    Потоково отдает пары (user_id, key) для действующих ключей с нулевым трафиком,
+    порциями по chunk_size.
+
+    Трафик берется из свежих строк таблицы key_traffic (см. collect_inbound_traffic);
+    если сбора новее TRAFFIC_STALE секунд нет, — из key_usage_reminders.last_traffic.
+    """
+    now_ms = int(datetime.now().timestamp() * 1000)
+    fresh_since = now_ms - TRAFFIC_STALE * 1000
+    last_collection = await _last_traffic_collection()
+
+    if last_collection is not None and last_collection >= fresh_since:
+        query = """
+            SELECT k.user_id, k.key 
+            FROM keys k
+            JOIN key_traffic t ON t.server_host = k.server_ip AND t.panel_email = k.panel_email
+            WHERE t.up + t.down = 0
+            AND t.updated_at >= ?
+            AND k.user_id IS NOT NULL
+            AND k.expiration_date > ?
+        """
+        params = (fresh_since, now_ms)
+    else:
+        query = """
+            SELECT k.user_id, k.key 
+            FROM keys k
+            JOIN key_usage_reminders r ON k.key = r.key
+            WHERE r.last_traffic = 0
+            AND k.user_id IS NOT NULL
+            AND k.expiration_date > ?
+        """
+        params = (now_ms,)
+
+    async for row in _iter_rows(query, params, key="key", chunk_size=chunk_size, attached=True):
+        yield row["user_id"], row["key"]
+
 async def get_users_with_zero_traffic_keys():
     """
     Получает список пользователей, у которых есть ключи с нулевым трафиком
@@ -1649,23 +2139,24 @@ async def get_users_with_zero_traffic_keys():
         list: Список кортежей (user_id, key)
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("""
-                SELECT k.user_id, k.key 
-                FROM keys k
-                JOIN key_usage_reminders r ON k.key = r.key
-                WHERE r.last_traffic = 0
-                AND k.user_id IS NOT NULL
-                AND k.expiration_date > ?
-            """, (int(datetime.now().timestamp() * 1000),))
-            
-            results = await cursor.fetchall()
-            logger.info(f"Найдено {len(results)} пользователей с ключами с нулевым трафиком")
-            return results
+        results = [pair async for pair in iter_users_with_zero_traffic_keys()]
+        logger.info(f"Найдено {len(results)} пользователей с ключами с нулевым трафиком")
+        return results
     except Exception as e:
         logger.error(f"Ошибка при получении пользователей с ключами с нулевым трафиком: {e}")
         return []
 
+async def iter_users_with_specific_balance(balance=99, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[int]:
+    """
+    Потоково отдает ID пользователей с указанным балансом и без активных подписок,
+    порциями по chunk_size.
+    """
+    current_time = int(datetime.now().timestamp() * 1000)
+    async for row in _iter_rows(
+        USERS_WITHOUT_ACTIVE_KEYS_SQL, (balance, current_time), key="user_id", chunk_size=chunk_size
+    ):
+        yield row["user_id"]
+
 async def get_users_with_specific_balance(balance=99):
     """
     Получает список пользователей с указанным балансом и без активных подписок
@@ -1677,32 +2168,27 @@ async def get_users_with_specific_balance(balance=99):
         list: Список ID пользователей
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            current_time = int(datetime.now().timestamp() * 1000)
-            
-            cursor = await db.execute("""
-                SELECT user_id FROM users 
-                WHERE balance = ? 
-                AND (
-                    user_id NOT IN (
-                        SELECT DISTINCT user_id FROM keys 
-                        WHERE expiration_date > ?
-                    )
-                    OR (
-                        SELECT COUNT(*) FROM keys 
-                        WHERE keys.user_id = users.user_id 
-                        AND expiration_date > ?
-                    ) = 0
-                )
-            """, (balance, current_time, current_time))
-            
-            users = await cursor.fetchall()
-            logger.info(f"Найдено {len(users)} пользователей с балансом {balance} руб. без активных подписок")
-            return [user[0] for user in users]
+        users = [user_id async for user_id in iter_users_with_specific_balance(balance)]
+        logger.info(f"Найдено {len(users)} пользователей с балансом {balance} руб. без активных подписок")
+        return users
     except Exception as e:
         logger.error(f"Ошибка при получении пользователей с балансом {balance}: {e}")
         return []
 
+async def iter_users_with_expiring_subscriptions(days=3, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[int]:
+    """
+    Потоково отдает ID пользователей, у которых подписка истекает в ближайшие days дней,
+    порциями по chunk_size.
+    """
+    # Текущее время и время через указанное количество дней в миллисекундах
+    current_time = int(datetime.now().timestamp() * 1000)
+    expiry_time = int((datetime.now() + timedelta(days=days)).timestamp() * 1000)
+
+    async for row in _iter_rows(
+        USERS_WITH_EXPIRING_KEYS_SQL, (current_time, expiry_time), key="user_id", chunk_size=chunk_size
+    ):
+        yield row["user_id"]
+
 async def get_users_with_expiring_subscriptions(days=3):
     """
     Получает список пользователей, у которых подписка истекает в ближайшие дни
@@ -1714,23 +2200,9 @@ async def get_users_with_expiring_subscriptions(days=3):
         list: Список ID пользователей
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Текущее время в миллисекундах
-            current_time = int(datetime.now().timestamp() * 1000)
-            
-            # Время через указанное количество дней
-            expiry_time = int((datetime.now() + timedelta(days=days)).timestamp() * 1000)
-            
-            cursor = await db.execute("""
-                SELECT DISTINCT user_id FROM keys
-                WHERE expiration_date > ?
-                AND expiration_date < ?
-                AND user_id IS NOT NULL
-            """, (current_time, expiry_time))
-            
-            users = await cursor.fetchall()
-            logger.info(f"Найдено {len(users)} пользователей с истекающими подписками в ближайшие {days} дней")
-            return [user[0] for user in users]
+        users = [user_id async for user_id in iter_users_with_expiring_subscriptions(days)]
+        logger.info(f"Найдено {len(users)} пользователей с истекающими подписками в ближайшие {days} дней")
+        return users
     except Exception as e:
         logger.error(f"Ошибка при получении пользователей с истекающими подписками: {e}")
         return []
@@ -1788,18 +2260,15 @@ async def remove_key(key: str, user_id: str):
         logger.warning(f"По какой-то причине нет этого элемента в списке: {job_id}")
 
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            try:
-                # Удаляем ключ с сервера
-                await server_remove_key(key, user_id)
-                # Удаляем истекшие ключи из БД
-                await remove_active_key(key, db)
-            except Exception as e:
-                logger.error(f"Ошибка при обработке ключа {key}: {e}")
-                return
-            # Обновляем счетчики ключей у пользователей
-            await update_multiple_keys_count([user_id], db)
-            logger.info(f"Удалён 1 ключ")
+        try:
+            # Удаляем ключ с сервера (сетевой запрос — без удержания соединения с БД)
+            await server_remove_key(key, user_id)
+            # Удаляем истекшие ключи из БД (счетчики обновят триггеры)
+            await remove_active_key(key)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке ключа {key}: {e}")
+            return
+        logger.info(f"Удалён 1 ключ")
     except Exception as e:
         logger.error(f"Ошибка при удалении истекших ключей: {e}")
 
@@ -1808,47 +2277,135 @@ async def remove_expired_keys(excluding_keys: List[str]):
     Удаляет истекшие ключи и обновляет счетчики у пользователей и серверов
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             current_time = int(datetime.now().timestamp() * 1000)
             
-            # Получаем все истекшие ключи с информацией о пользователях
-            cursor = await db.execute("""
-                SELECT key, user_id FROM keys 
-                WHERE expiration_date < ?
-            """, (current_time,))
+            # Получаем все истекшие ключи
+            cursor = await db.execute(EXPIRED_KEY_NAMES_SQL, (current_time,))
             
             expired_keys = await cursor.fetchall()
             
-            if not expired_keys:
-                return
-            
-            # Обрабатываем каждый истекший ключ
-            user_ids = []
-            for key, user_id in expired_keys:
-                if key in excluding_keys:
-                    continue
-
-                try:
-                    await server_remove_key(key, user_id)
-                    user_ids.append(user_id)
-
-                    # Удаляем истекшие ключи из БД
-                    await remove_active_key(key, db)
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке ключа {key}: {e}")
-                    continue
-            
-            # Обновляем счетчики ключей у пользователей
-            await update_multiple_keys_count(user_ids, db)
-            
-            logger.info(f"Удалено {len(user_ids)} истекших ключей")
+        excluding_keys = set(excluding_keys)
+        keys = [row[0] for row in expired_keys if row[0] not in excluding_keys]
+        if not keys:
+            return
+        
+        result = await remove_keys(keys)
+        logger.info(f"Удалено {len(result['deleted'])} истекших ключей, не удалось удалить {len(result['failed'])}")
             
     except Exception as e:
         logger.error(f"Ошибка при удалении истекших ключей: {e}")
 
+async def _delete_server_clients(server: dict, clients: list) -> tuple[list, list]:
+    """
+    Удаляет клиентов с одной панели, не больше PANEL_DELETE_CONCURRENCY запросов одновременно.
+
+    Args:
+        server (dict): address, username, password сервера
+        clients (list): Кортежи (key, inbound_id, client_id)
+
+    Returns:
+        tuple[list, list]: Ключи, клиенты которых удалены, и ключи, удалить которые не удалось
+    """
+    api = panel_sessions.session(server['address'], server['username'], server['password'])
+    semaphore = asyncio.Semaphore(PANEL_DELETE_CONCURRENCY)
+    deleted, failed = [], []
+
+    async def delete(key, inbound_id, client_id):
+        async with semaphore:
+            try:
+                await api.client.delete(inbound_id=inbound_id, client_uuid=str(client_id))
+                deleted.append(key)
+            except Exception as e:
+                logger.error(f"Ошибка при удалении клиента {client_id} с сервера {server['address']}: {e}")
+                failed.append(key)
+
+    await asyncio.gather(*(delete(*client) for client in clients))
+    logger.info(f"С сервера {server['address']} удалено клиентов: {len(deleted)} из {len(clients)}")
+    return deleted, failed
+
+async def _delete_keys_from_db(keys: List[str]) -> int:
+    """
+    Удаляет ключи из БД одной транзакцией (счетчики пользователей и инбаундов обновят триггеры).
+
+    Returns:
+        int: Количество удаленных ключей
+    """
+    rows = []
+    async with db_pool.transaction() as db:
+        for start in range(0, len(keys), STREAM_CHUNK_SIZE):
+            chunk = keys[start:start + STREAM_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            cursor = await db.execute(
+                f"DELETE FROM keys WHERE key IN ({placeholders}) RETURNING user_id, key", chunk
+            )
+            rows.extend(await cursor.fetchall())
+    user_cache.invalidate_many({row[0] for row in rows})
+    _forget_key_reminders(row[1] for row in rows)
+    return len(rows)
+
+async def remove_keys(keys: List[str]) -> dict:
+    """
+    Удаляет ключи с панелей и из БД.
+
+    Ключи группируются по серверу и инбаунду (по полям server_ip и protocol), серверы
+    обрабатываются параллельно, на каждом не больше PANEL_DELETE_CONCURRENCY запросов
+    одновременно. Ключи, клиентов которых не удалось удалить с панели, остаются в БД.
+    Ключи, для которых в БД нет активного сервера, удаляются только из БД.
+
+    Returns:
+        dict: 'deleted' — удаленные ключи, 'failed' — ключи, которые не удалось удалить с панели
+    """
+    if not keys:
+        return {'deleted': [], 'failed': []}
+
+    rows = []
+    async with db_pool.reader() as db:
+        db.row_factory = aiosqlite.Row
+        for start in range(0, len(keys), STREAM_CHUNK_SIZE):
+            chunk = keys[start:start + STREAM_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            async with db.execute(f"""
+                SELECT k.key, k.protocol, k.client_uuid, k.panel_email,
+                       s.address, s.username, s.password, i.inbound_id
+                FROM keys k
+                LEFT JOIN servers s ON s.host = k.server_ip AND s.is_active = 1
+                LEFT JOIN inbounds i ON i.server_id = s.id AND i.protocol = k.protocol
+                WHERE k.key IN ({placeholders})
+            """, chunk) as cursor:
+                rows.extend(await cursor.fetchall())
+
+    # Адрес сервера -> клиенты для удаления. Если на сервере несколько инбаундов
+    # одного протокола, ключ попадает в выборку несколько раз — берем первый
+    servers: Dict[str, dict] = {}
+    without_server = []
+    seen = set()
+    for row in rows:
+        if row['key'] in seen:
+            continue
+        seen.add(row['key'])
+        if row['address'] is None or row['inbound_id'] is None:
+            without_server.append(row['key'])
+            continue
+        # Клиент VLESS удаляется по UUID, клиент Shadowsocks — по email
+        client_id = row['client_uuid'] if row['protocol'] == 'vless' else row['panel_email']
+        group = servers.setdefault(row['address'], {'server': dict(row), 'clients': []})
+        group['clients'].append((row['key'], row['inbound_id'], client_id))
+
+    results = await asyncio.gather(
+        *(_delete_server_clients(group['server'], group['clients']) for group in servers.values())
+    )
+    deleted = without_server + [key for server_deleted, _ in results for key in server_deleted]
+    failed = [key for _, server_failed in results for key in server_failed]
+
+    if deleted:
+        await _delete_keys_from_db(deleted)
+    return {'deleted': deleted, 'failed': failed}
+
 async def server_remove_key(key: str, user_id: str):
     """
-    Полностью удаляет указанный ключ и обновляет счетчики у пользователей и серверов
+    Удаляет клиента указанного ключа с сервера.
+    Счетчик клиентов инбаунда уменьшается триггером при удалении ключа из БД
     """
     # Извлекаем данные из ключа
     device, unique_id, unique_uuid, address, parts = extract_key_data(key)
@@ -1859,18 +2416,11 @@ async def server_remove_key(key: str, user_id: str):
         if server:
             try:
                 # Подключаемся к API сервера
-                api = AsyncApi(
-                    f"http://{server['address']}",
-                    server['username'],
-                    server['password'],
-                    use_tls_verify=False
-                )
-                await api.login()
+                api = await panel_sessions.get(server['address'], server['username'], server['password'])
 
                 inbound_id = server['inbound_id']
                 email = f"{parts[0]}_{parts[1]}_{parts[2]}"
                 client = await api.client.get_by_email(email)
-                clients_count = await get_server_count_by_address(address, inbound_id, protocol)
 
                 # Удаляем клиента с сервера
                 if protocol == 'vless':
@@ -1878,48 +2428,95 @@ async def server_remove_key(key: str, user_id: str):
                 else:
                     await api.client.delete(inbound_id=inbound_id, client_uuid=str(client.email))
                 logger.info(f"Клиент {unique_uuid} удален с сервера {address}")
-                
-                await update_server_clients_count(address, clients_count - 1, inbound_id)
-
-                logger.info(f"Уменьшено количество клиентов на сервере {address}")
             except Exception as e:
                 logger.error(f"Ошибка при удалении клиента с сервера {address}: {e}")
                 raise e
 
 async def update_multiple_keys_count(user_ids: List[str], db = None):
-    current_time = int(datetime.now().timestamp() * 1000)
+    """
+    Пересчитывает keys_count у указанных пользователей по таблице keys.
+    
+    Обычно счетчик поддерживают триггеры, поэтому функция нужна только для
+    проверки согласованности
+    """
+    if not user_ids:
+        return
 
+    placeholders = ", ".join("?" for _ in user_ids)
+    query = f"""
+        UPDATE users 
+        SET keys_count = (SELECT COUNT(*) FROM keys WHERE keys.user_id = users.user_id)
+        WHERE user_id IN ({placeholders})
+    """
     if db is not None:
-        for user_id in user_ids:
+        await db.execute(query, list(user_ids))
+        await db.commit()
+    else:
+        async with db_pool.writer() as db:
+            await db.execute(query, list(user_ids))
+            await db.commit()
+    user_cache.invalidate_many(user_ids)
+
+async def audit_counters():
+    """
+    Сверяет счетчики, которые поддерживаются триггерами (users.keys_count, users.pay_count,
+    inbounds.clients_count), с фактическими данными и исправляет расхождения
+    """
+    try:
+        await sync_server_clients_count()
+        async with db_pool.writer() as db:
             cursor = await db.execute("""
-                SELECT COUNT(*) FROM keys 
-                WHERE user_id = ? AND expiration_date >= ?
-            """, (user_id, current_time))
-            new_keys_count = (await cursor.fetchone())[0]
-            
-            await db.execute("""
                 UPDATE users 
-                SET keys_count = ? 
-                WHERE user_id = ?
-            """, (new_keys_count, user_id))
-
+                SET keys_count = (SELECT COUNT(*) FROM keys WHERE keys.user_id = users.user_id)
+                WHERE keys_count IS NOT (SELECT COUNT(*) FROM keys WHERE keys.user_id = users.user_id)
+            """)
+            fixed_keys = cursor.rowcount
+            cursor = await db.execute("""
+                UPDATE users 
+                SET pay_count = (
+                    SELECT COUNT(*) FROM user_transactions t
+                    WHERE t.user_id = users.user_id AND t.status = 'succeeded'
+                )
+                WHERE pay_count IS NOT (
+                    SELECT COUNT(*) FROM user_transactions t
+                    WHERE t.user_id = users.user_id AND t.status = 'succeeded'
+                )
+            """)
+            fixed_payments = cursor.rowcount
             await db.commit()
-    else:
-        async with aiosqlite.connect(DB_PATH) as db:
-            for user_id in user_ids:
-                cursor = await db.execute("""
-                    SELECT COUNT(*) FROM keys 
-                    WHERE user_id = ? AND expiration_date >= ?
-                """, (user_id, current_time))
-                new_keys_count = (await cursor.fetchone())[0]
-                
-                await db.execute("""
-                    UPDATE users 
-                    SET keys_count = ? 
-                    WHERE user_id = ?
-                """, (new_keys_count, user_id))
+        if fixed_keys or fixed_payments:
+            user_cache.clear()
 
-                await db.commit()
+        if fixed_keys or fixed_payments:
+            logger.warning(
+                f"Исправлены расхождения счетчиков: keys_count у {fixed_keys}, "
+                f"pay_count у {fixed_payments} пользователей"
+            )
+        else:
+            logger.info("Счетчики пользователей согласованы")
+    except Exception as e:
+        logger.error(f"Ошибка при проверке счетчиков: {e}")
+
+
+async def check_expiry_query_plans() -> dict:
+    """
+    Проверяет через EXPLAIN QUERY PLAN, что запросы по сроку действия ключей используют индексы
+
+    План строится на отдельном соединении, открытом после миграций: читатели пула
+    открыты до init_db и могут еще видеть схему до пересоздания таблицы keys.
+
+    Returns:
+        dict: Название запроса -> список строк плана. Если запрос читает keys
+        не по ожидаемому индексу, пишется предупреждение
+    """
+    plans = {}
+    async with aiosqlite.connect(DB_PATH) as db:
+        for name, (query, index) in EXPIRY_QUERIES.items():
+            details = await explain_query_plan(db, query)
+            plans[name] = details
+            if not reads_keys_by_index(details, index):
+                logger.warning(f"Запрос {name} читает keys не по индексу {index}: {details}")
+    return plans
 
 
 def setup_scheduler():
@@ -1937,14 +2534,55 @@ def setup_scheduler():
     #    replace_existing=True
     #)
     
-    # Синхронизация счетчиков клиентов (каждые 15 минут)
+    # Проверка счетчиков ключей, платежей и клиентов (раз в сутки, их поддерживают триггеры)
+    scheduler.add_job(
+        audit_counters,
+        trigger=IntervalTrigger(days=1),
+        id='audit_counters',
+        name='Audit denormalized counters',
+        replace_existing=True
+    )
+    
+    # Очистка истекших резервов мест на инбаундах (каждые 15 минут)
     scheduler.add_job(
-        sync_server_clients_count,
+        purge_expired_reservations,
         trigger=IntervalTrigger(minutes=15),
-        id='sync_server_clients_count',
-        name='Sync server clients count',
+        id='purge_expired_reservations',
+        name='Purge expired slot reservations',
+        replace_existing=True
+    )
+    
+    # Перечитывание списка администраторов (каждые 10 минут)
+    scheduler.add_job(
+        load_admins,
+        trigger=IntervalTrigger(minutes=10),
+        id='load_admins',
+        name='Reload admin ids',
+        replace_existing=True
+    )
+    
+    # Проверка доступности серверов (каждые SERVER_HEALTH_INTERVAL секунд, первая — сразу)
+    scheduler.add_job(
+        probe_servers,
+        trigger=IntervalTrigger(seconds=SERVER_HEALTH_INTERVAL),
+        id='probe_servers',
+        name='Probe server health',
+        next_run_time=datetime.now(),
+        max_instances=1,
+        coalesce=True,
         replace_existing=True
-    )    
+    )
+    
+    # Сбор трафика клиентов со всех панелей в key_traffic (каждые TRAFFIC_COLLECT_INTERVAL секунд)
+    scheduler.add_job(
+        collect_inbound_traffic,
+        trigger=IntervalTrigger(seconds=TRAFFIC_COLLECT_INTERVAL),
+        id='collect_inbound_traffic',
+        name='Collect inbound traffic',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
     
     # Создание резервных копий базы данных (каждые 5 минут)
     scheduler.add_job(
@@ -1970,7 +2608,7 @@ async def add_used_promocode(user_id, promocode):
         user_id (int): ID пользователя
         promocode (str): Код использованного промокода
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             INSERT INTO used_promocodes (user_id, promocode, used_at) 
             VALUES (?, ?, ?)
@@ -1988,7 +2626,7 @@ async def check_user_used_promocode(user_id, promocode):
     Returns:
         bool: True, если промокод уже использован, иначе False
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("""
             SELECT COUNT(*) FROM used_promocodes 
             WHERE user_id = ? AND promocode = ?
@@ -2006,7 +2644,7 @@ async def get_user_used_promocodes(user_id):
     Returns:
         list: Список использованных промокодов
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("""
             SELECT promocode, used_at FROM used_promocodes 
             WHERE user_id = ? 
@@ -2015,7 +2653,7 @@ async def get_user_used_promocodes(user_id):
         return await cursor.fetchall()
 
 async def get_free_keys_count(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT free_keys_count FROM users WHERE user_id = ?", (user_id,))
         result = await cursor.fetchone()
         return result[0] if result else 0
@@ -2030,20 +2668,22 @@ async def get_free_days(user_id):
     Returns:
         int: Количество промо-дней или 0, если не найдено
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT promo_days FROM users WHERE user_id = ?", (user_id,))
         result = await cursor.fetchone()
         return result[0] if result else 0
 
 async def set_free_keys_count(user_id, count):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("UPDATE users SET free_keys_count = ? WHERE user_id = ?", (count, user_id))
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def add_promocode_days(user_id, days):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("UPDATE users SET promo_days = ? WHERE user_id = ?", (days, user_id))
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def update_promocode_amount(promo_id):
     """
@@ -2052,7 +2692,7 @@ async def update_promocode_amount(promo_id):
     Args:
         promo_id (int): ID промокода
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE promocodes 
             SET amount = amount - 1 
@@ -2061,12 +2701,12 @@ async def update_promocode_amount(promo_id):
         await db.commit()
 
 async def add_promocode(code, user_id, amount, gift_balance, gift_days, expiration_date):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("INSERT INTO promocodes (code, user_id, amount, gift_balance, gift_days, expiration_date) VALUES (?, ?, ?, ?, ?, ?)", (code, user_id, amount, gift_balance, gift_days, expiration_date))
         await db.commit()
 
 async def get_promocode(code):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT * FROM promocodes WHERE code = ?", (code,))
         return await cursor.fetchone()
 
@@ -2077,15 +2717,26 @@ async def remove_promocode(code):
     Args:
         code (str): Код промокода
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("DELETE FROM promocodes WHERE code = ?", (code,))
         await db.commit()
 
 async def get_all_promocodes():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT * FROM promocodes")
         return await cursor.fetchall()
 
+async def get_promocodes_page(limit: int, after: int = None, before: int = None):
+    """
+    Получает страницу промокодов по возрастанию id.
+
+    Returns:
+        tuple: (список кортежей строк promocodes, prev_cursor, next_cursor)
+    """
+    return await _fetch_page(
+        "SELECT * FROM promocodes", key="id", limit=limit, after=after, before=before, row_factory=None
+    )
+
 async def get_server_count_by_address(address, inbound_id=None, protocol=None):
     """
     Получает текущее количество клиентов на сервере по адресу и inbound_id
@@ -2097,15 +2748,15 @@ async def get_server_count_by_address(address, inbound_id=None, protocol=None):
     int: Количество клиентов на указанном инбаунде сервера
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             db.row_factory = aiosqlite.Row
             query = """
             SELECT i.clients_count
             FROM servers s
-            LEFT JOIN inbounds i ON TRIM(LOWER(s.address)) = TRIM(LOWER(?))
-            WHERE TRIM(LOWER(s.address)) = TRIM(LOWER(?))
+            JOIN inbounds i ON i.server_id = s.id
+            WHERE s.host = ?
             """
-            params = [address, address]
+            params = [normalize_server_host(address)]
 
             if inbound_id is not None:
                 query += " AND i.inbound_id = ?"
@@ -2129,25 +2780,8 @@ async def get_all_servers():
     """
     Получает список всех серверов с информацией об их инбаундах
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         db.row_factory = aiosqlite.Row
-        
-        logger.info("Checking servers table...")
-        cursor = await db.execute("SELECT * FROM servers")
-        cursor = await db.execute("""
-            SELECT 
-                id,
-                server_id,
-                server_address,
-                inbound_id,
-                protocol,
-                clients_count,
-                max_clients,
-                pbk,
-                sid,
-                sni
-            FROM inbounds
-        """)
         cursor = await db.execute("""
             SELECT 
                 s.id,
@@ -2164,19 +2798,51 @@ async def get_all_servers():
                 i.sid,
                 i.sni
             FROM servers s
-            LEFT JOIN inbounds i ON TRIM(LOWER(s.address)) = TRIM(LOWER(i.server_address))
+            LEFT JOIN inbounds i ON i.server_id = s.id
             ORDER BY s.id ASC, i.protocol ASC
         """)
         result = await cursor.fetchall()
 
         return result
 
+async def get_servers_page(limit: int, after: int = None, before: int = None):
+    """
+    Получает страницу серверов вместе с их инбаундами одним запросом.
+
+    Args:
+        limit (int): Количество серверов на странице
+        after (int): Курсор следующей страницы (id последнего показанного сервера)
+        before (int): Курсор предыдущей страницы (id первого показанного сервера)
+
+    Returns:
+        tuple: (список словарей серверов с ключом 'inbounds', prev_cursor, next_cursor)
+    """
+    servers, prev_cursor, next_cursor = await _fetch_page("""
+        SELECT
+            s.id, s.address, s.country, s.is_active,
+            (
+                SELECT json_group_array(json_object(
+                    'protocol', i.protocol,
+                    'clients_count', i.clients_count,
+                    'max_clients', i.max_clients,
+                    'inbound_id', i.inbound_id
+                ))
+                FROM (
+                    SELECT * FROM inbounds WHERE server_id = s.id ORDER BY protocol
+                ) i
+            ) AS inbounds
+        FROM servers s
+    """, key="id", limit=limit, after=after, before=before)
+    for server in servers:
+        server['inbounds'] = json.loads(server['inbounds'])
+    return servers, prev_cursor, next_cursor
+
 async def get_server_by_id(server_id: int):
     """
     Получает информацию о сервере по ID
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with db_pool.reader() as db:
+        db.row_factory = Server.row_factory
         cursor = await db.execute(
             "SELECT * FROM servers WHERE id = ?", 
             (server_id,)
@@ -2187,22 +2853,38 @@ async def delete_server(server_id: int):
     """
     Удаляет сервер из базы данных
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
+        # Инбаунды остаются без сервера (внешний ключ не дает удалить сервер со ссылками)
+        # и привязываются заново, если сервер с тем же адресом будет добавлен
         await db.execute(
-            "DELETE FROM servers WHERE id = ?", 
+            "UPDATE inbounds SET server_id = NULL WHERE server_id = ?",
             (server_id,)
         )
+        cursor = await db.execute(
+            "DELETE FROM servers WHERE id = ? RETURNING address", 
+            (server_id,)
+        )
+        addresses = [row[0] for row in await cursor.fetchall()]
         await db.commit()
+    for address in addresses:
+        panel_sessions.forget(address)
 
 async def add_server(address, username, password, max_clients=100):
     """
     Добавляет новый сервер в базу данных
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
+        cursor = await db.execute("""
+            INSERT INTO servers (address, username, password, max_clients, host) 
+            VALUES (?, ?, ?, ?, ?)
+        """, (address, username, password, max_clients, normalize_server_host(address)))
+        # Инбаунды, оставшиеся от удаленного сервера с тем же адресом, привязываем к новому
         await db.execute("""
-            INSERT INTO servers (address, username, password, max_clients) 
-            VALUES (?, ?, ?, ?)
-        """, (address, username, password, max_clients))
+            UPDATE inbounds 
+            SET server_id = ?
+            WHERE server_address = ?
+            AND (server_id IS NULL OR server_id NOT IN (SELECT id FROM servers))
+        """, (cursor.lastrowid, address))
         await db.commit()
 
 
@@ -2218,12 +2900,12 @@ async def get_server_by_address(address: str, protocol: str = None):
     Returns:
         dict: Словарь с данными сервера или None если сервер не найден
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader(attached=True) as db:
         db.row_factory = aiosqlite.Row
         clean_address = address.split(':')[0]
         
         # Сначала пытаемся найти серверы с указанным адресом
-        query = """
+        query = f"""
             SELECT 
                 s.address,
                 s.username,
@@ -2239,11 +2921,12 @@ async def get_server_by_address(address: str, protocol: str = None):
                 i.utls,
                 i.inbound_id
             FROM servers s
-            INNER JOIN inbounds i ON TRIM(LOWER(s.address)) = TRIM(LOWER(i.server_address))
-            WHERE TRIM(LOWER(s.address)) LIKE TRIM(LOWER(?)) || '%'
+            INNER JOIN inbounds i ON i.server_id = s.id
+            WHERE s.host = ?
             AND s.is_active = 1
+            AND {_SERVER_ALIVE_SQL}
         """
-        params = [clean_address]
+        params = [normalize_server_host(clean_address), _health_cutoff()]
         
         if protocol:
             query += " AND i.protocol = ?"
@@ -2252,31 +2935,33 @@ async def get_server_by_address(address: str, protocol: str = None):
         cursor = await db.execute(query, params)
         matching_servers = await cursor.fetchall()
         
-        # Проверяем доступность найденных серверов
-        for row in matching_servers:
-            server_address = row['address'].split(':')[0]
-            if await ping_server(server_address, 2053):
-                logger.info(f"Найден доступный сервер: {server_address}:{row['port']}")
-                return {
-                    'address': row['address'],
-                    'username': row['username'],
-                    'password': row['server_password'],
-                    'country': row['country'],
-                    'clients_count': row['clients_count'],
-                    'max_clients': row['max_clients'],
-                    'pbk': row['pbk'],
-                    'sid': row['sid'],
-                    'sni': row['sni'],
-                    'protocol': row['protocol'],
-                    'port': row['port'],
-                    'utls': row['utls'],
-                    'inbound_id': row['inbound_id']
-                }
-        
-        # Если указанные серверы недоступны, ищем любой другой доступный сервер
-        logger.warning(f"Сервер {address} недоступен, ищем альтернативный сервер")
-        
-        query = """
+    # Недоступные по данным монитора серверы отфильтрованы запросом
+    if matching_servers:
+        row = matching_servers[0]
+        server_address = row['address'].split(':')[0]
+        logger.info(f"Найден доступный сервер: {server_address}:{row['port']}")
+        return {
+            'address': row['address'],
+            'username': row['username'],
+            'password': row['server_password'],
+            'country': row['country'],
+            'clients_count': row['clients_count'],
+            'max_clients': row['max_clients'],
+            'pbk': row['pbk'],
+            'sid': row['sid'],
+            'sni': row['sni'],
+            'protocol': row['protocol'],
+            'port': row['port'],
+            'utls': row['utls'],
+            'inbound_id': row['inbound_id']
+        }
+    
+    # Если указанные серверы недоступны, ищем любой другой доступный сервер
+    logger.warning(f"Сервер {address} недоступен, ищем альтернативный сервер")
+    
+    async with db_pool.reader(attached=True) as db:
+        db.row_factory = aiosqlite.Row
+        query = f"""
             SELECT 
                 s.address,
                 s.username,
@@ -2293,11 +2978,12 @@ async def get_server_by_address(address: str, protocol: str = None):
                 i.inbound_id,
                 CAST(i.clients_count AS FLOAT) / NULLIF(i.max_clients, 0) as load_ratio
             FROM servers s
-            INNER JOIN inbounds i ON TRIM(LOWER(s.address)) = TRIM(LOWER(i.server_address))
+            INNER JOIN inbounds i ON i.server_id = s.id
             WHERE s.is_active = 1 
-            AND i.clients_count < i.max_clients
+            AND i.clients_count + {_ACTIVE_RESERVATIONS_SQL} < i.max_clients
+            AND {_SERVER_ALIVE_SQL}
         """
-        params = []
+        params = [int(datetime.now().timestamp() * 1000), _health_cutoff()]
         
         if protocol:
             query += " AND i.protocol = ?"
@@ -2314,39 +3000,37 @@ async def get_server_by_address(address: str, protocol: str = None):
         cursor = await db.execute(query, params)
         alternative_servers = await cursor.fetchall()
         
-        # Проверяем доступность альтернативных серверов
-        for row in alternative_servers:
-            server_address = row['address'].split(':')[0]
-            # Пропускаем изначально запрошенный адрес
-            if server_address.lower() == clean_address.lower():
-                continue
-                
-            if await ping_server(server_address, 2053):
-                logger.info(f"Найден альтернативный доступный сервер: {server_address}:{row['port']}")
-                return {
-                    'address': row['address'],
-                    'username': row['username'],
-                    'password': row['server_password'],
-                    'country': row['country'],
-                    'clients_count': row['clients_count'],
-                    'max_clients': row['max_clients'],
-                    'pbk': row['pbk'],
-                    'sid': row['sid'],
-                    'sni': row['sni'],
-                    'protocol': row['protocol'],
-                    'port': row['port'],
-                    'utls': row['utls'],
-                    'inbound_id': row['inbound_id']
-                }
-        
-        logger.error(f"Не найдено доступных серверов для протокола: {protocol}")
-        return None
+    for row in alternative_servers:
+        server_address = row['address'].split(':')[0]
+        # Пропускаем изначально запрошенный адрес
+        if server_address.lower() == clean_address.lower():
+            continue
+            
+        logger.info(f"Найден альтернативный доступный сервер: {server_address}:{row['port']}")
+        return {
+            'address': row['address'],
+            'username': row['username'],
+            'password': row['server_password'],
+            'country': row['country'],
+            'clients_count': row['clients_count'],
+            'max_clients': row['max_clients'],
+            'pbk': row['pbk'],
+            'sid': row['sid'],
+            'sni': row['sni'],
+            'protocol': row['protocol'],
+            'port': row['port'],
+            'utls': row['utls'],
+            'inbound_id': row['inbound_id']
+        }
+    
+    logger.error(f"Не найдено доступных серверов для протокола: {protocol}")
+    return None
 
 async def get_available_server():
     """
     Получает доступный сервер с наименьшим количеством клиентов
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("""
             SELECT address, username, password, clients_count, max_clients, pbk, sid, protocol, country, inbound_id
             FROM servers 
@@ -2357,7 +3041,7 @@ async def get_available_server():
         return await cursor.fetchone()
 
 async def update_server_max_clients(server_id, max_clients):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("UPDATE servers SET max_clients = ? WHERE id = ?", (max_clients, server_id))
         await db.commit()
 
@@ -2371,7 +3055,7 @@ async def update_server_info(address, protocol=None, country=None, inbound_id=No
         country (str, optional): Страна сервера
         inbound_id (int, optional): ID сервера для inbound
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         update_parts = []
         params = []
         
@@ -2395,9 +3079,10 @@ async def update_server_info(address, protocol=None, country=None, inbound_id=No
 
 
 async def update_free_keys_count(user_id, count):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("UPDATE users SET free_keys_count = ? WHERE user_id = ?", (count, user_id))
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def update_server_clients_count(address, count, inbound_id):
     """
@@ -2413,7 +3098,7 @@ async def update_server_clients_count(address, count, inbound_id):
     """
     try:
         # Нормализуем адрес сервера
-        server_ip = address.split(':')[0].strip().lower()
+        server_ip = normalize_server_host(address)
         
         # Проверяем входные данные
         if not server_ip or not isinstance(inbound_id, int):
@@ -2427,78 +3112,125 @@ async def update_server_clients_count(address, count, inbound_id):
             logger.error(f"Некорректное значение count={count} для сервера {server_ip}")
             return False
             
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Используем транзакцию с блокировкой
-            async with db.execute('BEGIN EXCLUSIVE TRANSACTION'):
-                # Проверяем существование записи с точным соответствием
-                cursor = await db.execute("""
-                    SELECT clients_count FROM inbounds 
-                    WHERE TRIM(LOWER(server_address)) = TRIM(LOWER(?))
-                    AND inbound_id = ?
-                """, (server_ip, inbound_id))
-                
-                current_count = await cursor.fetchone()
-                
-                if current_count is None:
-                    logger.error(f"Инбаунд не найден для сервера {server_ip} с ID {inbound_id}")
-                    return False
-                
-                # Проверка на отрицательные значения
-                if count < 0:
-                    logger.warning(f"Попытка установить отрицательное значение {count} для сервера {server_ip}. Устанавливаем 0.")
-                    count = 0
-                
-                # Логируем изменение, особенно если счетчик обнуляется
-                if current_count[0] > 0 and count == 0:
-                    logger.warning(
-                        f"Внимание: счетчик клиентов для сервера {server_ip}, инбаунд {inbound_id} "
-                        f"изменяется с {current_count[0]} на 0. Запускаем дополнительную проверку."
-                    )
-                    # Здесь можно добавить дополнительную проверку или запустить синхронизацию
-                
-                # Выполняем обновление с точным соответствием адреса
-                await db.execute("""
-                    UPDATE inbounds 
-                    SET clients_count = ?
-                    WHERE TRIM(LOWER(server_address)) = TRIM(LOWER(?))
-                    AND inbound_id = ?
-                """, (count, server_ip, inbound_id))
-                
-                # Проверяем результат обновления
-                cursor = await db.execute("""
-                    SELECT clients_count FROM inbounds 
-                    WHERE TRIM(LOWER(server_address)) = TRIM(LOWER(?))
-                    AND inbound_id = ?
-                """, (server_ip, inbound_id))
-                
-                new_count = await cursor.fetchone()
+        async with db_pool.writer() as db:
+            # Проверяем существование записи с точным соответствием
+            cursor = await db.execute("""
+                SELECT clients_count FROM inbounds 
+                WHERE server_id IN (SELECT id FROM servers WHERE host = ?)
+                AND inbound_id = ?
+            """, (server_ip, inbound_id))
+            
+            current_count = await cursor.fetchone()
+            
+            if current_count is None:
+                logger.error(f"Инбаунд не найден для сервера {server_ip} с ID {inbound_id}")
+                return False
+            
+            # Проверка на отрицательные значения
+            if count < 0:
+                logger.warning(f"Попытка установить отрицательное значение {count} для сервера {server_ip}. Устанавливаем 0.")
+                count = 0
+            
+            # Логируем изменение, особенно если счетчик обнуляется
+            if current_count[0] > 0 and count == 0:
+                logger.warning(
+                    f"Внимание: счетчик клиентов для сервера {server_ip}, инбаунд {inbound_id} "
+                    f"изменяется с {current_count[0]} на 0. Запускаем дополнительную проверку."
+                )
+                # Здесь можно добавить дополнительную проверку или запустить синхронизацию
+            
+            # Выполняем обновление с точным соответствием адреса
+            await db.execute("""
+                UPDATE inbounds 
+                SET clients_count = ?
+                WHERE server_id IN (SELECT id FROM servers WHERE host = ?)
+                AND inbound_id = ?
+            """, (count, server_ip, inbound_id))
+            
+            # Проверяем результат обновления
+            cursor = await db.execute("""
+                SELECT clients_count FROM inbounds 
+                WHERE server_id IN (SELECT id FROM servers WHERE host = ?)
+                AND inbound_id = ?
+            """, (server_ip, inbound_id))
+            
+            new_count = await cursor.fetchone()
+            
+            if new_count and new_count[0] == count:
+                await db.commit()
+                logger.info(f"Успешно обновлен счетчик клиентов на {count} для сервера {server_ip}, инбаунд {inbound_id}")
+                return True
+            else:
+                await db.rollback()
+                logger.error(f"Не удалось обновить счетчик клиентов для сервера {server_ip}, инбаунд {inbound_id}")
+                return False
                 
-                if new_count and new_count[0] == count:
-                    await db.commit()
-                    logger.info(f"Успешно обновлен счетчик клиентов на {count} для сервера {server_ip}, инбаунд {inbound_id}")
-                    return True
-                else:
-                    await db.rollback()
-                    logger.error(f"Не удалось обновить счетчик клиентов для сервера {server_ip}, инбаунд {inbound_id}")
-                    return False
-                    
     except Exception as e:
         logger.error(f"Ошибка при обновлении счетчика клиентов для {address}: {e}", exc_info=True)
         return False
 
 async def remove_active_key(key, db = None):
     if db is None:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("DELETE FROM keys WHERE key = ?", (key,))
+        async with db_pool.writer() as db:
+            cursor = await db.execute("DELETE FROM keys WHERE key = ? RETURNING user_id", (key,))
+            user_ids = [row[0] for row in await cursor.fetchall()]
             await db.commit()
     else:
-        await db.execute("DELETE FROM keys WHERE key = ?", (key,))
+        cursor = await db.execute("DELETE FROM keys WHERE key = ? RETURNING user_id", (key,))
+        user_ids = [row[0] for row in await cursor.fetchall()]
         await db.commit()
+    # keys_count пользователя меняет триггер
+    user_cache.invalidate_many(user_ids)
+    _forget_key_reminders([key])
+
+async def confirm_slot_reservation(db: aiosqlite.Connection, reservation_id: int) -> int | None:
+    """
+    Подтверждает резерв места, сделанный get_api_instance: резерв удаляется, а ключ
+    учитывается в clients_count инбаунда триггером на вставку в keys.
+    Вызывается внутри транзакции add_active_key до вставки ключа.
+    
+    Args:
+        db (aiosqlite.Connection): Соединение на запись
+        reservation_id (int): ID резерва, который вернул get_api_instance
+    
+    Returns:
+        int | None: inbounds.id резерва или None, если резерва уже нет
+    """
+    if reservation_id is None:
+        return None
+
+    # Резерв удаляется, даже если он уже истек: ключ все равно был создан на панели
+    cursor = await db.execute(
+        "DELETE FROM slot_reservations WHERE id = ? RETURNING inbound_row_id", (reservation_id,)
+    )
+    row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def purge_expired_reservations():
+    """
+    Удаляет истекшие резервы мест. На подсчет свободных мест они уже не влияют,
+    поэтому очистка нужна только чтобы таблица не росла.
+    """
+    try:
+        current_time = int(datetime.now().timestamp() * 1000)
+        async with db_pool.writer() as db:
+            cursor = await db.execute(
+                "DELETE FROM slot_reservations WHERE expires_at <= ?",
+                (current_time,)
+            )
+            await db.commit()
+            if cursor.rowcount:
+                logger.info(f"Удалено истекших резервов мест: {cursor.rowcount}")
+    except Exception as e:
+        logger.error(f"Ошибка при удалении истекших резервов мест: {e}")
 
-async def add_active_key(user_id, key, device_id, expiration_date, name, price: int, days: int):
+async def add_active_key(user_id, key, device_id, expiration_date, name, price: int, days: int, reservation_id: int = None):
+    """
+    Сохраняет выданный ключ и подтверждает резерв места reservation_id (из get_api_instance).
+    """
     try:
         logger.info(f"Adding key to database with params: user_id={user_id}, device_id={device_id}, expiration_date={expiration_date}")
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             # Проверка наличия ключа в базе данных
             cursor = await db.execute(
                 "SELECT * FROM keys WHERE key = ? AND user_id = ? AND device_id = ? AND name = ?",
@@ -2509,25 +3241,49 @@ async def add_active_key(user_id, key, device_id, expiration_date, name, price:
                 logger.warning(f"Key already exists in the database for user {user_id}, device {device_id}")
                 return
 
-            # Добавление нового ключа
+            # Инбаунд ключа берется из резерва; если резерва нет (истек и удален),
+            # ключ относится к первому инбаунду своего сервера с тем же протоколом
+            fields = parse_key_fields(key)
+            inbound_row_id = await confirm_slot_reservation(db, reservation_id)
+            if inbound_row_id is None:
+                cursor = await db.execute("""
+                    SELECT i.id FROM inbounds i
+                    JOIN servers s ON s.id = i.server_id
+                    WHERE s.host = ? AND i.protocol = ?
+                    ORDER BY i.id
+                    LIMIT 1
+                """, (fields["server_ip"], fields["protocol"]))
+                row = await cursor.fetchone()
+                inbound_row_id = row[0] if row else None
+
+            # Добавление нового ключа вместе с разобранными полями,
+            # чтобы поиск по серверу и идентификаторам шел по индексам, а не по LIKE.
+            # clients_count инбаунда увеличивает триггер
             await db.execute(
-                "INSERT INTO keys (key, user_id, device_id, expiration_date, name, price, days) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (key, user_id, device_id, expiration_date, name, price, days)
+                """
+                INSERT INTO keys (
+                    key, user_id, device_id, expiration_date, name, price, days,
+                    protocol, server_ip, port, client_uuid, panel_email, unique_id, device_type,
+                    inbound_row_id
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    key, user_id, device_id, expiration_date, name, price, days,
+                    fields["protocol"], fields["server_ip"], fields["port"], fields["client_uuid"],
+                    fields["panel_email"], fields["unique_id"], fields["device_type"],
+                    inbound_row_id
+                )
             )
             
-            # Сначала удаляем запись из key_usage_reminders, если она существует
-            await db.execute(
-                "DELETE FROM key_usage_reminders WHERE key = ?",
-                (key,)
-            )
+            await db.commit()
+            user_cache.invalidate(user_id)
             
-            # Добавляем запись для отслеживания использования ключа
-            await db.execute(
-                "INSERT INTO key_usage_reminders (key, last_traffic) VALUES (?, ?)",
+            # Запись для отслеживания использования ключа (старая запись, если она была, заменяется);
+            # внутри единицы работы — только после ее commit
+            db_pool.after_commit(lambda: aux_batch_writer.enqueue(
+                "INSERT OR REPLACE INTO key_usage_reminders (key, last_traffic) VALUES (?, ?)",
                 (key, 0)
-            )
-            
-            await db.commit()
+            ))
             logger.info(f"Successfully added key to database for user {user_id}")
     except Exception as e:
         logger.error(f"Error adding key to database: {e}", exc_info=True)
@@ -2537,15 +3293,10 @@ async def get_next_expiration_date(user_id: int | str, include_time: bool = Fals
     """
     Получает следующую дату экспирации для пользователя.
     """
-    query = """
-        SELECT MIN(expiration_date)
-        FROM keys
-        WHERE user_id = ? AND expiration_date > ?
-        """
     current_time = int(datetime.now().timestamp() * 1000)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(query, (user_id, current_time)) as cursor:
+    async with db_pool.reader() as db:
+        async with db.execute(NEXT_EXPIRATION_SQL, (user_id, current_time)) as cursor:
             row = await cursor.fetchone()
             if row and row[0] is not None:
                 exp_date = unix_to_str(row[0], include_time=include_time)
@@ -2563,29 +3314,31 @@ async def update_key_days_price(key_str: str, days: int | str, price: int | str)
         days (int | str): дни, на сколько ключ действителен
         price (int | str): цена, за которую пользователь продлевает ключ
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE keys SET days = ?, price = ? WHERE key = ?
         """, (days, price, key_str))
         await db.commit()
 
-async def get_users_without_payment_methods():
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        await db.execute("PRAGMA foreign_keys = ON")
-        sql = """
+async def iter_users_without_payment_methods(chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[User]:
+    """
+    Потоково отдает пользователей без сохраненных методов оплаты, порциями по chunk_size.
+    """
+    sql = """
         SELECT u.*
         FROM   users AS u
         LEFT JOIN user_payment_methods AS upm
                ON upm.user_id = u.user_id
-        WHERE  upm.user_id IS NULL;
-        """
-        async with db.execute(sql) as cursor:
-            rows = await cursor.fetchall()
-    return rows
+        WHERE  upm.user_id IS NULL
+    """
+    async for user in _iter_rows(sql, key="user_id", row_factory=User.row_factory, chunk_size=chunk_size):
+        yield user
+
+async def get_users_without_payment_methods():
+    return [user async for user in iter_users_without_payment_methods()]
 
 async def delete_all_payment_methods():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("DELETE FROM user_payment_methods")
         await db.commit()
 
@@ -2599,7 +3352,7 @@ async def update_key_expriration_date(key, new_end_date):
         user_id (int): ID пользователя
         new_end_date (str): Новая дата окончания подписки
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE keys SET expiration_date = ? WHERE key = ?
         """, (new_end_date, key))
@@ -2631,13 +3384,7 @@ async def get_key_traffic(key):
             return 0
             
         # Подключаемся к API сервера
-        api = AsyncApi(
-            f"http://{server['address']}",
-            server['username'],
-            server['password'],
-            use_tls_verify=False
-        )
-        await api.login()
+        api = await panel_sessions.get(server['address'], server['username'], server['password'])
         
         email = f"{parts[0]}_{parts[1]}_{parts[2]}"
         
@@ -2655,6 +3402,67 @@ async def get_key_traffic(key):
         logger.error(f"Ошибка при получении трафика для ключа {key}: {e}")
         return 0
 
+async def _fetch_server_traffic(server) -> list[tuple]:
+    """
+    Получает трафик всех клиентов сервера одним запросом списка инбаундов.
+
+    Returns:
+        list[tuple]: Строки (server_host, panel_email, inbound_id, up, down) для key_traffic
+    """
+    api = panel_sessions.session(server['address'], server['username'], server['password'])
+    inbounds = await api.inbound.get_list()
+    return [
+        (server['host'], client.email, inbound.id, client.up, client.down)
+        for inbound in inbounds
+        for client in inbound.client_stats or []
+    ]
+
+async def collect_inbound_traffic() -> int:
+    """
+    Собирает трафик клиентов со всех активных серверов (серверы опрашиваются
+    параллельно) и сохраняет его в таблицу key_traffic.
+
+    Строки сервера, который не ответил, не обновляются: их updated_at остается
+    старым, и функции, которым нужны свежие данные, их не учитывают.
+
+    Returns:
+        int: Время сбора (мс Unix-эпохи); строки с updated_at >= этого значения получены в этом сборе
+    """
+    async with db_pool.reader() as db:
+        db.row_factory = Server.row_factory
+        async with db.execute(
+            "SELECT address, username, password, host FROM servers WHERE is_active = 1"
+        ) as cursor:
+            servers = await cursor.fetchall()
+
+    collected_at = int(time.time() * 1000)
+    results = await asyncio.gather(
+        *(_fetch_server_traffic(server) for server in servers), return_exceptions=True
+    )
+
+    async with aux_pool.transaction() as db:
+        for server, rows in zip(servers, results):
+            if isinstance(rows, BaseException):
+                logger.error(f"Не удалось получить трафик клиентов сервера {server.address}: {rows}")
+                continue
+            await db.executemany("""
+                INSERT INTO key_traffic (server_host, panel_email, inbound_id, up, down, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(server_host, panel_email) DO UPDATE SET
+                    inbound_id = excluded.inbound_id,
+                    up = excluded.up,
+                    down = excluded.down,
+                    updated_at = excluded.updated_at
+            """, [(*row, collected_at) for row in rows])
+            # Клиенты, которых больше нет на панели
+            await db.execute(
+                "DELETE FROM key_traffic WHERE server_host = ? AND updated_at < ?",
+                (server.host, collected_at)
+            )
+            logger.info(f"Трафик клиентов сервера {server.address}: {len(rows)} записей")
+
+    return collected_at
+
 async def update_key_traffic(key, traffic):
     """
     Обновляет информацию о последнем известном трафике для ключа
@@ -2664,13 +3472,11 @@ async def update_key_traffic(key, traffic):
         traffic (int): Объем трафика в байтах
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE key_usage_reminders SET last_traffic = ? WHERE key = ?",
-                (traffic, key)
-            )
-            await db.commit()
-            logger.debug(f"Обновлен трафик для ключа {key}: {traffic} байт")
+        aux_batch_writer.enqueue(
+            "UPDATE key_usage_reminders SET last_traffic = ? WHERE key = ?",
+            (traffic, key)
+        )
+        logger.debug(f"Обновлен трафик для ключа {key}: {traffic} байт")
     except Exception as e:
         logger.error(f"Ошибка при обновлении трафика для ключа {key}: {e}")
 
@@ -2682,84 +3488,101 @@ async def check_unused_keys():
         logger.info("Начало проверки неиспользуемых ключей...")
         current_time = datetime.now()
         
-        async with aiosqlite.connect(DB_PATH) as db:
+        # Трафик всех ключей собирается одним запросом к каждой панели
+        collected_at = await collect_inbound_traffic()
+        
+        async with db_pool.reader(attached=True) as db:
             db.row_factory = aiosqlite.Row
             
-            # Получаем все активные ключи с информацией о напоминаниях
+            # Получаем все активные ключи с информацией о напоминаниях и трафике из этого сбора
             query = """
                 SELECT 
                     k.key, k.user_id, k.device_id, k.expiration_date,
                     r.last_traffic, r.first_reminder_sent, r.second_reminder_sent, r.third_reminder_sent,
-                    r.created_at
+                    r.created_at,
+                    t.up + t.down AS current_traffic
                 FROM keys k
                 LEFT JOIN key_usage_reminders r ON k.key = r.key
+                LEFT JOIN key_traffic t
+                    ON t.server_host = k.server_ip AND t.panel_email = k.panel_email AND t.updated_at >= ?
                 WHERE k.expiration_date > ?
             """
             
             current_timestamp = int(current_time.timestamp() * 1000)
-            cursor = await db.execute(query, (current_timestamp,))
+            cursor = await db.execute(query, (collected_at, current_timestamp))
             keys = await cursor.fetchall()
+        
+        # Отправка сообщений выполняется без удержания соединения с БД
+        for key_data in keys:
+            key = key_data['key']
+            user_id = key_data['user_id']
+            last_traffic = key_data['last_traffic'] or 0
+            first_reminder = key_data['first_reminder_sent'] == 1
+            second_reminder = key_data['second_reminder_sent'] == 1
+            third_reminder = key_data['third_reminder_sent'] == 1
+            updates = []
             
-            for key_data in keys:
-                key = key_data['key']
-                user_id = key_data['user_id']
-                last_traffic = key_data['last_traffic'] or 0
-                first_reminder = key_data['first_reminder_sent'] == 1
-                second_reminder = key_data['second_reminder_sent'] == 1
-                third_reminder = key_data['third_reminder_sent'] == 1
-                
-                # Если запись о напоминаниях отсутствует, создаем её
-                if key_data['created_at'] is None:
-                    await db.execute(
-                        "INSERT OR IGNORE INTO key_usage_reminders (key, last_traffic) VALUES (?, ?)",
-                        (key, 0)
-                    )
-                    created_at = current_time
-                else:
-                    created_at = datetime.fromisoformat(key_data['created_at'].replace('Z', '+00:00'))
+            # Если запись о напоминаниях отсутствует, создаем её
+            if key_data['created_at'] is None:
+                updates.append((
+                    "INSERT OR IGNORE INTO key_usage_reminders (key, last_traffic) VALUES (?, ?)",
+                    (key, 0)
+                ))
+                created_at = current_time
+            else:
+                created_at = datetime.fromisoformat(key_data['created_at'].replace('Z', '+00:00'))
+            
+            # Трафик неизвестен (сервер не ответил или клиента нет на панели): ключ пропускаем,
+            # чтобы не отправить напоминание по неполным данным
+            current_traffic = key_data['current_traffic']
+            if current_traffic is None:
+                for sql, params in updates:
+                    aux_batch_writer.enqueue(sql, params)
+                continue
+            
+            # Если трафик не изменился, проверяем необходимость отправки напоминаний
+            if current_traffic <= last_traffic:
+                days_since_creation = (current_time - created_at).days
                 
-                # Получаем текущий трафик
-                current_traffic = await get_key_traffic(key)
+                # Первое напоминание через 1 день
+                if not first_reminder and days_since_creation >= 1:
+                    await send_key_reminder(user_id, key, 1)
+                    updates.append((
+                        "UPDATE key_usage_reminders SET first_reminder_sent = 1 WHERE key = ?",
+                        (key,)
+                    ))
+                    logger.info(f"Отправлено первое напоминание для ключа {key} пользователю {user_id}")
                 
-                # Если трафик не изменился, проверяем необходимость отправки напоминаний
-                if current_traffic <= last_traffic:
-                    days_since_creation = (current_time - created_at).days
-                    
-                    # Первое напоминание через 1 день
-                    if not first_reminder and days_since_creation >= 1:
-                        await send_key_reminder(user_id, key, 1)
-                        await db.execute(
-                            "UPDATE key_usage_reminders SET first_reminder_sent = 1 WHERE key = ?",
-                            (key,)
-                        )
-                        logger.info(f"Отправлено первое напоминание для ключа {key} пользователю {user_id}")
-                    
-                    # Второе напоминание через 5 дней
-                    elif first_reminder and not second_reminder and days_since_creation >= 5:
-                        await send_key_reminder(user_id, key, 2)
-                        await db.execute(
-                            "UPDATE key_usage_reminders SET second_reminder_sent = 1 WHERE key = ?",
-                            (key,)
-                        )
-                        logger.info(f"Отправлено второе напоминание для ключа {key} пользователю {user_id}")
-                    
-                    # Третье напоминание через 15 дней
-                    elif second_reminder and not third_reminder and days_since_creation >= 15:
-                        await send_key_reminder(user_id, key, 3)
-                        await db.execute(
-                            "UPDATE key_usage_reminders SET third_reminder_sent = 1 WHERE key = ?",
-                            (key,)
-                        )
-                        logger.info(f"Отправлено третье напоминание для ключа {key} пользователю {user_id}")
+                # Второе напоминание через 5 дней
+                elif first_reminder and not second_reminder and days_since_creation >= 5:
+                    await send_key_reminder(user_id, key, 2)
+                    updates.append((
+                        "UPDATE key_usage_reminders SET second_reminder_sent = 1 WHERE key = ?",
+                        (key,)
+                    ))
+                    logger.info(f"Отправлено второе напоминание для ключа {key} пользователю {user_id}")
                 
-                # Обновляем информацию о трафике
-                await db.execute(
-                    "UPDATE key_usage_reminders SET last_traffic = ? WHERE key = ?",
-                    (current_traffic, key)
-                )
+                # Третье напоминание через 15 дней
+                elif second_reminder and not third_reminder and days_since_creation >= 15:
+                    await send_key_reminder(user_id, key, 3)
+                    updates.append((
+                        "UPDATE key_usage_reminders SET third_reminder_sent = 1 WHERE key = ?",
+                        (key,)
+                    ))
+                    logger.info(f"Отправлено третье напоминание для ключа {key} пользователю {user_id}")
             
-            await db.commit()
-            logger.info("Проверка неиспользуемых ключей завершена")
+            # Обновляем информацию о трафике
+            updates.append((
+                "UPDATE key_usage_reminders SET last_traffic = ? WHERE key = ?",
+                (current_traffic, key)
+            ))
+            
+            # Записи по всем ключам фиксируются пачками, а не отдельным commit на каждый ключ
+            for sql, params in updates:
+                aux_batch_writer.enqueue(sql, params)
+        
+        await aux_batch_writer.flush()
+        logger.info("Проверка неиспользуемых ключей завершена")
             
     except Exception as e:
         logger.error(f"Ошибка при проверке неиспользуемых ключей: {e}")
@@ -2822,7 +3645,7 @@ async def update_key_expiry_date(key: str, new_expiry_time: int):
         new_expiry_time (int): Новое время истечения в миллисекундах
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute(
                 "UPDATE keys SET expiration_date = ? WHERE key = ?",
                 (new_expiry_time, key)
@@ -2834,40 +3657,39 @@ async def update_key_expiry_date(key: str, new_expiry_time: int):
         raise
 
 async def get_key_expiry_date(key):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT expiration_date FROM keys WHERE key = ?", (key,))
         result = await cursor.fetchone()
         return result[0] if result else None
 
 async def update_user_ban_status(user_id: int, is_banned: bool):
     """Обновляет статус бана пользователя"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute(
             "UPDATE users SET is_banned = ? WHERE user_id = ?",
             (is_banned, user_id)
         )
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def get_user_by_username(username: str):
     """Получает пользователя по username"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
+        db.row_factory = User.row_factory
         async with db.execute(
             "SELECT * FROM users WHERE username = ?",
             (username,)
         ) as cursor:
-            user = await cursor.fetchone()
-            if user:
-                return dict(zip([col[0] for col in cursor.description], user))
-            return None
+            return await cursor.fetchone()
 
 async def get_key_price(key):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT price FROM keys WHERE key = ?", (key,))
         result = await cursor.fetchone()
         return result[0] if result else None
     
 async def get_key_days(key):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT days FROM keys WHERE key = ?", (key,))
         result = await cursor.fetchone()
         return result[0] if result else None
@@ -2882,10 +3704,10 @@ async def get_user_info(key=None, username=None, user_id=None):
         user_id (int): ID пользователя.
 
     Returns:
-        dict: Словарь с информацией о пользователе или None, если пользователь не найден.
+        User: Пользователь или None, если пользователь не найден.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row  # Устанавливаем row_factory для получения словаря
+    async with db_pool.reader() as db:
+        db.row_factory = User.row_factory
 
         if key:
             cursor = await db.execute("SELECT * FROM users WHERE user_id = (SELECT user_id FROM keys WHERE key = ?)", (key,))
@@ -2896,11 +3718,7 @@ async def get_user_info(key=None, username=None, user_id=None):
         else:
             return None
 
-        row = await cursor.fetchone()
-
-        if row:
-            return dict(row)
-        return None
+        return await cursor.fetchone()
         
 
 async def update_key_name(key: str, new_name: str) -> bool:
@@ -2909,84 +3727,185 @@ async def update_key_name(key: str, new_name: str) -> bool:
     Возвращает True при успехе, False при ошибке
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE keys SET name = ? WHERE key = ?",
-                (new_name, key)
-            )
-            await db.commit()
+        await batch_writer.execute(
+            "UPDATE keys SET name = ? WHERE key = ?",
+            (new_name, key)
+        )
         return True
     except Exception as e:
         logger.error(f"Ошибка при обновлении имени ключа: {e}")
         return False
     
+async def get_user_keys_page(user_id, device_ids, limit: int, after: int = None, before: int = None):
+    """
+    Получает страницу ключей пользователя для устройства в порядке добавления.
+
+    Курсор — rowid ключа: он короткий и помещается в callback_data, в отличие от самого ключа.
+
+    Args:
+        user_id: ID пользователя
+        device_ids: Допустимые значения device_id (без учета регистра)
+        limit (int): Количество ключей на странице
+        after (int): Курсор следующей страницы
+        before (int): Курсор предыдущей страницы
+
+    Returns:
+        tuple: (список Key, prev_cursor, next_cursor)
+    """
+    device_ids = [device_id.lower() for device_id in device_ids]
+    placeholders = ", ".join("?" * len(device_ids))
+    return await _fetch_page(f"""
+        SELECT rowid AS row_id, * FROM keys
+        WHERE user_id = ? AND lower(device_id) IN ({placeholders})
+    """, (user_id, *device_ids), key="row_id", limit=limit, after=after, before=before,
+        row_factory=Key.row_factory)
+
 async def get_user_keys(user_id, to_dict: bool = False):
     """
     Получает список всех ключей пользователя
-    """
-    async with aiosqlite.connect(DB_PATH) as db:
-        if to_dict:
-            db.row_factory = aiosqlite.Row
 
-        cursor = await db.execute(
-            "SELECT key, device_id, expiration_date, name FROM keys WHERE user_id = ?", 
-            (user_id,)
-        )
+    Returns:
+        list[Key]: Ключи пользователя (list[dict], если to_dict=True)
+    """
+    async with db_pool.reader() as db:
+        db.row_factory = Key.row_factory
+        cursor = await db.execute("SELECT * FROM keys WHERE user_id = ?", (user_id,))
         result = await cursor.fetchall()
-        return result if result else []
+    if to_dict:
+        return [key.to_dict() for key in result]
+    return result
 
 async def get_keys_count(user_id):
     """
     Получает количество ключей пользователя
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT COUNT(*) FROM keys WHERE user_id = ?", (user_id,))
         result = await cursor.fetchone()
         return result[0] if result else 0
 
 async def update_keys_count(user_id, count):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("UPDATE users SET keys_count = ? WHERE user_id = ?", (count, user_id))
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def update_referral_count(user_id):
     """
     Увеличивает счетчик рефералов пользователя на 1
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE users 
             SET referral_count = referral_count + 1 
             WHERE user_id = ?
         """, (user_id,))
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def get_referral_count(user_id):
     """
     Получает количество рефералов пользователя
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT referral_count FROM users WHERE user_id = ?", (user_id,))
         result = await cursor.fetchone()
         return result[0] if result else 0
 
 
-async def update_balance(user_id, balance):
+async def _change_balance(user_id, amount: int, reason: str, idempotency_key: str | None) -> int | None:
     """
-    Устанавливает новое значение баланса для пользователя
+    Атомарно меняет баланс на amount и записывает операцию в balance_ledger.
+
+    Списание (amount < 0) выполняется одним условным UPDATE и не проходит, если
+    средств недостаточно, поэтому параллельные списания не уводят баланс в минус
+    и не затирают друг друга.
+
+    Returns:
+        int | None: Новый баланс или None, если операция не проведена
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.transaction() as db:
+        if idempotency_key is not None:
+            cursor = await db.execute(
+                "SELECT 1 FROM balance_ledger WHERE idempotency_key = ?", (idempotency_key,)
+            )
+            if await cursor.fetchone():
+                logger.info(f"Операция с балансом {idempotency_key} уже проведена, пропускаем")
+                return None
+
+        cursor = await db.execute("""
+            UPDATE users SET balance = COALESCE(balance, 0) + ?
+            WHERE user_id = ? AND COALESCE(balance, 0) + ? >= 0
+            RETURNING balance
+        """, (amount, user_id, min(amount, 0)))
+        row = await cursor.fetchone()
+        if row is None:
+            return None
+
         await db.execute("""
-            UPDATE users SET balance = ? WHERE user_id = ?
-        """, (balance, user_id))
-        await db.commit()
+            INSERT INTO balance_ledger (user_id, amount, balance_after, reason, idempotency_key, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, amount, row[0], reason, idempotency_key, int(time.time() * 1000)))
+    user_cache.invalidate(user_id)
+    return row[0]
+
+async def credit_balance(user_id, amount: int, reason: str, idempotency_key: str = None) -> int | None:
+    """
+    Начисляет amount на баланс пользователя.
+
+    Args:
+        user_id: ID пользователя
+        amount (int): Сумма начисления (не меньше 0)
+        reason (str): Причина для журнала (deposit, referral_bonus, promocode, admin, ...)
+        idempotency_key (str): Ключ операции; повторный вызов с тем же ключом ничего не меняет
+
+    Returns:
+        int | None: Новый баланс или None, если пользователь не найден или операция уже проведена
+    """
+    if amount < 0:
+        raise ValueError("Сумма начисления не может быть отрицательной")
+    return await _change_balance(user_id, int(amount), reason, idempotency_key)
+
+async def debit_balance(user_id, amount: int, reason: str, idempotency_key: str = None) -> int | None:
+    """
+    Списывает amount с баланса пользователя, если средств достаточно.
+
+    Args:
+        user_id: ID пользователя
+        amount (int): Сумма списания (не меньше 0)
+        reason (str): Причина для журнала (subscription, renewal, admin, ...)
+        idempotency_key (str): Ключ операции; повторный вызов с тем же ключом ничего не меняет
+
+    Returns:
+        int | None: Новый баланс или None, если средств недостаточно, пользователь
+        не найден или операция уже проведена
+    """
+    if amount < 0:
+        raise ValueError("Сумма списания не может быть отрицательной")
+    return await _change_balance(user_id, -int(amount), reason, idempotency_key)
+
+async def get_balance_history(user_id, limit: int = 20) -> list[dict]:
+    """
+    Возвращает последние операции с балансом пользователя (новые первые).
+    """
+    async with db_pool.reader() as db:
+        db.row_factory = _dict_row
+        cursor = await db.execute("""
+            SELECT id, amount, balance_after, reason, idempotency_key, created_at
+            FROM balance_ledger
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (user_id, limit))
+        return await cursor.fetchall()
 
 async def update_subscription(user_id, subscription_type, subscription_end):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE users SET subscription_type = ?, subscription_end = ? WHERE user_id = ?
         """, (subscription_type, subscription_end, user_id))
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def update_user_subscription(user_id, new_end_date):
     """
@@ -2996,46 +3915,53 @@ async def update_user_subscription(user_id, new_end_date):
         user_id (int): ID пользователя
         new_end_date (str): Новая дата окончания подписки
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE users SET subscription_end = ? WHERE user_id = ?
         """, (new_end_date, user_id))
         await db.commit()
+    user_cache.invalidate(user_id)
 
 
 
 async def get_key(key):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
+        db.row_factory = Key.row_factory
         cursor = await db.execute("SELECT * FROM keys WHERE key = ?", (key,))
         return await cursor.fetchone()
 
+async def iter_all_keys(chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[Key]:
+    """
+    Потоково отдает все ключи в порядке значения ключа, порциями по chunk_size.
+    """
+    async for key in _iter_rows("SELECT * FROM keys", key="key", row_factory=Key.row_factory, chunk_size=chunk_size):
+        yield key
+
 async def get_all_keys():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT * FROM keys")
-        return await cursor.fetchall()
+    return [key async for key in iter_all_keys()]
 
 async def sync_payment_id_for_all_keys(user_id, payment_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE keys SET payment_id = ? WHERE user_id = ?
         """, (payment_id, user_id))
         await db.commit()
 
 async def set_payment_id_for_key(key, payment_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE keys SET payment_id = ? WHERE key = ?
         """, (payment_id, key))
         await db.commit()
 
 async def get_payment_id_for_key(key):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("SELECT payment_id FROM keys WHERE key = ?", (key,))
         result = await cursor.fetchone()
         return result[0] if result else None
 
 async def get_all_keys_with_payment_method():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         cursor = await db.execute("""
             SELECT key, expiration_date, payment_id 
             FROM keys 
@@ -3055,7 +3981,7 @@ async def get_user_id_by_key(key):
         int: ID пользователя или None, если ключ не найден
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             cursor = await db.execute("SELECT user_id FROM keys WHERE key = ?", (key,))
             result = await cursor.fetchone()
             return result[0] if result else None
@@ -3075,7 +4001,7 @@ async def update_key_expiration(key, new_expiry_timestamp):
         bool: True если обновление успешно, False в противном случае
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.writer() as db:
             await db.execute(
                 "UPDATE keys SET expiration_date = ? WHERE key = ?",
                 (new_expiry_timestamp, key)
@@ -3090,7 +4016,7 @@ async def update_key_expiration(key, new_expiry_timestamp):
 
 async def get_key_by_uniquie_id(unique_id):
     """
-    Ищет ключ, содержащий указанный unique_id в любой части строки key
+    Ищет ключ по unique_id из имени клиента (device_uniqueid_username)
     
     Args:
         unique_id (str): Уникальный идентификатор для поиска
@@ -3098,13 +4024,13 @@ async def get_key_by_uniquie_id(unique_id):
     Returns:
         dict: Словарь с данными ключа или None, если ключ не найден
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         db.row_factory = aiosqlite.Row  # Устанавливаем row_factory для получения словаря
         cursor = await db.execute("""
             SELECT key, user_id, device_id, expiration_date 
             FROM keys 
-            WHERE key LIKE ?
-        """, (f'%{unique_id}%',))
+            WHERE unique_id = ?
+        """, (unique_id,))
         row = await cursor.fetchone()
         
         if row:
@@ -3112,25 +4038,29 @@ async def get_key_by_uniquie_id(unique_id):
         return None
 
 async def remove_key_bd(key):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+    async with db_pool.writer() as db:
+        cursor = await db.execute("""
             DELETE FROM keys WHERE key = ?
+            RETURNING user_id
         """, (key,))
+        user_ids = [row[0] for row in await cursor.fetchall()]
         await db.commit()
+    user_cache.invalidate_many(user_ids)
+    _forget_key_reminders([key])
 
 async def get_all_keys_to_expire() -> list[dict]:
     """
-    Возвращает все ключи, чей expiration_date (мс Unix‑эпохи) попадает на сегодняшнюю дату UTC.
+    Возвращает все ключи, чей expiration_date (мс Unix‑эпохи) попадает на сегодняшнюю дату UTC или раньше.
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        # Граница — начало завтрашнего дня в UTC, сравнение идет по индексу expiration_date
+        today_utc = datetime.now(timezone.utc).date()
+        start_of_tomorrow = datetime.combine(today_utc + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+        end_ms = int(start_of_tomorrow.timestamp() * 1000)
+
+        async with db_pool.reader() as db:
             db.row_factory = aiosqlite.Row
-            query = """
-                SELECT *
-                FROM   keys
-                WHERE  date(expiration_date / 1000, 'unixepoch') <= date('now', 'utc');
-            """
-            cursor = await db.execute(query)
+            cursor = await db.execute(KEYS_TO_EXPIRE_SQL, (end_ms,))
             rows = await cursor.fetchall()
             return [dict(r) for r in rows]
     except Exception as e:
@@ -3141,87 +4071,110 @@ async def add_or_update_user(user_id, username, subscription_type, is_admin, bal
     """
     Добавляет или обновляет пользователя в базе данных
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             INSERT OR REPLACE INTO users 
             (user_id, username, subscription_type, is_admin, balance, subscription_end, referrer_id, promo_days) 
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """, (user_id, username, subscription_type, is_admin, balance, subscription_end, referrer_id, promo_days))
         await db.commit()
+        # Кэш администраторов обновляется только после фиксации записи
+        db_pool.after_commit(lambda: _update_admin_ids(user_id, is_admin))
+    user_cache.invalidate(user_id)
+
+def _update_admin_ids(user_id, is_admin):
+    """Отражает смену флага is_admin пользователя в кэше администраторов."""
+    if _admin_ids is not None:
+        if is_admin:
+            _admin_ids.add(int(user_id))
+        else:
+            _admin_ids.discard(int(user_id))
 
-async def add_referral_bonus(referrer_id, amount):
+async def add_referral_bonus(referrer_id, amount, referral_id=None):
     """
-    Начисляет бонус рефереру
+    Начисляет бонус рефереру за регистрацию реферала referral_id (не более одного раза)
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            UPDATE users SET balance = balance + ? WHERE user_id = ?
-        """, (amount, referrer_id))
-        await db.commit()
+    idempotency_key = f"referral_signup:{referral_id}" if referral_id is not None else None
+    return await credit_balance(referrer_id, amount, "referral_signup", idempotency_key)
 
 async def get_user(user_id):
     """
-    Получает данные пользователя из базы данных и возвращает их в виде словаря
+    Получает данные пользователя из базы данных (User).
+    Строка берется из user_cache, если она там есть и не устарела
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    # Внутри незавершенной единицы работы данные могут быть откачены, их не кэшируем
+    generation = user_cache.generation
+    cacheable = not db_pool.in_transaction
+    async with db_pool.reader() as db:
+        # Колонки сопоставляются с полями User по имени, порядок колонок в таблице не важен
+        db.row_factory = User.row_factory
         cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        # Обновляем порядок колонок в соответствии с порядком в CREATE TABLE
-        columns = [
-            'user_id',
-            'username',
-            'balance',
-            'subscription_type',
-            'subscription_end',
-            'is_admin',
-            'referrer_id',
-            'referral_count',
-            'keys_count',
-            'free_keys_count',
-            'promo_days',
-            'email',
-            'is_first_payment_done',
-            'from_channel',
-            'pay_count',
-        ]
-        row = await cursor.fetchone()
-        if row:
-            return dict(zip(columns, row))
-        return None
+        user = await cursor.fetchone()
+    if user and cacheable and not db_pool.in_transaction:
+        user_cache.set(user_id, user, generation)
+    return user
+
+async def iter_all_users(chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[dict]:
+    """
+    Потоково отдает актуальные данные всех пользователей (словари) в порядке user_id,
+    порциями по chunk_size.
+    """
+    query = """
+        SELECT 
+            u.user_id,
+            u.username,
+            u.balance,
+            u.subscription_type,
+            u.subscription_end,
+            u.is_admin,
+            u.referrer_id,
+            (SELECT COUNT(*) FROM users r WHERE r.referrer_id = u.user_id) as referral_count,
+            (SELECT COUNT(*) FROM keys k WHERE k.user_id = u.user_id AND k.expiration_date > ?) as keys_count,
+            u.free_keys_count,
+            u.promo_days,
+            u.from_channel,
+            u.pay_count
+        FROM users u
+    """
+    current_time = int(datetime.now(timezone.utc).timestamp() * 1000)
+    async for row in _iter_rows(query, (current_time,), key="user_id", chunk_size=chunk_size):
+        yield dict(row)
+
+async def iter_user_ids(chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[int]:
+    """
+    Потоково отдает ID всех пользователей, порциями по chunk_size.
+    """
+    async for row in _iter_rows("SELECT user_id FROM users", key="user_id", chunk_size=chunk_size):
+        yield row["user_id"]
+
+async def get_referral_income() -> dict:
+    """
+    Считает доход с рефералов: сумму успешных платежей приглашенных пользователей.
+
+    Returns:
+        dict: referrer_id -> сумма успешных транзакций его рефералов
+    """
+    async with db_pool.reader() as db:
+        cursor = await db.execute("""
+            SELECT u.referrer_id, SUM(t.amount)
+            FROM users u
+            JOIN user_transactions t ON t.user_id = u.user_id
+            WHERE u.referrer_id IS NOT NULL AND u.referrer_id != 0
+            AND t.status = 'succeeded'
+            GROUP BY u.referrer_id
+        """)
+        return {referrer_id: amount for referrer_id, amount in await cursor.fetchall()}
 
 async def get_all_users():
     """
     Получает актуальные данные всех пользователей
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row  # Это позволит получать данные в виде словаря
-            
-            query = """
-                SELECT 
-                    u.user_id,
-                    u.username,
-                    u.balance,
-                    u.subscription_type,
-                    u.subscription_end,
-                    u.is_admin,
-                    u.referrer_id,
-                    (SELECT COUNT(*) FROM users r WHERE r.referrer_id = u.user_id) as referral_count,
-                    (SELECT COUNT(*) FROM keys k WHERE k.user_id = u.user_id AND k.expiration_date > ?) as keys_count,
-                    u.free_keys_count,
-                    u.promo_days,
-                    u.from_channel,
-                    u.pay_count
-                FROM users u
-                ORDER BY u.user_id
-            """
-            
-            current_time = int(datetime.now(timezone.utc).timestamp() * 1000)
-            cursor = await db.execute(query, (current_time,))
-            users = await cursor.fetchall()
-            
-            # Преобразуем Row objects в список словарей
-            return [dict(row) for row in users]
-            
+        return [user async for user in iter_all_users()]
     except Exception as e:
         logger.error(f"Ошибка при получении списка пользователей: {e}")
         return []
@@ -3237,7 +4190,7 @@ async def get_forum_topic_id(username: str):
         tuple: (topic_id, channel) или None, если топик не найден
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader(attached=True) as db:
             cursor = await db.execute(
                 "SELECT topic_id, channel FROM forum_topics WHERE username = ?", 
                 (username,)
@@ -3261,18 +4214,16 @@ async def save_forum_topic_id(username: str, topic_id: int, channel: str):
         bool: True если успешно, иначе False
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Используем INSERT OR REPLACE для обновления существующей записи
-            await db.execute(
-                """
-                INSERT OR REPLACE INTO forum_topics (username, topic_id, channel) 
-                VALUES (?, ?, ?)
-                """, 
-                (username, topic_id, channel)
-            )
-            await db.commit()
-            logger.info(f"Сохранен ID топика {topic_id} в канале {channel} для пользователя {username}")
-            return True
+        # Используем INSERT OR REPLACE для обновления существующей записи
+        await aux_batch_writer.execute(
+            """
+            INSERT OR REPLACE INTO forum_topics (username, topic_id, channel) 
+            VALUES (?, ?, ?)
+            """, 
+            (username, topic_id, channel)
+        )
+        logger.info(f"Сохранен ID топика {topic_id} в канале {channel} для пользователя {username}")
+        return True
     except Exception as e:
         logger.error(f"Ошибка при сохранении ID топика для {username}: {e}")
         return False
@@ -3288,7 +4239,7 @@ async def delete_forum_topic(username: str):
         bool: True если успешно, иначе False
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with aux_pool.writer() as db:
             await db.execute(
                 "DELETE FROM forum_topics WHERE username = ?", 
                 (username,)
@@ -3304,7 +4255,7 @@ async def add_channel_column_to_forum_topics():
     """
     Добавляет колонку channel в таблицу forum_topics, если её нет.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aux_pool.writer() as db:
         # Проверяем, существует ли колонка channel
         cursor = await db.execute("PRAGMA table_info(forum_topics)")
         columns = {row[1] for row in await cursor.fetchall()}
@@ -3331,28 +4282,24 @@ async def add_channel_column_to_forum_topics():
         else:
             logger.info("Колонка channel уже существует в таблице forum_topics")
 
-async def release_server_slot(address, inbound_id, protocol):
+async def release_server_slot(reservation_id: int):
     """
-    Освобождает зарезервированное место на сервере при ошибке добавления клиента
+    Освобождает зарезервированное место на сервере при ошибке добавления клиента,
+    не дожидаясь истечения резерва
     
     Args:
-        address (str): Адрес сервера
-        inbound_id (int): ID инбаунда
-        protocol (str): Протокол (shadowsocks/vless)
+        reservation_id (int): ID резерва, который вернул get_api_instance
     """
+    if reservation_id is None:
+        return
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
-                UPDATE inbounds 
-                SET clients_count = MAX(clients_count - 1, 0)
-                WHERE TRIM(LOWER(server_address)) = TRIM(LOWER(?))
-                AND inbound_id = ?
-                AND protocol = ?
-            """, (address, inbound_id, protocol))
+        async with db_pool.writer() as db:
+            cursor = await db.execute("DELETE FROM slot_reservations WHERE id = ?", (reservation_id,))
             await db.commit()
-            logger.info(f"Освобождено место на сервере {address}, инбаунд {inbound_id} ({protocol})")
+            if cursor.rowcount:
+                logger.info(f"Освобожден резерв места #{reservation_id}")
     except Exception as e:
-        logger.error(f"Ошибка при освобождении места на сервере {address}: {e}")
+        logger.error(f"Ошибка при освобождении резерва места #{reservation_id}: {e}")
 
 async def get_system_statistics():
     """
@@ -3366,7 +4313,7 @@ async def get_system_statistics():
             - active_keys: Количество активных ключей
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             # Получаем текущее время в миллисекундах
             current_time = int(datetime.now().timestamp() * 1000)
             
@@ -3420,7 +4367,7 @@ async def get_all_users_with_subscription():
         list: Список словарей с информацией о пользователях
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.reader() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("""
                 SELECT user_id, subscription_end
@@ -3435,6 +4382,22 @@ async def get_all_users_with_subscription():
         logger.error(f"Ошибка при получении пользователей с подпиской: {e}")
         return []
 
+async def iter_users_by_server_address(server_address: str, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[int]:
+    """
+    Потоково отдает ID пользователей, у которых есть ключи на указанном сервере,
+    порциями по chunk_size.
+    """
+    # Нормализуем адрес сервера (убираем порт если есть)
+    base_address = normalize_server_host(server_address)
+
+    async for row in _iter_rows("""
+        SELECT DISTINCT user_id 
+        FROM keys 
+        WHERE server_ip = ? 
+        AND user_id IS NOT NULL
+    """, (base_address,), key="user_id", chunk_size=chunk_size):
+        yield row["user_id"]
+
 async def get_users_by_server_address(server_address: str):
     """
     Получает список ID пользователей, у которых есть ключи с указанным адресом сервера
@@ -3446,21 +4409,9 @@ async def get_users_by_server_address(server_address: str):
         list: Список ID пользователей
     """
     try:
-        # Нормализуем адрес сервера (убираем порт если есть)
-        base_address = server_address.split(':')[0].strip().lower()
-        
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Ищем ключи, содержащие указанный адрес
-            cursor = await db.execute("""
-                SELECT DISTINCT user_id 
-                FROM keys 
-                WHERE key LIKE ? 
-                AND user_id IS NOT NULL
-            """, (f'%{base_address}%',))
-            
-            users = await cursor.fetchall()
-            logger.info(f"Найдено {len(users)} пользователей с ключами на сервере {server_address}")
-            return [user[0] for user in users]
+        users = [user_id async for user_id in iter_users_by_server_address(server_address)]
+        logger.info(f"Найдено {len(users)} пользователей с ключами на сервере {server_address}")
+        return users
             
     except Exception as e:
         logger.error(f"Ошибка при получении пользователей с ключами на сервере {server_address}: {e}")
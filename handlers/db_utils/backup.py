@@ -0,0 +1,145 @@
+# handlers.db_utils.backup.py
+"""
+Онлайн-бэкап SQLite через backup API.
+
+Копия снимается отдельным sqlite3-соединением в рабочем потоке порциями по
+pages_per_step страниц, поэтому цикл событий не блокируется, а запись в базу
+продолжается во время копирования (если база меняется между порциями, SQLite
+сам начинает копирование заново и копия остается согласованной). Готовая копия
+проверяется PRAGMA integrity_check и сжимается gzip.
+
+Чтобы не снимать и не рассылать одинаковые копии, перед бэкапом проверяется
+PRAGMA data_version (get_data_version()). Сжатые файлы больше лимита Bot API
+режутся на части функцией split_file().
+"""
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# Страниц за один шаг backup API и время ожидания между шагами, если база занята
+BACKUP_PAGES_PER_STEP = 1024
+BACKUP_STEP_SLEEP = 0.05
+BACKUP_BUSY_TIMEOUT_MS = 5000
+
+# Соединения, через которые читается PRAGMA data_version (путь к базе -> соединение).
+# data_version меняется, только если коммит сделало другое соединение, поэтому
+# соединение должно жить между бэкапами и само ничего не писать.
+_probes: dict[str, sqlite3.Connection] = {}
+
+
+def _copy_database(source_path: str, target_path: str, pages_per_step: int) -> int:
+    """Копирует базу через backup API и возвращает количество страниц копии."""
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.execute(f"PRAGMA busy_timeout = {BACKUP_BUSY_TIMEOUT_MS}")
+        source.backup(target, pages=pages_per_step, sleep=BACKUP_STEP_SLEEP)
+        # Копия — самостоятельный файл без WAL рядом с ним
+        target.execute("PRAGMA journal_mode = DELETE")
+        return target.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        target.close()
+        source.close()
+
+
+def get_data_version(source_path: str) -> int:
+    """Возвращает PRAGMA data_version базы, увиденный постоянным соединением-пробой."""
+    probe = _probes.get(source_path)
+    if probe is None:
+        probe = sqlite3.connect(source_path, check_same_thread=False)
+        probe.execute(f"PRAGMA busy_timeout = {BACKUP_BUSY_TIMEOUT_MS}")
+        _probes[source_path] = probe
+    return probe.execute("PRAGMA data_version").fetchone()[0]
+
+
+def _check_integrity(path: str) -> str:
+    """Возвращает результат PRAGMA integrity_check ("ok" для целой базы)."""
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = db.execute("PRAGMA integrity_check").fetchall()
+        return "; ".join(row[0] for row in rows)
+    finally:
+        db.close()
+
+
+def _compress(source_path: str, target_path: str) -> str:
+    """Сжимает файл gzip и возвращает sha256 сжатого файла."""
+    with open(source_path, 'rb') as source, gzip.open(target_path, 'wb', compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+    digest = hashlib.sha256()
+    with open(target_path, 'rb') as compressed:
+        for chunk in iter(lambda: compressed.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def split_file(path: str, chunk_size: int) -> list[str]:
+    """
+    Режет файл на части не больше chunk_size байт (path.part001, path.part002, ...).
+
+    Returns:
+        list[str]: Пути частей; [path], если файл и так не больше chunk_size
+    """
+    if os.path.getsize(path) <= chunk_size:
+        return [path]
+
+    parts = []
+    with open(path, 'rb') as source:
+        for number, chunk in enumerate(iter(lambda: source.read(chunk_size), b''), start=1):
+            part_path = f"{path}.part{number:03d}"
+            with open(part_path, 'wb') as part:
+                part.write(chunk)
+            parts.append(part_path)
+    return parts
+
+
+def run_backup(source_path: str, backup_path: str, pages_per_step: int = BACKUP_PAGES_PER_STEP) -> dict:
+    """
+    Снимает копию базы в backup_path (файл .gz). Блокирующая функция —
+    из асинхронного кода вызывается через create_backup().
+
+    Returns:
+        dict: Имя файла, время создания (мс), длительность (мс), количество страниц,
+        размер копии и сжатого файла в байтах, sha256 и результат integrity_check
+    """
+    started = time.monotonic()
+    raw_path = f"{backup_path}.raw"
+    tmp_path = f"{backup_path}.tmp"
+    try:
+        pages = _copy_database(source_path, raw_path, pages_per_step)
+        integrity = _check_integrity(raw_path)
+        if integrity != "ok":
+            logger.error(f"integrity_check копии {raw_path}: {integrity}")
+            raise sqlite3.DatabaseError(f"Копия базы не прошла integrity_check: {integrity}")
+
+        db_bytes = os.path.getsize(raw_path)
+        sha256 = _compress(raw_path, tmp_path)
+        os.replace(tmp_path, backup_path)
+    finally:
+        for path in (raw_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return {
+        'file_name': os.path.basename(backup_path),
+        'created_at': int(time.time() * 1000),
+        'duration_ms': int((time.monotonic() - started) * 1000),
+        'pages': pages,
+        'db_bytes': db_bytes,
+        'compressed_bytes': os.path.getsize(backup_path),
+        'sha256': sha256,
+        'integrity': integrity,
+    }
+
+
+async def create_backup(source_path: str, backup_path: str, pages_per_step: int = BACKUP_PAGES_PER_STEP) -> dict:
+    """Выполняет run_backup() в рабочем потоке, не блокируя цикл событий."""
+    return await asyncio.to_thread(run_backup, source_path, backup_path, pages_per_step)
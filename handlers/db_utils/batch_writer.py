@@ -0,0 +1,157 @@
+# handlers.db_utils.batch_writer.py
+import asyncio
+import logging
+
+from handlers.db_utils.pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """
+    Групповая фиксация мелких записей.
+
+    Одиночные UPDATE/INSERT копятся в очереди и выполняются фоновой задачей
+    одной транзакцией: через flush_interval секунд после первой записи в очереди
+    или сразу, когда набралось max_batch записей. Так вместо commit (и fsync)
+    на каждую строку получается один commit на пачку.
+
+    enqueue() не ждет фиксации, execute() ждет и возвращает rowcount. Если пачка
+    не прошла, ее записи выполняются по одной, чтобы ошибка одной записи
+    не отменяла остальные. Вызывать execute() при удержании writer() нельзя:
+    фоновая задача будет ждать то же соединение.
+    """
+
+    def __init__(self, pool: ConnectionPool, flush_interval: float = 0.1, max_batch: int = 200):
+        """
+        Args:
+            pool (ConnectionPool): Пул, через который выполняется запись
+            flush_interval (float): Максимальная задержка записи в секундах
+            max_batch (int): Количество записей, после которого пачка фиксируется сразу
+        """
+        self._pool = pool
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        # (sql, params, future или None для enqueue())
+        self._pending: list[tuple[str, tuple, asyncio.Future | None]] = []
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stats = {'statements': 0, 'batches': 0, 'failed': 0}
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _add(self, sql: str, params: tuple, future: asyncio.Future | None):
+        self._ensure_started()
+        self._pending.append((sql, tuple(params), future))
+        self._has_pending.set()
+        if len(self._pending) >= self.max_batch:
+            self._batch_full.set()
+
+    def enqueue(self, sql: str, params: tuple = ()):
+        """Ставит запись в очередь, не дожидаясь фиксации. Ошибки только логируются."""
+        self._add(sql, params, None)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """
+        Ставит запись в очередь и ждет фиксации пачки.
+
+        Returns:
+            int: Количество измененных строк
+
+        Raises:
+            Exception: Ошибка выполнения этой записи
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._add(sql, params, future)
+        return await future
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        """Фиксирует все записи, которые сейчас в очереди."""
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.max_batch]
+                self._pending = self._pending[self.max_batch:]
+                if not self._pending:
+                    self._has_pending.clear()
+                if len(self._pending) < self.max_batch:
+                    self._batch_full.clear()
+                try:
+                    await self._write(batch)
+                except BaseException:
+                    # Задачу отменили посреди записи: транзакция откачена, возвращаем
+                    # пачку в начало очереди, чтобы ее зафиксировал close()
+                    self._pending[:0] = [item for item in batch if item[2] is None or not item[2].done()]
+                    self._has_pending.set()
+                    raise
+
+    async def _write(self, batch: list):
+        try:
+            rowcounts = []
+            async with self._pool.transaction() as db:
+                for sql, params, _ in batch:
+                    cursor = await db.execute(sql, params)
+                    rowcounts.append(cursor.rowcount)
+                    await cursor.close()
+        except Exception as e:
+            logger.warning(f"Пачка из {len(batch)} записей не зафиксирована ({e}), выполняю по одной")
+            for item in batch:
+                await self._write_one(item)
+            return
+
+        self._stats['statements'] += len(batch)
+        self._stats['batches'] += 1
+        for (_, _, future), rowcount in zip(batch, rowcounts):
+            if future is not None and not future.done():
+                future.set_result(rowcount)
+
+    async def _write_one(self, item: tuple):
+        sql, params, future = item
+        try:
+            async with self._pool.transaction() as db:
+                cursor = await db.execute(sql, params)
+                rowcount = cursor.rowcount
+                await cursor.close()
+        except Exception as e:
+            self._stats['failed'] += 1
+            if future is None:
+                logger.error(f"Ошибка отложенной записи ({sql.split()[0]}): {e}")
+            elif not future.done():
+                future.set_exception(e)
+            return
+
+        self._stats['statements'] += 1
+        self._stats['batches'] += 1
+        if future is not None and not future.done():
+            future.set_result(rowcount)
+
+    async def close(self):
+        """Останавливает фоновую задачу и фиксирует оставшиеся записи (вызывается при остановке бота)."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        await self.flush()
+        logger.info(f"Групповая запись остановлена. Статистика: {self.get_stats()}")
+
+    def get_stats(self) -> dict:
+        """
+        Returns:
+            dict: Количество зафиксированных записей, транзакций, ошибок и размер очереди
+        """
+        return {**self._stats, 'pending': len(self._pending)}
@@ -0,0 +1,158 @@
+# handlers.db_utils.benchmark.py
+"""
+Нагрузочный тест пула соединений на смешанном трафике обработчиков.
+
+Сравнивает пул без настроек (rollback journal, как было раньше) с профилем
+DB_PRAGMAS (WAL и остальные PRAGMA). Каждый прогон идет на отдельной временной базе.
+
+Запуск:
+    python -m handlers.db_utils.benchmark --tasks 50 --ops 200 --write-ratio 0.2
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from handlers.database import DB_POOL_READERS, DB_PRAGMAS
+from handlers.db_utils.pool import ConnectionPool
+
+USERS = 1000
+KEYS_PER_USER = 3
+
+
+async def _prepare(pool: ConnectionPool):
+    """Создает упрощенные таблицы users и keys и заполняет их."""
+    now = int(time.time() * 1000)
+    async with pool.writer() as db:
+        await db.execute("""
+            CREATE TABLE users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                balance INTEGER DEFAULT 0,
+                keys_count INTEGER DEFAULT 0
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE keys (
+                key TEXT PRIMARY KEY,
+                user_id INTEGER,
+                expiration_date INTEGER,
+                price INTEGER NOT NULL,
+                days INTEGER NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX idx_keys_user_expiration ON keys(user_id, expiration_date)")
+        await db.executemany(
+            "INSERT INTO users (user_id, username, balance) VALUES (?, ?, ?)",
+            [(user_id, f"user{user_id}", 100) for user_id in range(USERS)]
+        )
+        await db.executemany(
+            "INSERT INTO keys (key, user_id, expiration_date, price, days) VALUES (?, ?, ?, ?, ?)",
+            [
+                (f"key-{user_id}-{n}", user_id, now + n * 86400000, 100, 30)
+                for user_id in range(USERS)
+                for n in range(KEYS_PER_USER)
+            ]
+        )
+        await db.commit()
+
+
+async def _read(pool: ConnectionPool, user_id: int):
+    """Профиль пользователя и его активные ключи (как в меню бота)."""
+    async with pool.reader() as db:
+        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            await cursor.fetchone()
+        async with db.execute(
+            "SELECT key, expiration_date FROM keys WHERE user_id = ? AND expiration_date > ?",
+            (user_id, int(time.time() * 1000))
+        ) as cursor:
+            await cursor.fetchall()
+
+
+async def _write(pool: ConnectionPool, user_id: int, seq: int):
+    """Списание с баланса и сохранение нового ключа (как при покупке)."""
+    async with pool.writer() as db:
+        await db.execute("UPDATE users SET balance = balance - 1 WHERE user_id = ?", (user_id,))
+        await db.execute(
+            "INSERT INTO keys (key, user_id, expiration_date, price, days) VALUES (?, ?, ?, ?, ?)",
+            (f"new-{user_id}-{seq}", user_id, int(time.time() * 1000) + 86400000, 100, 30)
+        )
+        await db.commit()
+
+
+async def run_profile(name: str, pragmas: dict, tasks: int, ops: int, write_ratio: float, readers: int) -> dict:
+    """
+    Прогоняет нагрузку на новой базе с заданными PRAGMA.
+
+    Returns:
+        dict: Название профиля, количество операций в секунду, задержки и число ошибок
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        pool = ConnectionPool(os.path.join(tmp, "bench.db"), readers=readers, pragmas=pragmas)
+        await pool.open()
+        try:
+            await _prepare(pool)
+            latencies = []
+            errors = 0
+            rng = random.Random(42)
+            plan = [
+                [(rng.random() < write_ratio, rng.randrange(USERS)) for _ in range(ops)]
+                for _ in range(tasks)
+            ]
+
+            async def worker(worker_id: int, steps: list):
+                nonlocal errors
+                for seq, (is_write, user_id) in enumerate(steps):
+                    started = time.perf_counter()
+                    try:
+                        if is_write:
+                            await _write(pool, user_id, worker_id * ops + seq)
+                        else:
+                            await _read(pool, user_id)
+                    except Exception:
+                        errors += 1
+                    latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(i, steps) for i, steps in enumerate(plan)))
+            elapsed = time.perf_counter() - started
+        finally:
+            await pool.close()
+
+    latencies.sort()
+    return {
+        'profile': name,
+        'ops_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+        'errors': errors,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Сравнение профилей PRAGMA пула соединений")
+    parser.add_argument("--tasks", type=int, default=50, help="Количество одновременных задач")
+    parser.add_argument("--ops", type=int, default=200, help="Операций на задачу")
+    parser.add_argument("--write-ratio", type=float, default=0.2, help="Доля операций записи")
+    parser.add_argument("--readers", type=int, default=DB_POOL_READERS, help="Соединений на чтение")
+    args = parser.parse_args()
+
+    results = [
+        await run_profile(name, pragmas, args.tasks, args.ops, args.write_ratio, args.readers)
+        for name, pragmas in (("default", {}), ("DB_PRAGMAS", DB_PRAGMAS))
+    ]
+    for result in results:
+        print(
+            f"{result['profile']:>12}: {result['ops_per_sec']:>8} оп/с, "
+            f"p50 {result['p50_ms']} мс, p95 {result['p95_ms']} мс, ошибок {result['errors']}"
+        )
+    baseline, tuned = results
+    if baseline['ops_per_sec']:
+        print(f"Прирост пропускной способности: x{tuned['ops_per_sec'] / baseline['ops_per_sec']:.2f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,494 @@
+# handlers.db_utils.migrations.py
+import logging
+import re
+from typing import Awaitable, Callable, List, Tuple
+
+import aiosqlite
+
+from handlers.utils import normalize_server_host, parse_key_fields
+
+logger = logging.getLogger(__name__)
+
+Migration = Tuple[int, str, Callable[[aiosqlite.Connection], Awaitable[None]]]
+
+
+async def _ensure_column_exists(
+    db: aiosqlite.Connection, table: str, column: str, col_type: str
+):
+    """Добавляет колонку, если её нет (SQLite не поддерживает IF NOT EXISTS)."""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        cols = [row[1] async for row in cursor]
+    if column not in cols:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type};")
+
+
+async def _baseline_columns(db: aiosqlite.Connection):
+    """
+    Приводит старые базы к актуальной структуре: создает таблицу inbounds
+    и добавляет колонки, которые раньше добавлялись отдельными функциями при каждом запуске.
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS inbounds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            server_address TEXT NOT NULL,
+            inbound_id INTEGER NOT NULL,
+            protocol TEXT NOT NULL,
+            clients_count INTEGER DEFAULT 0,
+            max_clients INTEGER DEFAULT 100,
+            pbk TEXT,
+            sid TEXT,
+            sni TEXT,
+            port INTEGER,
+            utls TEXT,
+            FOREIGN KEY(server_id) REFERENCES servers(id)
+        )
+    """)
+
+    columns = [
+        ("keys", "price", "INTEGER"),
+        ("keys", "days", "INTEGER"),
+        ("keys", "payment_id", "TEXT"),
+        ("keys", "name", "TEXT DEFAULT NULL"),
+        ("user_payment_methods", "when_valid", "TEXT"),
+        ("users", "from_channel", "TEXT DEFAULT NULL"),
+        ("users", "pay_count", "INTEGER DEFAULT 0"),
+        ("users", "is_first_payment_done", "BOOLEAN DEFAULT 0"),
+        ("users", "is_banned", "INTEGER DEFAULT 0"),
+        ("inbounds", "pbk", "TEXT"),
+        ("inbounds", "sid", "TEXT"),
+        ("inbounds", "sni", "TEXT"),
+        ("inbounds", "port", "INTEGER"),
+        ("inbounds", "utls", "TEXT"),
+        ("forum_topics", "channel", "TEXT DEFAULT '@atlanta_logsss'"),
+    ]
+    for table, column, col_type in columns:
+        await _ensure_column_exists(db, table, column, col_type)
+
+
+async def _hot_table_indexes(db: aiosqlite.Connection):
+    """Вторичные индексы для часто используемых выборок."""
+    indexes = [
+        "CREATE INDEX IF NOT EXISTS idx_keys_user_id ON keys(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_keys_expiration_date ON keys(expiration_date)",
+        "CREATE INDEX IF NOT EXISTS idx_user_transactions_user_status ON user_transactions(user_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)",
+        "CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users(referrer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_used_promocodes_user_promocode ON used_promocodes(user_id, promocode)",
+        "CREATE INDEX IF NOT EXISTS idx_promocodes_code ON promocodes(code)",
+        "CREATE INDEX IF NOT EXISTS idx_inbounds_server_protocol ON inbounds(server_address, protocol)",
+        "CREATE INDEX IF NOT EXISTS idx_user_payment_methods_user ON user_payment_methods(user_id, payment_method_id)",
+    ]
+    for statement in indexes:
+        await db.execute(statement)
+
+
+async def _key_fields_columns(db: aiosqlite.Connection):
+    """
+    Добавляет в keys колонки с разобранными полями ключа и заполняет их
+    для уже существующих ключей.
+    """
+    columns = [
+        ("protocol", "TEXT"),
+        ("server_ip", "TEXT"),
+        ("port", "INTEGER"),
+        ("client_uuid", "TEXT"),
+        ("panel_email", "TEXT"),
+        ("unique_id", "TEXT"),
+        ("device_type", "TEXT"),
+    ]
+    for column, col_type in columns:
+        await _ensure_column_exists(db, "keys", column, col_type)
+
+    async with db.execute("SELECT key FROM keys WHERE protocol IS NULL") as cursor:
+        keys = [row[0] async for row in cursor]
+
+    updates = []
+    for key in keys:
+        fields = parse_key_fields(key)
+        updates.append((*(fields[column] for column, _ in columns), key))
+    if updates:
+        await db.executemany(
+            f"UPDATE keys SET {', '.join(f'{column} = ?' for column, _ in columns)} WHERE key = ?",
+            updates
+        )
+    logger.info(f"Разобрано ключей: {len(updates)}")
+
+    indexes = [
+        "CREATE INDEX IF NOT EXISTS idx_keys_server_protocol ON keys(server_ip, protocol, expiration_date)",
+        "CREATE INDEX IF NOT EXISTS idx_keys_unique_id ON keys(unique_id)",
+        "CREATE INDEX IF NOT EXISTS idx_keys_client_uuid ON keys(client_uuid)",
+        "CREATE INDEX IF NOT EXISTS idx_keys_panel_email ON keys(panel_email)",
+    ]
+    for statement in indexes:
+        await db.execute(statement)
+
+
+async def _server_host_links(db: aiosqlite.Connection):
+    """
+    Добавляет servers.host (адрес без порта в нижнем регистре) и заново связывает
+    inbounds.server_id с серверами, чтобы соединения шли по индексам, а не по TRIM(LOWER(...)).
+    """
+    await _ensure_column_exists(db, "servers", "host", "TEXT")
+
+    async with db.execute("SELECT id, address FROM servers") as cursor:
+        servers = [row async for row in cursor]
+    await db.executemany(
+        "UPDATE servers SET host = ? WHERE id = ?",
+        [(normalize_server_host(address), server_id) for server_id, address in servers]
+    )
+
+    # Раньше инбаунды связывались с сервером только по адресу, поэтому server_id
+    # восстанавливаем по нему же; инбаунды без сервера оставляем как есть
+    await db.execute("""
+        UPDATE inbounds
+        SET server_id = COALESCE((
+            SELECT s.id FROM servers s
+            WHERE TRIM(LOWER(s.address)) = TRIM(LOWER(inbounds.server_address))
+            ORDER BY s.id
+            LIMIT 1
+        ), server_id)
+    """)
+
+    indexes = [
+        "CREATE INDEX IF NOT EXISTS idx_servers_host ON servers(host)",
+        "CREATE INDEX IF NOT EXISTS idx_inbounds_server_id ON inbounds(server_id, protocol, inbound_id)",
+    ]
+    for statement in indexes:
+        await db.execute(statement)
+
+
+async def _slot_reservations(db: aiosqlite.Connection):
+    """
+    Таблица временных резервов мест на инбаундах. Резерв подтверждается при
+    сохранении ключа, а неподтвержденный перестает учитываться после expires_at.
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS slot_reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            inbound_row_id INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(inbound_row_id) REFERENCES inbounds(id) ON DELETE CASCADE
+        )
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_slot_reservations_inbound ON slot_reservations(inbound_row_id, expires_at)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_slot_reservations_expires ON slot_reservations(expires_at)"
+    )
+
+
+# Инбаунд ключа, угадываемый по серверу и протоколу: первый инбаунд сервера ключа с тем же
+# протоколом. Так считали триггеры миграции 6; с миграции 10 инбаунд хранится в keys.inbound_row_id,
+# а это правило заполняет его только для ключей, сохраненных раньше
+_KEY_INBOUND_SQL = """(
+    SELECT i.id FROM inbounds i
+    JOIN servers s ON s.id = i.server_id
+    WHERE s.host = {row}.server_ip AND i.protocol = {row}.protocol
+    ORDER BY i.id
+    LIMIT 1
+)"""
+
+
+async def _counter_triggers(db: aiosqlite.Connection):
+    """
+    Триггеры, поддерживающие users.keys_count, users.pay_count и inbounds.clients_count
+    при изменениях keys и user_transactions, и однократный пересчет этих счетчиков.
+    """
+    new_inbound = _KEY_INBOUND_SQL.format(row="NEW")
+    old_inbound = _KEY_INBOUND_SQL.format(row="OLD")
+
+    triggers = [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_keys_insert_counters AFTER INSERT ON keys
+        BEGIN
+            UPDATE users SET keys_count = COALESCE(keys_count, 0) + 1 WHERE user_id = NEW.user_id;
+            UPDATE inbounds SET clients_count = COALESCE(clients_count, 0) + 1 WHERE id = {new_inbound};
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_keys_delete_counters AFTER DELETE ON keys
+        BEGIN
+            UPDATE users SET keys_count = MAX(COALESCE(keys_count, 0) - 1, 0) WHERE user_id = OLD.user_id;
+            UPDATE inbounds SET clients_count = MAX(COALESCE(clients_count, 0) - 1, 0) WHERE id = {old_inbound};
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_keys_update_user AFTER UPDATE OF user_id ON keys
+        WHEN OLD.user_id IS NOT NEW.user_id
+        BEGIN
+            UPDATE users SET keys_count = MAX(COALESCE(keys_count, 0) - 1, 0) WHERE user_id = OLD.user_id;
+            UPDATE users SET keys_count = COALESCE(keys_count, 0) + 1 WHERE user_id = NEW.user_id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_keys_update_inbound AFTER UPDATE OF server_ip, protocol ON keys
+        WHEN OLD.server_ip IS NOT NEW.server_ip OR OLD.protocol IS NOT NEW.protocol
+        BEGIN
+            UPDATE inbounds SET clients_count = MAX(COALESCE(clients_count, 0) - 1, 0) WHERE id = {old_inbound};
+            UPDATE inbounds SET clients_count = COALESCE(clients_count, 0) + 1 WHERE id = {new_inbound};
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_insert_pay_count AFTER INSERT ON user_transactions
+        WHEN NEW.status = 'succeeded'
+        BEGIN
+            UPDATE users SET pay_count = COALESCE(pay_count, 0) + 1 WHERE user_id = NEW.user_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_delete_pay_count AFTER DELETE ON user_transactions
+        WHEN OLD.status = 'succeeded'
+        BEGIN
+            UPDATE users SET pay_count = MAX(COALESCE(pay_count, 0) - 1, 0) WHERE user_id = OLD.user_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_update_pay_count AFTER UPDATE OF status, user_id ON user_transactions
+        WHEN OLD.status IS NOT NEW.status OR OLD.user_id IS NOT NEW.user_id
+        BEGIN
+            UPDATE users SET pay_count = MAX(COALESCE(pay_count, 0) - 1, 0)
+            WHERE OLD.status = 'succeeded' AND user_id = OLD.user_id;
+            UPDATE users SET pay_count = COALESCE(pay_count, 0) + 1
+            WHERE NEW.status = 'succeeded' AND user_id = NEW.user_id;
+        END
+        """,
+    ]
+    for statement in triggers:
+        await db.execute(statement)
+
+    # Начальные значения, от которых дальше считают триггеры
+    await db.execute("""
+        UPDATE users SET
+            keys_count = (SELECT COUNT(*) FROM keys WHERE keys.user_id = users.user_id),
+            pay_count = (
+                SELECT COUNT(*) FROM user_transactions t
+                WHERE t.user_id = users.user_id AND t.status = 'succeeded'
+            )
+    """)
+    await db.execute("""
+        UPDATE inbounds SET clients_count = (
+            SELECT COUNT(*) FROM keys k
+            JOIN servers s ON s.host = k.server_ip
+            WHERE s.id = inbounds.server_id AND k.protocol = inbounds.protocol
+        )
+    """)
+
+
+async def _rebuild_keys_with_integer_expiry(db: aiosqlite.Connection, columns: List[str]):
+    """
+    Копирует таблицу keys в новую с колонкой expiration_date типа INTEGER.
+    SQLite не умеет менять тип колонки, поэтому индексы и триггеры создаются заново.
+    """
+    # С включенными внешними ключами DROP TABLE каскадно удалит строки key_usage_reminders
+    async with db.execute("PRAGMA foreign_keys") as cursor:
+        if (await cursor.fetchone())[0]:
+            raise RuntimeError("Пересоздание таблицы keys невозможно при включенном PRAGMA foreign_keys")
+
+    async with db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'keys'") as cursor:
+        table_sql = (await cursor.fetchone())[0]
+    async with db.execute(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = 'keys' AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+    ) as cursor:
+        dependent_sql = [row[0] async for row in cursor]
+
+    new_table_sql = re.sub(r"expiration_date\s+TEXT", "expiration_date INTEGER", table_sql, count=1, flags=re.IGNORECASE)
+    new_table_sql = re.sub(r"^CREATE TABLE\s+(IF NOT EXISTS\s+)?\"?keys\"?", "CREATE TABLE keys_new", new_table_sql, count=1, flags=re.IGNORECASE)
+    await db.execute(new_table_sql)
+
+    # Колонка с INTEGER affinity сама приводит числовые строки к целым
+    column_list = ", ".join(columns)
+    await db.execute(f"INSERT INTO keys_new ({column_list}) SELECT {column_list} FROM keys")
+    await db.execute("DROP TABLE keys")
+    await db.execute("ALTER TABLE keys_new RENAME TO keys")
+
+    for statement in dependent_sql:
+        await db.execute(statement)
+
+
+async def _integer_key_expiry(db: aiosqlite.Connection):
+    """
+    Переводит keys.expiration_date в INTEGER (миллисекунды Unix): в TEXT-колонке
+    числа хранились строками, и сравнения с числами не могли идти по индексу как диапазон.
+    """
+    async with db.execute("PRAGMA table_info(keys)") as cursor:
+        columns = {row[1]: row[2] async for row in cursor}
+    if columns.get("expiration_date", "").upper() != "INTEGER":
+        await _rebuild_keys_with_integer_expiry(db, list(columns))
+
+    # Выборки ключей пользователя по сроку (ближайшая дата, активные ключи) идут по составному индексу
+    await db.execute("DROP INDEX IF EXISTS idx_keys_user_id")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_keys_user_expiration ON keys(user_id, expiration_date)")
+
+
+async def _balance_ledger(db: aiosqlite.Connection):
+    """
+    Журнал изменений баланса. Каждое начисление и списание записывается сюда в той же
+    транзакции, что и UPDATE users.balance; idempotency_key не дает провести одну и ту
+    же операцию (например, зачисление одного платежа) дважды.
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            balance_after INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            idempotency_key TEXT UNIQUE,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger(user_id, id)")
+
+
+async def _backup_metadata(db: aiosqlite.Connection):
+    """
+    Сведения о снятых резервных копиях: размер, количество страниц, контрольная сумма
+    сжатого файла и результат integrity_check.
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS backups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_name TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            pages INTEGER NOT NULL,
+            db_bytes INTEGER NOT NULL,
+            compressed_bytes INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            integrity TEXT NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_backups_created_at ON backups(created_at)")
+
+
+async def _key_inbound_links(db: aiosqlite.Connection):
+    """
+    Добавляет keys.inbound_row_id — инбаунд, на котором выдан ключ (его берет add_active_key
+    из резерва места), и переводит триггеры inbounds.clients_count на эту колонку.
+    Раньше триггеры относили ключ к первому инбаунду сервера с тем же протоколом, а сверка
+    счетчиков записывала общее число ключей сервера в каждый такой инбаунд.
+    """
+    await _ensure_column_exists(db, "keys", "inbound_row_id", "INTEGER")
+    await db.execute(f"UPDATE keys SET inbound_row_id = {_KEY_INBOUND_SQL.format(row='keys')} WHERE inbound_row_id IS NULL")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_keys_inbound_row_id ON keys(inbound_row_id)")
+
+    for trigger in ("trg_keys_insert_counters", "trg_keys_delete_counters", "trg_keys_update_inbound"):
+        await db.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    triggers = [
+        """
+        CREATE TRIGGER trg_keys_insert_counters AFTER INSERT ON keys
+        BEGIN
+            UPDATE users SET keys_count = COALESCE(keys_count, 0) + 1 WHERE user_id = NEW.user_id;
+            UPDATE inbounds SET clients_count = COALESCE(clients_count, 0) + 1 WHERE id = NEW.inbound_row_id;
+        END
+        """,
+        """
+        CREATE TRIGGER trg_keys_delete_counters AFTER DELETE ON keys
+        BEGIN
+            UPDATE users SET keys_count = MAX(COALESCE(keys_count, 0) - 1, 0) WHERE user_id = OLD.user_id;
+            UPDATE inbounds SET clients_count = MAX(COALESCE(clients_count, 0) - 1, 0) WHERE id = OLD.inbound_row_id;
+        END
+        """,
+        """
+        CREATE TRIGGER trg_keys_update_inbound AFTER UPDATE OF inbound_row_id ON keys
+        WHEN OLD.inbound_row_id IS NOT NEW.inbound_row_id
+        BEGIN
+            UPDATE inbounds SET clients_count = MAX(COALESCE(clients_count, 0) - 1, 0) WHERE id = OLD.inbound_row_id;
+            UPDATE inbounds SET clients_count = COALESCE(clients_count, 0) + 1 WHERE id = NEW.inbound_row_id;
+        END
+        """,
+    ]
+    for statement in triggers:
+        await db.execute(statement)
+
+    await db.execute("""
+        UPDATE inbounds SET clients_count = (
+            SELECT COUNT(*) FROM keys k WHERE k.inbound_row_id = inbounds.id
+        )
+    """)
+
+
+# Номер миграции, название, функция. Новые миграции добавляются только в конец списка.
+MIGRATIONS: List[Migration] = [
+    (1, "baseline_columns", _baseline_columns),
+    (2, "hot_table_indexes", _hot_table_indexes),
+    (3, "key_fields_columns", _key_fields_columns),
+    (4, "server_host_links", _server_host_links),
+    (5, "slot_reservations", _slot_reservations),
+    (6, "counter_triggers", _counter_triggers),
+    (7, "integer_key_expiry", _integer_key_expiry),
+    (8, "balance_ledger", _balance_ledger),
+    (9, "backup_metadata", _backup_metadata),
+    (10, "key_inbound_links", _key_inbound_links),
+]
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    """Возвращает номер последней примененной миграции (0, если миграций не было)."""
+    cursor = await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def run_migrations(db: aiosqlite.Connection) -> int:
+    """
+    Применяет миграции, которые еще не были применены к базе.
+
+    Каждая миграция выполняется в отдельной транзакции вместе с записью
+    в schema_migrations, поэтому при ошибке база остается на предыдущей версии.
+
+    Args:
+        db (aiosqlite.Connection): Соединение на запись
+
+    Returns:
+        int: Текущая версия схемы после применения миграций
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.commit()
+
+    current_version = await get_schema_version(db)
+    pending = [m for m in MIGRATIONS if m[0] > current_version]
+    if not pending:
+        logger.info(f"Схема базы данных актуальна (версия {current_version})")
+        return current_version
+
+    # Миграции пересоздают таблицы, а DROP TABLE с включенными внешними ключами
+    # каскадно удаляет связанные строки. PRAGMA нельзя менять внутри транзакции.
+    async with db.execute("PRAGMA foreign_keys") as cursor:
+        foreign_keys = (await cursor.fetchone())[0]
+    if foreign_keys:
+        await db.execute("PRAGMA foreign_keys = OFF")
+
+    try:
+        for version, name, migration in pending:
+            logger.info(f"Применяю миграцию {version}: {name}")
+            # DDL не открывает транзакцию неявно, поэтому BEGIN выполняем явно
+            await db.execute("BEGIN")
+            try:
+                await migration(db)
+                await db.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (?, ?)",
+                    (version, name)
+                )
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logger.error(f"Ошибка при применении миграции {version} ({name}): {e}")
+                raise
+            current_version = version
+    finally:
+        if foreign_keys:
+            await db.execute("PRAGMA foreign_keys = ON")
+
+    logger.info(f"Схема базы данных обновлена до версии {current_version}")
+    return current_version
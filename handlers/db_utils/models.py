@@ -0,0 +1,145 @@
+# handlers.db_utils.models.py
+"""
+Модели строк таблиц базы данных.
+
+Строки создаются фабрикой `Model.row_factory`, которая сопоставляет колонки
+курсора с полями по имени, поэтому порядок колонок в таблице и в SELECT
+не важен, а лишние колонки игнорируются. Для совместимости с кодом,
+который работал со словарями, модели поддерживают `row['field']`,
+`row.get('field')`, `keys()` и `dict(row)`.
+"""
+from dataclasses import dataclass
+from typing import Any, ClassVar
+
+
+class RowModel:
+    """Общая часть моделей: фабрика строк и доступ к полям как к ключам словаря."""
+
+    __slots__ = ()
+
+    # (класс, имена колонок курсора) -> индексы колонок в порядке полей модели (-1 — колонки нет)
+    _layouts: ClassVar[dict] = {}
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        """
+        row_factory для sqlite3/aiosqlite: `db.row_factory = User.row_factory`.
+        """
+        columns = tuple(column[0] for column in cursor.description)
+        layout = RowModel._layouts.get((cls, columns))
+        if layout is None:
+            positions = {name: index for index, name in enumerate(columns)}
+            layout = tuple(positions.get(name, -1) for name in cls.__dataclass_fields__)
+            RowModel._layouts[(cls, columns)] = layout
+        return cls(*[row[index] if index >= 0 else None for index in layout])
+
+    def __getitem__(self, name: str) -> Any:
+        if not isinstance(name, str) or name not in self.__dataclass_fields__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __contains__(self, name) -> bool:
+        return name in self.__dataclass_fields__
+
+    def get(self, name: str, default: Any = None) -> Any:
+        if name not in self.__dataclass_fields__:
+            return default
+        return getattr(self, name)
+
+    def keys(self):
+        return self.__dataclass_fields__.keys()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__dataclass_fields__}
+
+
+@dataclass(slots=True)
+class User(RowModel):
+    user_id: int | None = None
+    username: str | None = None
+    email: str | None = None
+    balance: int | None = None
+    subscription_type: str | None = None
+    subscription_end: str | None = None
+    is_admin: int | None = None
+    referrer_id: int | None = None
+    referral_count: int | None = None
+    keys_count: int | None = None
+    free_keys_count: int | None = None
+    promo_days: int | None = None
+    from_channel: str | None = None
+    pay_count: int | None = None
+    is_first_payment_done: int | None = None
+    is_banned: int | None = None
+
+
+@dataclass(slots=True)
+class Key(RowModel):
+    key: str | None = None
+    user_id: int | None = None
+    device_id: str | None = None
+    expiration_date: int | None = None
+    price: int | None = None
+    days: int | None = None
+    payment_id: str | None = None
+    name: str | None = None
+    protocol: str | None = None
+    server_ip: str | None = None
+    port: int | None = None
+    client_uuid: str | None = None
+    panel_email: str | None = None
+    unique_id: str | None = None
+    device_type: str | None = None
+    inbound_row_id: int | None = None
+
+
+@dataclass(slots=True)
+class Server(RowModel):
+    id: int | None = None
+    address: str | None = None
+    username: str | None = None
+    password: str | None = None
+    country: str | None = None
+    max_clients: int | None = None
+    is_active: int | None = None
+    host: str | None = None
+
+
+@dataclass(slots=True)
+class Inbound(RowModel):
+    id: int | None = None
+    server_id: int | None = None
+    server_address: str | None = None
+    inbound_id: int | None = None
+    protocol: str | None = None
+    clients_count: int | None = None
+    max_clients: int | None = None
+    pbk: str | None = None
+    sid: str | None = None
+    sni: str | None = None
+    port: int | None = None
+    utls: str | None = None
+
+
+@dataclass(slots=True)
+class Transaction(RowModel):
+    id: int | None = None
+    user_id: int | None = None
+    amount: int | None = None
+    status: str | None = None
+    transaction_id: str | None = None
+    created_at: str | None = None
+
+
+@dataclass(slots=True)
+class PaymentMethod(RowModel):
+    id: int | None = None
+    user_id: int | None = None
+    payment_method_id: str | None = None
+    issuer_name: str | None = None
+    title: str | None = None
+    when_valid: str | None = None
+    created_at: str | None = None
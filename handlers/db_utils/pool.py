@@ -0,0 +1,361 @@
+# handlers.db_utils.pool.py
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Callable
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class _UnitOfWorkConnection:
+    """
+    Соединение на запись внутри transaction(): commit() вложенных функций
+    откладывается до конца транзакции, остальные атрибуты берутся у соединения.
+    """
+
+    __slots__ = ('_db', '_pool')
+
+    def __init__(self, db: aiosqlite.Connection, pool: 'ConnectionPool'):
+        object.__setattr__(self, '_db', db)
+        object.__setattr__(self, '_pool', pool)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._db, name, value)
+
+    async def commit(self):
+        # Фиксация выполняется один раз при выходе из transaction()
+        pass
+
+    async def rollback(self):
+        # Откат во вложенной функции отменяет всю единицу работы
+        self._pool._rollback_only = True
+        await self._db.rollback()
+
+
+class ConnectionPool:
+    """
+    Пул долгоживущих соединений aiosqlite.
+
+    Держит одно соединение на запись (SQLite допускает только одного писателя)
+    и несколько соединений только на чтение. Соединения открываются один раз
+    при старте бота и переиспользуются всеми функциями БД, поэтому вызовы больше
+    не создают отдельный поток aiosqlite и не переоткрывают файл базы.
+
+    Соединение на запись реентерабельно в пределах одной задачи asyncio:
+    если задача уже держит writer, вложенные writer()/reader() отдают то же
+    соединение (вложенные функции видят незакоммиченные изменения и не
+    блокируют сами себя).
+
+    transaction() объединяет записи нескольких функций в одну транзакцию
+    с одним commit в конце.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        readers: int = 4,
+        acquire_timeout: float = 30.0,
+        pragmas: dict | None = None,
+        attach: dict | None = None,
+    ):
+        """
+        Args:
+            db_path (str): Путь к файлу базы данных
+            readers (int): Количество соединений на чтение
+            acquire_timeout (float): Максимальное время ожидания свободного соединения в секундах
+            pragmas (dict | None): PRAGMA, которые выполняются на каждом соединении
+                при открытии (имя -> значение), в порядке словаря
+            attach (dict | None): Базы, которые присоединяются к соединениям на чтение
+                (псевдоним -> путь), чтобы запросы могли читать их таблицы. К writer они
+                не присоединяются: BEGIN IMMEDIATE блокирует на запись все присоединенные файлы
+        """
+        if readers < 1:
+            raise ValueError("Пул должен содержать хотя бы одно соединение на чтение")
+
+        self.db_path = db_path
+        self.readers_size = readers
+        self.acquire_timeout = acquire_timeout
+        self.pragmas = dict(pragmas or {})
+        self.attach = dict(attach or {})
+
+        self._writer: aiosqlite.Connection | None = None
+        self._writer_lock = asyncio.Lock()
+        self._writer_owner: asyncio.Task | None = None
+        self._in_transaction = False
+        self._rollback_only = False
+        self._after_commit: list[Callable[[], None]] = []
+        self._readers: asyncio.Queue | None = None
+        self._connections: list[aiosqlite.Connection] = []
+        self._open_lock = asyncio.Lock()
+
+        self._stats = {
+            kind: {'acquired': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'timeouts': 0}
+            for kind in ('reader', 'writer')
+        }
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    @property
+    def in_transaction(self) -> bool:
+        """Идет ли сейчас единица работы transaction() (ее изменения еще могут откатиться)."""
+        return self._in_transaction
+
+    def after_commit(self, callback: Callable[[], None]):
+        """
+        Выполняет callback после фиксации изменений текущей задачи.
+
+        Внутри transaction() вызов откладывается до ее commit и отбрасывается
+        при откате; вне единицы работы callback выполняется сразу. Так побочные
+        эффекты записи (кэши в памяти, очереди BatchWriter) не применяются
+        к изменениям, которые еще могут откатиться.
+        """
+        if self._in_transaction and self._owns_writer():
+            self._after_commit.append(callback)
+        else:
+            callback()
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        """Открывает и настраивает одно соединение пула."""
+        db = await aiosqlite.connect(self.db_path)
+        try:
+            for name, value in self.pragmas.items():
+                async with db.execute(f"PRAGMA {name} = {value}") as cursor:
+                    row = await cursor.fetchone()
+                # journal_mode возвращает итоговый режим: для :memory: WAL недоступен
+                if name == 'journal_mode' and row and str(row[0]).lower() != str(value).lower():
+                    logger.warning(f"Не удалось включить journal_mode={value}, текущий режим: {row[0]}")
+            if read_only:
+                for alias, path in self.attach.items():
+                    await db.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+                await db.execute("PRAGMA query_only = ON")
+        except Exception:
+            await db.close()
+            raise
+        return db
+
+    async def open(self):
+        """
+        Открывает соединения пула. Повторный вызов ничего не делает.
+        """
+        async with self._open_lock:
+            if self.is_open:
+                return
+
+            # Сначала writer: он создает файл базы, если его еще нет
+            writer = await self._connect()
+            connections = [writer]
+            readers = asyncio.Queue()
+            try:
+                for _ in range(self.readers_size):
+                    reader = await self._connect(read_only=True)
+                    connections.append(reader)
+                    readers.put_nowait(reader)
+            except Exception:
+                for db in connections:
+                    await db.close()
+                raise
+
+            self._writer = writer
+            self._readers = readers
+            self._connections = connections
+            logger.info(
+                f"Пул соединений открыт: {self.db_path}, "
+                f"1 writer + {self.readers_size} readers"
+            )
+
+    async def close(self):
+        """
+        Закрывает все соединения пула. Незакоммиченные изменения откатываются.
+        """
+        async with self._open_lock:
+            if not self.is_open:
+                return
+
+            # Дожидаемся завершения текущей записи
+            async with self._writer_lock:
+                for db in self._connections:
+                    try:
+                        await db.close()
+                    except Exception as e:
+                        logger.error(f"Ошибка при закрытии соединения с БД: {e}")
+
+                self._writer = None
+                self._readers = None
+                self._connections = []
+
+            logger.info(f"Пул соединений закрыт. Статистика: {self.get_stats()}")
+
+    async def _ensure_open(self):
+        if not self.is_open:
+            await self.open()
+
+    def _record_wait(self, kind: str, waited: float):
+        stats = self._stats[kind]
+        stats['acquired'] += 1
+        stats['wait_total'] += waited
+        if waited > stats['wait_max']:
+            stats['wait_max'] = waited
+
+    def get_stats(self) -> dict:
+        """
+        Возвращает счетчики пула.
+
+        Returns:
+            dict: {'reader': {...}, 'writer': {...}, 'readers_idle': int}, где для каждого
+            типа соединения указаны количество выдач, суммарное, среднее и максимальное
+            время ожидания (в миллисекундах) и число таймаутов
+        """
+        result = {}
+        for kind, stats in self._stats.items():
+            acquired = stats['acquired']
+            result[kind] = {
+                'acquired': acquired,
+                'timeouts': stats['timeouts'],
+                'wait_total_ms': round(stats['wait_total'] * 1000, 3),
+                'wait_avg_ms': round(stats['wait_total'] * 1000 / acquired, 3) if acquired else 0.0,
+                'wait_max_ms': round(stats['wait_max'] * 1000, 3),
+            }
+        result['readers_idle'] = self._readers.qsize() if self._readers is not None else 0
+        return result
+
+    def _owns_writer(self) -> bool:
+        return self._writer_owner is not None and self._writer_owner is asyncio.current_task()
+
+    @asynccontextmanager
+    async def writer(self):
+        """
+        Выдает соединение на запись.
+
+        Незакоммиченные изменения откатываются при выходе из внешнего контекста,
+        как это происходило при закрытии отдельного соединения.
+        """
+        if self._owns_writer():
+            # Вложенный вызов из той же задачи — отдаем то же соединение
+            db = self._writer
+            previous_factory = db.row_factory
+            db.row_factory = None
+            try:
+                yield _UnitOfWorkConnection(db, self) if self._in_transaction else db
+            finally:
+                db.row_factory = previous_factory
+            return
+
+        await self._ensure_open()
+        started = time.perf_counter()
+        try:
+            async with asyncio.timeout(self.acquire_timeout):
+                await self._writer_lock.acquire()
+        except TimeoutError:
+            self._stats['writer']['timeouts'] += 1
+            logger.error(f"Не удалось получить соединение на запись за {self.acquire_timeout} с")
+            raise
+        self._record_wait('writer', time.perf_counter() - started)
+
+        db = self._writer
+        self._writer_owner = asyncio.current_task()
+        db.row_factory = None
+        try:
+            yield db
+        finally:
+            try:
+                if db.in_transaction:
+                    await db.rollback()
+            finally:
+                db.row_factory = None
+                self._writer_owner = None
+                self._writer_lock.release()
+
+    @asynccontextmanager
+    async def reader(self, attached: bool = False):
+        """
+        Выдает соединение только на чтение.
+
+        Если текущая задача держит соединение на запись, возвращается оно —
+        так чтение видит собственные незакоммиченные изменения.
+
+        Args:
+            attached (bool): Запросу нужны присоединенные базы (self.attach).
+                Они подключены только к читателям, поэтому в этом случае всегда
+                выдается настоящий читатель, даже внутри writer() и transaction();
+                незакоммиченные изменения текущей задачи такой запрос не видит.
+        """
+        if self._owns_writer() and not (attached and self.attach):
+            async with self.writer() as db:
+                yield db
+            return
+
+        await self._ensure_open()
+        started = time.perf_counter()
+        try:
+            async with asyncio.timeout(self.acquire_timeout):
+                db = await self._readers.get()
+        except TimeoutError:
+            self._stats['reader']['timeouts'] += 1
+            logger.error(f"Не удалось получить соединение на чтение за {self.acquire_timeout} с")
+            raise
+        self._record_wait('reader', time.perf_counter() - started)
+
+        db.row_factory = None
+        try:
+            yield db
+        finally:
+            try:
+                if db.in_transaction:
+                    await db.rollback()
+            finally:
+                db.row_factory = None
+                self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Единица работы: все записи внутри контекста, включая вызовы функций БД,
+        которые сами берут writer() и вызывают commit(), выполняются в одной
+        транзакции и фиксируются одним commit при выходе.
+
+        При исключении или вызове rollback() внутри контекста откатывается вся
+        транзакция. Побочные эффекты, зарегистрированные через after_commit(),
+        выполняются только после успешного commit. Вложенный transaction() присоединяется к внешнему.
+        Внутри не должно быть сетевых запросов: writer занят до конца контекста.
+
+        Присоединенные базы (self.attach) к writer не подключаются: чтение их
+        таблиц внутри единицы работы должно идти через reader(attached=True).
+        """
+        if self._in_transaction and self._owns_writer():
+            async with self.writer() as db:
+                yield db
+            return
+
+        async with self.writer() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            self._in_transaction = True
+            self._rollback_only = False
+            self._after_commit = []
+            try:
+                yield _UnitOfWorkConnection(db, self)
+                if self._rollback_only:
+                    raise RuntimeError("Транзакция отменена вызовом rollback() внутри единицы работы")
+                await db.commit()
+            except BaseException:
+                if db.in_transaction:
+                    await db.rollback()
+                raise
+            finally:
+                self._in_transaction = False
+                self._rollback_only = False
+                callbacks, self._after_commit = self._after_commit, []
+
+        # Изменения зафиксированы (при исключении сюда не доходим)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике after_commit: {e}", exc_info=True)
@@ -0,0 +1,76 @@
+# handlers.db_utils.query_plans.py
+"""
+Запросы по сроку действия ключей, которые должны читать keys по индексу,
+а не полным проходом. Функции handlers.database выполняют именно эти константы. Планы проверяются тестом tests/test_expiry_query_plans.py
+и при запуске бота (check_expiry_query_plans в handlers.database).
+"""
+import aiosqlite
+
+# Ключи, срок которых попадает в полуинтервал [?, ?) (check_expiring_subscriptions и др.)
+EXPIRING_KEYS_SQL = """
+    SELECT *
+    FROM   keys
+    WHERE  expiration_date >= ? AND expiration_date < ?
+"""
+
+# Ключи со сроком раньше границы (get_all_keys_to_expire)
+KEYS_TO_EXPIRE_SQL = """
+    SELECT *
+    FROM   keys
+    WHERE  expiration_date < ?
+"""
+
+# Названия истекших ключей (remove_expired_keys, cleanup_expired_keys)
+EXPIRED_KEY_NAMES_SQL = """
+    SELECT key FROM keys
+    WHERE expiration_date < ?
+"""
+
+# Ближайший срок действующих ключей пользователя (get_next_expiration_date)
+NEXT_EXPIRATION_SQL = """
+    SELECT MIN(expiration_date)
+    FROM keys
+    WHERE user_id = ? AND expiration_date > ?
+"""
+
+# Пользователи с ключами, срок которых в интервале (?, ?) (get_users_with_expiring_subscriptions)
+USERS_WITH_EXPIRING_KEYS_SQL = """
+    SELECT DISTINCT user_id FROM keys
+    WHERE expiration_date > ?
+    AND expiration_date < ?
+    AND user_id IS NOT NULL
+"""
+
+# Пользователи с балансом ? без действующих ключей (get_users_with_specific_balance)
+USERS_WITHOUT_ACTIVE_KEYS_SQL = """
+    SELECT user_id FROM users
+    WHERE balance = ?
+    AND NOT EXISTS (
+        SELECT 1 FROM keys
+        WHERE keys.user_id = users.user_id
+        AND expiration_date > ?
+    )
+"""
+
+# Название -> (запрос, индекс, по которому он должен читать keys)
+EXPIRY_QUERIES = {
+    'expiring_range': (EXPIRING_KEYS_SQL, 'idx_keys_expiration_date'),
+    'keys_to_expire': (KEYS_TO_EXPIRE_SQL, 'idx_keys_expiration_date'),
+    'expired_key_names': (EXPIRED_KEY_NAMES_SQL, 'idx_keys_expiration_date'),
+    'next_expiration': (NEXT_EXPIRATION_SQL, 'idx_keys_user_expiration'),
+    'users_with_expiring': (USERS_WITH_EXPIRING_KEYS_SQL, 'idx_keys_expiration_date'),
+    'users_without_active': (USERS_WITHOUT_ACTIVE_KEYS_SQL, 'idx_keys_user_expiration'),
+}
+
+async def explain_query_plan(db: aiosqlite.Connection, query: str) -> list[str]:
+    """Возвращает строки EXPLAIN QUERY PLAN запроса (параметры заменяются нулями)."""
+    params = (0,) * query.count('?')
+    async with db.execute(f"EXPLAIN QUERY PLAN {query}", params) as cursor:
+        return [row[3] async for row in cursor]
+
+
+def reads_keys_by_index(details: list[str], index: str) -> bool:
+    """True, если план не проходит keys целиком и читает ее по индексу index."""
+    if any(detail.startswith('SCAN keys') for detail in details):
+        return False
+    return any(f"INDEX {index} " in f"{detail} " for detail in details)
@@ -1,6 +1,8 @@
 # handlers.db_utils.server_utils.py
 import aiosqlite
-from handlers.database import DB_PATH
+from handlers.database import db_pool
+from handlers.db_utils.models import Inbound
+from handlers.utils import normalize_server_host
 import logging
 
 logger = logging.getLogger(__name__)
@@ -10,7 +12,7 @@ async def get_servers_with_total_clients():
     """
     Получает список серверов с суммарным количеством клиентов по всем инбаундам
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         db.row_factory = aiosqlite.Row
         
         cursor = await db.execute("""
@@ -24,7 +26,7 @@ async def get_servers_with_total_clients():
                 COALESCE(SUM(i.clients_count), 0) as total_clients,
                 COALESCE(SUM(i.max_clients), 0) as total_max_clients
             FROM servers s
-            LEFT JOIN inbounds i ON TRIM(LOWER(s.address)) = TRIM(LOWER(i.server_address))
+            LEFT JOIN inbounds i ON i.server_id = s.id
             GROUP BY s.id, s.address, s.username, s.password, s.country, s.is_active
             ORDER BY s.id ASC
         """)
@@ -37,19 +39,19 @@ async def get_inbound_info(address: str, protocol: str):
     """
     Получает информацию об инбаунде по адресу сервера и протоколу
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with db_pool.reader() as db:
+        db.row_factory = Inbound.row_factory
         cursor = await db.execute("""
             SELECT * FROM inbounds 
-            WHERE server_address = ? AND protocol = ?
-        """, (address, protocol))
+            WHERE server_id IN (SELECT id FROM servers WHERE host = ?) AND protocol = ?
+        """, (normalize_server_host(address), protocol))
         return await cursor.fetchone()
     
 async def update_inbound_max_clients(server_id: int, inbound_id: int, new_max_clients: int):
     """
     Обновляет максимальное количество клиентов для конкретного инбаунда
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE inbounds 
             SET max_clients = ? 
@@ -61,31 +63,31 @@ async def get_server_inbounds(server_address: str):
     """
     Получает все инбаунды для конкретного сервера
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with db_pool.reader() as db:
+        db.row_factory = Inbound.row_factory
         cursor = await db.execute("""
             SELECT * FROM inbounds 
-            WHERE server_address = ?
-        """, (server_address,))
+            WHERE server_id IN (SELECT id FROM servers WHERE host = ?)
+        """, (normalize_server_host(server_address),))
         return await cursor.fetchall()
 
 async def get_server_inbound(server_address: str):
     """
     Получает информацию об инбаунде сервера
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with db_pool.reader() as db:
+        db.row_factory = Inbound.row_factory
         cursor = await db.execute("""
             SELECT * FROM inbounds 
-            WHERE server_address = ?
-        """, (server_address,))
+            WHERE server_id IN (SELECT id FROM servers WHERE host = ?)
+        """, (normalize_server_host(server_address),))
         return await cursor.fetchone()
     
 async def update_inbound_protocol(inbound_id: int, protocol: str):
     """
     Обновляет протокол для конкретного инбаунда
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE inbounds 
             SET protocol = ? 
@@ -97,7 +99,7 @@ async def update_inbound_id(inbound_id: int, new_inbound_id: int):
     """
     Обновляет inbound_id для конкретного инбаунда
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE inbounds 
             SET inbound_id = ? 
@@ -109,7 +111,7 @@ async def update_inbound_port(inbound_id: int, new_port: int):
     """
     Обновляет порт для конкретного инбаунда
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE inbounds 
             SET port = ? 
@@ -121,7 +123,7 @@ async def update_inbound_sni(inbound_id: int, new_sni: str):
     """
     Обновляет SNI для конкретного инбаунда
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE inbounds 
             SET sni = ? 
@@ -133,7 +135,7 @@ async def update_inbound_pbk(inbound_id: int, new_pbk: str):
     """
     Обновляет pbk для конкретного инбаунда
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE inbounds 
             SET pbk = ? 
@@ -145,7 +147,7 @@ async def update_inbound_utls(inbound_id: int, new_utls: str):
     """
     Обновляет utls для конкретного инбаунда
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE inbounds 
             SET utls = ? 
@@ -157,7 +159,7 @@ async def update_inbound_sid(inbound_id: int, new_sid: str):
     """
     Обновляет sid для конкретного инбаунда
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE inbounds 
             SET sid = ? 
@@ -169,19 +171,19 @@ async def update_inbound_clients_count(address: str, protocol: str, count: int):
     """
     Обновляет количество клиентов для инбаунда
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("""
             UPDATE inbounds 
             SET clients_count = ?
-            WHERE server_address = ? AND protocol = ?
-        """, (count, address, protocol))
+            WHERE server_id IN (SELECT id FROM servers WHERE host = ?) AND protocol = ?
+        """, (count, normalize_server_host(address), protocol))
         await db.commit()
 
 async def add_inbound(inbound_data: dict):
     """
     Добавляет новый инбаунд для сервера с дополнительными параметрами
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         try:
             # Проверяем существование сервера
             cursor = await db.execute(
@@ -189,6 +191,13 @@ async def add_inbound(inbound_data: dict):
                 (inbound_data['server_address'],)
             )
             server = await cursor.fetchone()
+            if not server:
+                # Адрес мог быть введен с другим регистром или без порта панели
+                cursor = await db.execute(
+                    "SELECT id FROM servers WHERE host = ? ORDER BY id LIMIT 1",
+                    (normalize_server_host(inbound_data['server_address']),)
+                )
+                server = await cursor.fetchone()
             if not server:
                 raise ValueError(f"Сервер {inbound_data['server_address']} не найден")
             
@@ -197,8 +206,8 @@ async def add_inbound(inbound_data: dict):
             # Проверяем существование инбаунда
             cursor = await db.execute("""
                 SELECT id FROM inbounds 
-                WHERE server_address = ? AND protocol = ?
-            """, (inbound_data['server_address'], inbound_data['protocol']))
+                WHERE server_id = ? AND protocol = ?
+            """, (server_id, inbound_data['protocol']))
             
             if await cursor.fetchone():
                 raise ValueError(f"Инбаунд с protocol={inbound_data['protocol']} уже существует на сервере {inbound_data['server_address']}")
@@ -233,7 +242,7 @@ async def remove_inbound(inbound_id: int):
     """
     Удаляет инбаунд из базы данных
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("DELETE FROM inbounds WHERE id = ?", (inbound_id,))
         await db.commit()
 
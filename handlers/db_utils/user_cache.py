@@ -0,0 +1,110 @@
+# handlers.db_utils.user_cache.py
+import copy
+import time
+from collections import OrderedDict
+from typing import Iterable
+
+
+def _cache_key(user_id):
+    # user_id приходит и числом, и строкой из callback data
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return user_id
+
+
+class UserCache:
+    """
+    LRU-кэш строк пользователей (user_id -> User) с ограниченным временем жизни.
+
+    Функции, которые меняют строку пользователя, вызывают invalidate().
+    Чтобы чтение, начатое до изменения, не положило в кэш устаревшие данные,
+    запись в кэш принимается только если с момента начала чтения не было
+    инвалидаций (см. generation).
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        """
+        Args:
+            maxsize (int): Максимальное количество пользователей в кэше
+            ttl (float): Время жизни записи в секундах
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    @property
+    def generation(self) -> int:
+        """Счетчик инвалидаций; запоминается перед чтением из БД и передается в set()."""
+        return self._generation
+
+    def get(self, user_id) -> dict | None:
+        """
+        Возвращает копию закэшированной строки или None, если ее нет или она устарела.
+        """
+        user_id = _cache_key(user_id)
+        entry = self._data.get(user_id)
+        if entry is None:
+            self._stats['misses'] += 1
+            return None
+
+        row, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._data[user_id]
+            self._stats['misses'] += 1
+            return None
+
+        self._data.move_to_end(user_id)
+        self._stats['hits'] += 1
+        return copy.copy(row)
+
+    def set(self, user_id, row, generation: int):
+        """
+        Сохраняет строку пользователя, если после чтения не было инвалидаций.
+
+        Args:
+            user_id: ID пользователя
+            row (User): Строка пользователя
+            generation (int): Значение generation до начала чтения из БД
+        """
+        if generation != self._generation:
+            return
+        user_id = _cache_key(user_id)
+        self._data[user_id] = (copy.copy(row), time.monotonic())
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def invalidate(self, *user_ids):
+        """Удаляет из кэша строки указанных пользователей."""
+        self.invalidate_many(user_ids)
+
+    def invalidate_many(self, user_ids: Iterable):
+        """Удаляет из кэша строки всех пользователей из списка."""
+        self._generation += 1
+        for user_id in user_ids:
+            if self._data.pop(_cache_key(user_id), None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        """Очищает кэш целиком (после массовых изменений таблицы users)."""
+        self._generation += 1
+        self._stats['invalidations'] += len(self._data)
+        self._data.clear()
+
+    def get_stats(self) -> dict:
+        """
+        Возвращает счетчики кэша.
+
+        Returns:
+            dict: Попадания, промахи, доля попаданий, инвалидации, вытеснения и текущий размер
+        """
+        lookups = self._stats['hits'] + self._stats['misses']
+        return {
+            **self._stats,
+            'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else 0.0,
+            'size': len(self._data),
+        }
@@ -0,0 +1,15 @@
+# handlers.filters.py
+from aiogram.filters import BaseFilter
+from aiogram.types import CallbackQuery, Message
+
+from handlers.database import is_admin_id
+
+
+class IsAdmin(BaseFilter):
+    """
+    Пропускает апдейты только от администраторов.
+    Проверка идет по набору ID в памяти (handlers.database.load_admins), без запроса к БД
+    """
+
+    async def __call__(self, event: Message | CallbackQuery) -> bool:
+        return event.from_user is not None and is_admin_id(event.from_user.id)
@@ -14,11 +14,13 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import FSInputFile, Message, ReplyKeyboardMarkup, KeyboardButton, InputMediaPhoto
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardButton
+from openpyxl import Workbook
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from py3xui import AsyncApi, Client
+from py3xui import Client
 from apscheduler.triggers.cron import CronTrigger
 import string
 import hashlib
+from handlers.api import panel_sessions
 from handlers.classes import (
     AdminBroadcastStates,
     AdminKeyRemovalStates,
@@ -32,6 +34,7 @@ from handlers.classes import (
     KeyNameStates
 )
 from handlers.database import (
+    db_pool,
     delete_payment_method_by_id,
     remove_active_key,
     update_key_days_price,
@@ -50,9 +53,9 @@ from handlers.database import (
     check_user_used_promocode,
     delete_server,
     get_admins,
-    get_all_promocodes,
     get_all_servers,
-    get_all_users,
+    get_promocodes_page,
+    get_servers_page,
     get_api_instance,
     get_available_countries,
     get_free_days,
@@ -69,11 +72,15 @@ from handlers.database import (
     get_user_by_username,
     get_user_email,
     get_user_keys,
+    get_user_keys_page,
+    release_server_slot,
     remove_key_bd,
+    remove_keys,
     remove_promocode,
     save_or_update_email,
     set_free_keys_count,
-    update_balance,
+    credit_balance,
+    debit_balance,
     update_free_keys_count,
     update_key_expiry_date,
     update_keys_count,
@@ -82,7 +89,7 @@ from handlers.database import (
     update_server_clients_count,
     update_server_info,
     update_subscription,
-    get_user_transactions,
+    get_user_transactions_page,
     add_transaction,
     update_transaction_status,
     get_transaction_by_id,
@@ -93,13 +100,18 @@ from handlers.database import (
     update_user_pay_count,
     get_system_statistics,
     get_channel_statistics,
-    get_user_segments,
-    get_users_with_unused_free_keys,
+    get_referral_income,
+    iter_all_users,
+    iter_user_ids,
+    iter_users_by_server_address,
+    iter_users_with_expiring_subscriptions,
+    iter_users_with_specific_balance,
+    iter_users_with_unused_free_keys,
+    iter_users_with_zero_traffic_keys,
     add_payment_method,
     get_user_payment_methods,
     delete_payment_method,
     get_payment_method_by_id,
-    get_users_by_server_address,
     sync_payment_id_for_all_keys,
     get_payment_id_for_key,
     set_payment_id_for_key,
@@ -108,6 +120,7 @@ from handlers.database import (
     update_key_expiration,
     update_key_name,
 )
+from handlers.filters import IsAdmin
 from handlers.db_utils.server_utils import (
     add_inbound,
     get_server_inbounds,
@@ -126,6 +139,8 @@ from handlers.payments import check_payment_status, create_payment, check_transa
 from handlers.utils import (
     extract_key_data,
     generate_random_string,
+    page_nav_buttons,
+    parse_page_cursor,
     send_info_for_admins,
     send_channel_log
 )
@@ -340,19 +355,21 @@ async def start_command(message: types.Message, bot: Bot, state: FSMContext):
         existing_user = await get_user(user_id=message.from_user.id if message.from_user else None)
         if not existing_user:
 
-                await add_or_update_user(
-                    user_id=message.from_user.id,
-                    username=message.from_user.username or f"None{random.randint(10, 999)}",  # Используем f-string
-                    subscription_type="Без подписки",
-                    is_admin=False,
-                    balance=0,
-                    subscription_end=None,
-                    referrer_id=referrer_id
-                )
-                await add_referral_bonus(referrer_id, 50)
-                await update_referral_count(referrer_id)
+                # Регистрация и начисления рефереру фиксируются одной транзакцией
+                async with db_pool.transaction():
+                    await add_or_update_user(
+                        user_id=message.from_user.id,
+                        username=message.from_user.username or f"None{random.randint(10, 999)}",  # Используем f-string
+                        subscription_type="Без подписки",
+                        is_admin=False,
+                        balance=0,
+                        subscription_end=None,
+                        referrer_id=referrer_id
+                    )
+                    await add_referral_bonus(referrer_id, 50, referral_id=message.from_user.id)
+                    await update_referral_count(referrer_id)
 
-                referrer = await get_user(user_id=referrer_id)
+                    referrer = await get_user(user_id=referrer_id)
                 if referrer:
                     kb = InlineKeyboardBuilder()
                     kb.button(text="◀️ Вернуться в меню", callback_data="back_to_menu")
@@ -567,7 +584,7 @@ async def check_subscription(callback: types.CallbackQuery, bot: Bot, state: FSM
                     )
                     
                     # Начисляем бонус рефереру
-                    await add_referral_bonus(referrer_id, 50)
+                    await add_referral_bonus(referrer_id, 50, referral_id=callback.from_user.id)
                     await update_referral_count(referrer_id)
                     
                     # Уведомляем реферера
@@ -850,14 +867,24 @@ async def process_promocode(message: Message, state: FSMContext):
         if current_time <= expiration_date:
             # Проверяем, можно ли еще использовать промокод
             if promo_amount > 0:
-                user = await get_user(user_id=message.from_user.id)
-                
                 kb = InlineKeyboardBuilder()
 
-                
-                # Начисляем бонусы
-                new_balance = user['balance'] + gift_balance
-                await update_balance(message.from_user.id, new_balance)
+                # Начисляем бонусы; ключ операции не даст активировать промокод дважды,
+                # даже если два сообщения с ним обрабатываются одновременно
+                new_balance = await credit_balance(
+                    message.from_user.id, gift_balance, "promocode",
+                    idempotency_key=f"promocode:{promo_id}:{message.from_user.id}"
+                )
+                if new_balance is None:
+                    kb.button(text="◀️ Вернуться в профиль", callback_data="profile")
+                    await message.answer(
+                        "❌ <b>Промокод уже использован</b>\n\n"
+                        "Вы ранее активировали этот промокод.",
+                        reply_markup=kb.as_markup(),
+                        parse_mode="HTML"
+                    )
+                    await state.clear()
+                    return
                 
                 # Уменьшаем количество использований промокода
                 await update_promocode_amount(promo_id)
@@ -1152,8 +1179,8 @@ async def device_guide(callback: types.CallbackQuery):
     # Фильтруем ключи для выбранного устройства с учетом нормализации
     device_keys = [
         key for key in user_keys 
-        if (key[1].lower() == normalized_device or 
-            any(key[1].lower().startswith(alias) for alias in device_mapping.keys()))
+        if (key.device_id.lower() == normalized_device or 
+            any(key.device_id.lower().startswith(alias) for alias in device_mapping.keys()))
     ]
     
     if not device_keys:
@@ -1670,12 +1697,16 @@ async def cancel_payment_method(callback: types.CallbackQuery, bot: Bot):
 
 
 
-@router.callback_query(F.data == "transactions")
+@router.callback_query(F.data.startswith("transactions"))
 async def get_transactions(callback: types.CallbackQuery, bot: Bot):
     """
-    Отображает список транзакций пользователя в виде кнопок
+    Отображает страницу транзакций пользователя в виде кнопок
     """
-    transactions = await get_user_transactions(callback.from_user.id)
+    TRANSACTIONS_PER_PAGE = 10
+    after, before = parse_page_cursor(callback.data, "transactions")
+    transactions, prev_cursor, next_cursor = await get_user_transactions_page(
+        callback.from_user.id, TRANSACTIONS_PER_PAGE, after=after, before=before
+    )
     kb = InlineKeyboardBuilder()
     
     if transactions:
@@ -1693,10 +1724,13 @@ async def get_transactions(callback: types.CallbackQuery, bot: Bot):
             )
     else:
         kb.button(text="Нет транзакций", callback_data="profile")
-        
-    kb.button(text="◀️ Назад", callback_data="profile")
     kb.adjust(1)
     
+    nav_buttons = page_nav_buttons("transactions", prev_cursor, next_cursor)
+    if nav_buttons:
+        kb.row(*nav_buttons)
+    kb.row(InlineKeyboardButton(text="◀️ Назад", callback_data="profile"))
+    
     await callback.message.edit_media(
         media=InputMediaPhoto(
             media=FSInputFile("handlers/images/10banner.png"),
@@ -1712,10 +1746,9 @@ async def show_transaction_details(callback: types.CallbackQuery, state: FSMCont
     Показывает детали конкретной транзакции
     """
     transaction_id = callback.data.split('_')[1]
-    transactions = await get_user_transactions(callback.from_user.id)
-    transaction = next((tx for tx in transactions if tx['transaction_id'] == transaction_id), None)
+    transaction = await get_transaction_by_id(transaction_id)
     
-    if not transaction:
+    if not transaction or transaction['user_id'] != callback.from_user.id:
         await callback.answer("Транзакция не найдена", show_alert=True)
         return
     
@@ -1821,12 +1854,14 @@ async def check_user_transaction(callback: types.CallbackQuery, state: FSMContex
         elif new_status == 'succeeded':
             if current_transaction['status'] != 'succeeded':
                 await update_transaction_status(transaction_id=transaction_id, new_status="succeeded")
-                await update_balance(callback.from_user.id, amount)
+                # Платеж зачисляется один раз, даже если его параллельно подтвердила другая проверка
+                credited = await credit_balance(
+                    callback.from_user.id, int(amount), "deposit", idempotency_key=f"deposit:{transaction_id}"
+                )
+                user = await get_user(user_id=callback.from_user.id)
+                first_deposit = await get_is_first_payment_done(user['user_id'])
 
                 if payment: 
-                    user = await get_user(user_id=callback.from_user.id)
-                    first_deposit = await get_is_first_payment_done(user['user_id'])
-
                     if payment.payment_method.saved:
                         if not first_deposit:
                             await sync_payment_id_for_all_keys(user['user_id'], payment.payment_method.id)
@@ -1845,11 +1880,14 @@ async def check_user_transaction(callback: types.CallbackQuery, state: FSMContex
                         await state.update_data(saved_id=payment.payment_method.id)
                         await state.set_state(SubscriptionStates.waiting_for_payment_method_name)
                 # Проверка и начисление реферальных бонусов
-                if user['referrer_id']:
+                if credited is not None and user['referrer_id']:
                     referrer = await get_user(user_id=user['referrer_id'])
 
                     bonus_percentage = 0.5 if first_deposit else 0.3
-                    await update_balance(referrer['user_id'], int(referrer['balance']) + int(amount) * bonus_percentage)
+                    bonus = int(int(amount) * bonus_percentage)
+                    await credit_balance(
+                        user['referrer_id'], bonus, "referral_bonus", idempotency_key=f"referral_bonus:{transaction_id}"
+                    )
 
                     try:
                         kb.button(text="◀️ Вернуться в меню", callback_data="back_to_menu")
@@ -1857,7 +1895,7 @@ async def check_user_transaction(callback: types.CallbackQuery, state: FSMContex
                             user['referrer_id'],
                             f"🎉 <b>Поздравляем!</b>\n\n"
                             f"Ваш реферал пополнил баланс на сумму {amount}₽\n"
-                            f"Вам начислен бонус: <b>{int(amount) * bonus_percentage}₽</b> ({bonus_percentage * 100}%)",
+                            f"Вам начислен бонус: <b>{bonus}₽</b> ({bonus_percentage * 100}%)",
                             parse_mode="HTML",
                             reply_markup=kb.as_markup()
                         )
@@ -1926,7 +1964,7 @@ async def active_keys(callback: types.CallbackQuery, bot: Bot):
 
         device_counts = {}
         for key in user_keys:
-            original_device = key[1].lower()
+            original_device = key.device_id.lower()
             
             # Упорядоченный список замен (от длинных к коротким)
             replacements = [
@@ -2034,10 +2072,10 @@ async def change_key_name(callback: types.CallbackQuery, state: FSMContext):
     
     # Добавляем кнопку для каждого ключа
     for key_data in user_keys:
-        key = key_data[0]            # key
-        device_id = key_data[1]      # device_id
-        expiration_date = key_data[2] # expiration_date
-        name = key_data[3]           # name
+        key = key_data.key
+        device_id = key_data.device_id
+        expiration_date = key_data.expiration_date
+        name = key_data.name
         
         # Определяем протокол
         protocol = 'Shadowsocks' if key.startswith('ss://') else 'VLESS'
@@ -2171,10 +2209,10 @@ async def change_key_protocol(callback: types.CallbackQuery, state: FSMContext):
     # Добавляем кнопку только для ключей Shadowsocks (разрешена смена только SS -> VLESS)
     shadowsocks_keys = []
     for key_data in user_keys:
-        key = key_data[0]            # key
-        device_id = key_data[1]      # device_id
-        expiration_date = key_data[2] # expiration_date
-        name = key_data[3]           # name
+        key = key_data.key
+        device_id = key_data.device_id
+        expiration_date = key_data.expiration_date
+        name = key_data.name
         
         # Определяем протокол
         protocol = 'Shadowsocks' if key.startswith('ss://') else 'VLESS'
@@ -2274,6 +2312,7 @@ async def process_protocol_change(callback: types.CallbackQuery, state: FSMConte
         await callback.answer("Ключ не найден. Попробуйте еще раз.")
         return
     
+    reservation_id = None
     try:
         # Устанавливаем индикатор загрузки
         await callback.message.edit_caption(
@@ -2293,7 +2332,7 @@ async def process_protocol_change(callback: types.CallbackQuery, state: FSMConte
             raise Exception("Не удалось найти сервер для данного ключа")
         
         # 1. Создание нового клиента с противоположным протоколом
-        api, server_address, pbk, sid, sni, port, utls, new_protocol, country, inbound_id = await get_api_instance(
+        api, server_address, pbk, sid, sni, port, utls, new_protocol, country, inbound_id, reservation_id = await get_api_instance(
             country=server['country'],
             use_shadowsocks=(current_protocol == 'vless')  # Меняем протокол на противоположный
         )
@@ -2357,16 +2396,10 @@ async def process_protocol_change(callback: types.CallbackQuery, state: FSMConte
             raise Exception("Не удалось создать нового клиента на сервере")
         
         # 3. Добавляем новый ключ в БД пользователя
-        await add_active_key(callback.from_user.id, new_key, device, old_expiry_time, device, price, days)
-        
-        # 4. Обновляем счетчик на новом сервере
-        clients_count = await get_server_count_by_address(
-            server_address_base, inbound_id, 
-            protocol="shadowsocks" if new_protocol == 'ss' else "vless"
-        )
-        await update_server_clients_count(server_address_base, clients_count + 1, inbound_id)
+        # (add_active_key подтверждает резерв места и обновляет счетчик на новом сервере)
+        await add_active_key(callback.from_user.id, new_key, device, old_expiry_time, device, price, days, reservation_id=reservation_id)
         
-        # 5. Отправка сообщения пользователю о новом ключе
+        # 4. Отправка сообщения пользователю о новом ключе
         kb = InlineKeyboardBuilder()
         kb.button(text="📖 Как подключить VPN", callback_data=f"guide_{device}")
         kb.button(text="🔑 Мои ключи", callback_data="active_keys")
@@ -2385,7 +2418,7 @@ async def process_protocol_change(callback: types.CallbackQuery, state: FSMConte
         
         logger.info(f"New key with protocol {new_protocol_name} created for user {callback.from_user.id}")
         
-        # 6. Теперь пытаемся удалить старый ключ (асинхронно, не блокируя пользователя)
+        # 5. Теперь пытаемся удалить старый ключ (асинхронно, не блокируя пользователя)
         try:
             # Получаем данные старого сервера для удаления клиента
             old_server = await get_server_by_address(
@@ -2394,13 +2427,7 @@ async def process_protocol_change(callback: types.CallbackQuery, state: FSMConte
             )
             
             if old_server:
-                old_api = AsyncApi(
-                    f"http://{old_server['address']}",
-                    old_server['username'],
-                    old_server['password'],
-                    use_tls_verify=False
-                )
-                await old_api.login()
+                old_api = await panel_sessions.get(old_server['address'], old_server['username'], old_server['password'])
                 
                 # Удаляем старого клиента
                 if current_protocol == 'ss':
@@ -2413,20 +2440,8 @@ async def process_protocol_change(callback: types.CallbackQuery, state: FSMConte
                         inbound_id=old_server['inbound_id'], 
                         client_uuid=str(unique_uuid)
                     )
-                
-                # Обновляем счетчик на старом сервере
-                old_clients_count = await get_server_count_by_address(
-                    address, 
-                    old_server['inbound_id'], 
-                    protocol="shadowsocks" if current_protocol == 'ss' else "vless"
-                )
-                await update_server_clients_count(
-                    address, 
-                    old_clients_count - 1, 
-                    old_server['inbound_id']
-                )
             
-            # Удаляем старый ключ из БД пользователя
+            # Удаляем старый ключ из БД пользователя (счетчик старого сервера обновит триггер)
             await remove_key_bd(key)
             logger.info(f"Old key successfully removed for user {callback.from_user.id}")
             
@@ -2444,6 +2459,8 @@ async def process_protocol_change(callback: types.CallbackQuery, state: FSMConte
     except Exception as e:
         # Если произошла ошибка при создании нового ключа
         logger.error(f"Error changing protocol: {str(e)}", exc_info=True)
+        # Резерв места, который не подтвердил add_active_key, освобождаем сразу
+        await release_server_slot(reservation_id)
         
         kb = InlineKeyboardBuilder()
         kb.button(text="🔄 Попробовать ещё раз", callback_data="change_key_protocol")
@@ -2484,10 +2501,10 @@ async def change_key_country(callback: types.CallbackQuery, state: FSMContext):
     
     # Добавляем кнопку для каждого ключа
     for key_data in user_keys:
-        key = key_data[0]            # key
-        device_id = key_data[1]      # device_id
-        expiration_date = key_data[2] # expiration_date
-        name = key_data[3]           # name
+        key = key_data.key
+        device_id = key_data.device_id
+        expiration_date = key_data.expiration_date
+        name = key_data.name
         
         # Определяем отображаемое имя для кнопки
         if name:
@@ -2609,6 +2626,7 @@ async def process_country_change(callback: types.CallbackQuery, state: FSMContex
         await callback.answer("Ключ не найден. Попробуйте еще раз.")
         return
     
+    reservation_id = None
     try:
         price = await get_key_price(key)
         days = await get_key_days(key)
@@ -2625,7 +2643,7 @@ async def process_country_change(callback: types.CallbackQuery, state: FSMContex
         old_expiry_time = await get_key_expiry_date(key)
         
         # 1. Создание нового клиента в выбранной стране
-        api, server_address, pbk, sid, sni, port, utls, protocol, country, inbound_id = await get_api_instance(
+        api, server_address, pbk, sid, sni, port, utls, protocol, country, inbound_id, reservation_id = await get_api_instance(
             country=country_code,
             use_shadowsocks=(protocol == 'ss')
         )
@@ -2688,16 +2706,10 @@ async def process_country_change(callback: types.CallbackQuery, state: FSMContex
             raise Exception("Не удалось создать нового клиента на сервере")
         
         # 3. Добавляем новый ключ в БД пользователя
-        await add_active_key(callback.from_user.id, new_key, device, old_expiry_time, device, price, days)
-        
-        # 4. Обновляем счетчик на новом сервере
-        clients_count = await get_server_count_by_address(
-            server_address_base, inbound_id, 
-            protocol="shadowsocks" if protocol == 'ss' else "vless"
-        )
-        await update_server_clients_count(server_address_base, clients_count + 1, inbound_id)
+        # (add_active_key подтверждает резерв места и обновляет счетчик на новом сервере)
+        await add_active_key(callback.from_user.id, new_key, device, old_expiry_time, device, price, days, reservation_id=reservation_id)
         
-        # 5. Отправка сообщения пользователю о новом ключе
+        # 4. Отправка сообщения пользователю о новом ключе
         kb = InlineKeyboardBuilder()
         kb.button(text="📖 Как подключить VPN", callback_data=f"guide_{device}")
         kb.button(text="🔑 Мои ключи", callback_data="active_keys")
@@ -2716,7 +2728,7 @@ async def process_country_change(callback: types.CallbackQuery, state: FSMContex
         
         logger.info(f"New key successfully created for user {callback.from_user.id}: {new_key}")
         
-        # 6. Теперь пытаемся удалить старый ключ (асинхронно, не блокируя пользователя)
+        # 5. Теперь пытаемся удалить старый ключ (асинхронно, не блокируя пользователя)
         try:
             # Получаем данные старого сервера
             old_server = await get_server_by_address(
@@ -2725,13 +2737,7 @@ async def process_country_change(callback: types.CallbackQuery, state: FSMContex
             )
             
             if old_server:
-                old_api = AsyncApi(
-                    f"http://{old_server['address']}",
-                    old_server['username'],
-                    old_server['password'],
-                    use_tls_verify=False
-                )
-                await old_api.login()
+                old_api = await panel_sessions.get(old_server['address'], old_server['username'], old_server['password'])
                 
                 # Удаляем старого клиента
                 if protocol == 'ss':
@@ -2744,20 +2750,8 @@ async def process_country_change(callback: types.CallbackQuery, state: FSMContex
                         inbound_id=old_server['inbound_id'], 
                         client_uuid=str(unique_uuid)
                     )
-                
-                # Обновляем счетчик на старом сервере
-                old_clients_count = await get_server_count_by_address(
-                    address, 
-                    old_server['inbound_id'], 
-                    protocol="shadowsocks" if protocol == 'ss' else "vless"
-                )
-                await update_server_clients_count(
-                    address, 
-                    old_clients_count - 1, 
-                    old_server['inbound_id']
-                )
             
-            # Удаляем старый ключ из БД пользователя
+            # Удаляем старый ключ из БД пользователя (счетчик старого сервера обновит триггер)
             await remove_key_bd(key)
             logger.info(f"Old key successfully removed for user {callback.from_user.id}")
             
@@ -2775,6 +2769,8 @@ async def process_country_change(callback: types.CallbackQuery, state: FSMContex
     except Exception as e:
         # Если произошла ошибка при создании нового ключа
         logger.error(f"Error creating new key: {str(e)}", exc_info=True)
+        # Резерв места, который не подтвердил add_active_key, освобождаем сразу
+        await release_server_slot(reservation_id)
         
         kb = InlineKeyboardBuilder()
         kb.button(text="🔄 Попробовать ещё раз", callback_data="change_key_country")
@@ -2814,10 +2810,10 @@ async def replace_key(callback: types.CallbackQuery, state: FSMContext):
     
     # Добавляем кнопку для каждого ключа
     for key_data in user_keys:
-        key = key_data[0]            # key
-        device_id = key_data[1]      # device_id
-        expiration_date = key_data[2] # expiration_date
-        name = key_data[3]           # name
+        key = key_data.key
+        device_id = key_data.device_id
+        expiration_date = key_data.expiration_date
+        name = key_data.name
         
         # Определяем отображаемое имя для кнопки
         if name:
@@ -2872,6 +2868,7 @@ async def process_selected_key(message, key, user_id, state, bot):
     """
     Обрабатывает выбранный ключ для замены
     """
+    reservation_id = None
     try:
         if not (key.startswith("vless://") or key.startswith("ss://")):
             kb = InlineKeyboardBuilder()
@@ -2899,7 +2896,7 @@ async def process_selected_key(message, key, user_id, state, bot):
         unique_email = f"{parts[0]}_{random_part}_{parts[2]}"
 
         # 1. Создаем нового клиента на новом сервере
-        new_api, server_address, pbk, sid, sni, port, utls, protocol, country, inbound_id = await get_api_instance(
+        new_api, server_address, pbk, sid, sni, port, utls, protocol, country, inbound_id, reservation_id = await get_api_instance(
             use_shadowsocks=(protocol == 'ss')
         ) 
         await send_info_for_admins(
@@ -2955,16 +2952,10 @@ async def process_selected_key(message, key, user_id, state, bot):
             raise Exception("Не удалось создать нового клиента на сервере")
             
         # 2. Добавляем новый ключ в БД
-        await add_active_key(user_id, new_key, device, old_expiry_time, device, price, days)
+        # (add_active_key подтверждает резерв места и обновляет счетчик на новом сервере)
+        await add_active_key(user_id, new_key, device, old_expiry_time, device, price, days, reservation_id=reservation_id)
         
-        # 3. Обновляем счетчик на новом сервере
-        clients_count = await get_server_count_by_address(
-            server_address, inbound_id, 
-            protocol="shadowsocks" if protocol == 'ss' else "vless"
-        ) 
-        await update_server_clients_count(server_address, clients_count + 1, inbound_id)
-        
-        # 4. Уведомляем пользователя об успешной замене
+        # 3. Уведомляем пользователя об успешной замене
         kb = InlineKeyboardBuilder()
         kb.button(text="📖 Как подключить VPN", callback_data=f"guide_{device}")
         kb.button(text="🔑 Мои ключи", callback_data="active_keys")
@@ -2981,33 +2972,20 @@ async def process_selected_key(message, key, user_id, state, bot):
         ) 
         await message.edit_reply_markup(reply_markup=kb.as_markup())
 
-        # 5. Пытаемся удалить старый ключ
+        # 4. Пытаемся удалить старый ключ
         try:
             # Получаем данные старого сервера
             old_server = await get_server_by_address(address, protocol="shadowsocks" if protocol == 'ss' else "vless")
             if old_server:
-                old_api = AsyncApi(
-                    f"http://{old_server['address']}",
-                    old_server['username'],
-                    old_server['password'],
-                    use_tls_verify=False
-                )
-                await old_api.login()
+                old_api = await panel_sessions.get(old_server['address'], old_server['username'], old_server['password'])
                 
                 # Пытаемся удалить старого клиента
                 if protocol == 'ss':
                     await old_api.client.delete(inbound_id=old_server['inbound_id'], client_uuid=f"{parts[0]}_{parts[1]}_{parts[2]}")
                 else:
                     await old_api.client.delete(inbound_id=old_server['inbound_id'], client_uuid=str(unique_uuid))
-                
-                # Обновляем счетчик на старом сервере
-                old_clients_count = await get_server_count_by_address(
-                    address, old_server['inbound_id'], 
-                    protocol="shadowsocks" if protocol == 'ss' else "vless"
-                ) 
-                await update_server_clients_count(address, old_clients_count - 1, old_server['inbound_id'])
             
-            # Удаляем старый ключ из БД в любом случае
+            # Удаляем старый ключ из БД в любом случае (счетчик старого сервера обновит триггер)
             await remove_key_bd(key)
             logger.info(f"Старый ключ успешно удален для пользователя {user_id}")
             
@@ -3030,6 +3008,8 @@ async def process_selected_key(message, key, user_id, state, bot):
         
     except Exception as e:
         logger.error(f"Error replacing key: {str(e)}", exc_info=True)
+        # Резерв места, который не подтвердил add_active_key, освобождаем сразу
+        await release_server_slot(reservation_id)
         await send_info_for_admins(
             f"[Замена ключа] Ошибка при замене ключа для пользователя {user_id}: {e}", 
             await get_admins(), 
@@ -3056,6 +3036,8 @@ async def show_device_keys(callback: types.CallbackQuery, state: FSMContext):
     Отображает список ключей для выбранного устройства в виде кнопок
     """
     original_device = callback.data.split("_")[2].lower()
+    after, before = parse_page_cursor(callback.data, f"show_keys_{callback.data.split('_')[2]}")
+    KEYS_PER_PAGE = 10
     
     # Упорядоченный словарь замен (от длинных к коротким)
     device_mapping = [
@@ -3079,13 +3061,10 @@ async def show_device_keys(callback: types.CallbackQuery, state: FSMContext):
     device_aliases = {k for k, v in device_mapping if v == device}
     device_aliases.add(device)  # Добавляем основное название
     
-    user_keys = await get_user_keys(callback.from_user.id)
-    
-    # Фильтрация ключей с учетом всех алиасов
-    device_keys = [
-        key for key in user_keys 
-        if key[1].lower() in device_aliases
-    ]
+    # Страница ключей с учетом всех алиасов устройства
+    device_keys, prev_cursor, next_cursor = await get_user_keys_page(
+        callback.from_user.id, device_aliases, KEYS_PER_PAGE, after=after, before=before
+    )
     
     if not device_keys:
         kb = InlineKeyboardBuilder()
@@ -3106,9 +3085,9 @@ async def show_device_keys(callback: types.CallbackQuery, state: FSMContext):
     
     # Добавляем кнопки для каждого ключа
     for idx, key_data in enumerate(device_keys, 1):
-        key = key_data[0]
-        expiry_date = datetime.fromtimestamp(int(key_data[2])/1000).strftime('%d.%m.%Y')
-        name = key_data[3]  # Имя ключа если доступно
+        key = key_data.key
+        expiry_date = datetime.fromtimestamp(int(key_data.expiration_date)/1000).strftime('%d.%m.%Y')
+        name = key_data.name  # Имя ключа если доступно
         
         # Определяем отображаемое имя для кнопки
         if name:
@@ -3127,13 +3106,16 @@ async def show_device_keys(callback: types.CallbackQuery, state: FSMContext):
         )
         
         # Сохраняем ключ в состоянии для последующего доступа
-        await state.update_data({f"view_key_{key_id}": key_data})
+        await state.update_data({f"view_key_{key_id}": key_data.to_dict()})
+    kb.adjust(1)  # Каждая кнопка на новой строке
     
     # Добавляем навигационные кнопки
-    kb.button(text="🔑 Настроить ключ", callback_data="key_settings")
-    kb.button(text="📖 Как подключить VPN", callback_data=f"guide_{device}")
-    kb.button(text="◀️ Назад к категориям", callback_data="active_keys")
-    kb.adjust(1)  # Каждая кнопка на новой строке
+    nav_buttons = page_nav_buttons(f"show_keys_{device}", prev_cursor, next_cursor)
+    if nav_buttons:
+        kb.row(*nav_buttons)
+    kb.row(InlineKeyboardButton(text="🔑 Настроить ключ", callback_data="key_settings"))
+    kb.row(InlineKeyboardButton(text="📖 Как подключить VPN", callback_data=f"guide_{device}"))
+    kb.row(InlineKeyboardButton(text="◀️ Назад к категориям", callback_data="active_keys"))
     
     await callback.message.edit_media(
         media=InputMediaPhoto(
@@ -3160,9 +3142,9 @@ async def show_key_details(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Ключ не найден. Попробуйте еще раз.")
         return
     
-    key = key_data[0]
-    device = key_data[1]
-    expiry_timestamp = key_data[2]
+    key = key_data['key']
+    device = key_data['device_id']
+    expiry_timestamp = key_data['expiration_date']
     
     if device == "and":
         device = "android"
@@ -3668,6 +3650,7 @@ async def choose_subscription(callback: types.CallbackQuery, state: FSMContext,
     Отображает меню выбора типа подписки
     """
     device = callback.data.split("_")[1]
+    reservation_id = None
     try:
         user = await get_user(user_id=callback.from_user.id)
         free_keys_count = await get_free_keys_count(callback.from_user.id)
@@ -3683,7 +3666,7 @@ async def choose_subscription(callback: types.CallbackQuery, state: FSMContext,
             await update_free_keys_count(callback.from_user.id, 0)
 
             logger.info(f"Starting free subscription creation for user {callback.from_user.id}")
-            api, server_address, pbk, sid, sni, port, utls, protocol, country, inbound_id = await get_api_instance(use_shadowsocks=False) 
+            api, server_address, pbk, sid, sni, port, utls, protocol, country, inbound_id, reservation_id = await get_api_instance(use_shadowsocks=False) 
             await send_info_for_admins(
                 f"[Контроль Сервера, Функция: choose_subscription]\nНайденый сервер:\n{server_address},\n{pbk},\n{sid}\n{sni}... ",
                 await get_admins(),
@@ -3736,7 +3719,6 @@ async def choose_subscription(callback: types.CallbackQuery, state: FSMContext,
             add_result = await api.client.add(inbound_id, [new_client])
             logger.info(f"Add client result: {add_result}")
             #await send_info_for_admins(f"[Бесплатная подписка] Добавление в панель, результат: {add_result}", await get_admins(), bot)
-            await api.login()
             
             client = await api.client.get_by_email(email)
             logger.info(f"Retrieved client by email: {client}")
@@ -3765,12 +3747,10 @@ async def choose_subscription(callback: types.CallbackQuery, state: FSMContext,
                 )
                 
                 await callback.message.answer(success_text, parse_mode="HTML", reply_markup=kb.as_markup())
-                await add_active_key(callback.from_user.id, vpn_link, device, client.expiry_time, device, 0, 3)
-                await update_keys_count(callback.from_user.id, keys_count + 1)
-                clients_count = await get_server_count_by_address(server_address, inbound_id, protocol="shadowsocks" if protocol == 'ss' else "vless") 
-                await update_server_clients_count(server_address, clients_count + 1, inbound_id) 
                 expiry_time = datetime.fromtimestamp(expiry_time/1000).strftime('%d.%m.%Y %H:%M')
-                await update_subscription(callback.from_user.id, "Бесплатная", expiry_time)
+                async with db_pool.transaction():
+                    await add_active_key(callback.from_user.id, vpn_link, device, client.expiry_time, device, 0, 3, reservation_id=reservation_id)
+                    await update_subscription(callback.from_user.id, "Бесплатная", expiry_time)
                 logger.info(f"Successfully completed subscription creation for user {callback.from_user.id}")
                 await send_info_for_admins(f"[Бесплатная подписка] Успешное создание подписки для пользователя {user['username']}, user id: {callback.from_user.id}, device: {device}, days: {free_days}", await get_admins(), bot, username=user.get("username"))
                 #await send_info_for_admins(f"[Бесплатная подписка] Информация о пользователе: {user}", await get_admins(), bot)
@@ -3822,6 +3802,8 @@ async def choose_subscription(callback: types.CallbackQuery, state: FSMContext,
 
     except Exception as e:
         logger.error(f"Error creating free subscription: {str(e)}", exc_info=True)
+        # Резерв места, который не подтвердил add_active_key, освобождаем сразу
+        await release_server_slot(reservation_id)
         error_message = (
             f"❌ Произошла ошибка при создании бесплатной подписки:\n"
             f"Тип ошибки: {type(e).__name__}\n"
@@ -4013,21 +3995,20 @@ async def process_subscription(callback_query: types.CallbackQuery, state: FSMCo
     await callback_query.message.edit_reply_markup(reply_markup=kb.as_markup())
     await state.set_state(SubscriptionStates.waiting_for_email)
 
-async def extend_key(key: str, address: str, bot: Bot, user: Dict, device, unique_id, user_name, days, unique_uuid, message):
+async def extend_key(key: str, address: str, bot: Bot, user: Dict, device, unique_id, user_name, days, unique_uuid, message) -> bool:
     """
     Полностью продлевает срок действия ключа
+
+    Returns:
+        bool: True, если срок ключа продлен на панели и в базе
     """
     protocol = 'ss' if key.startswith('ss://') else 'vless'
+    extended = False
 
     try:
         server = await get_server_by_address(address)
 
-        api = AsyncApi(
-                    f"http://{server['address']}",
-                    server['username'],
-                    server['password'],
-                    use_tls_verify=False
-        )
+        api = panel_sessions.session(server['address'], server['username'], server['password'])
         await send_info_for_admins(
             f"[Контроль Сервера, Функция: extend_key]\nНайденый сервер IP:\n{address}",
             await get_admins(),
@@ -4073,7 +4054,6 @@ async def extend_key(key: str, address: str, bot: Bot, user: Dict, device, uniqu
                 )
             
             await send_info_for_admins(f"[ПРОТОКОЛ ПРОДЛЕНИЯ]: {protocol}", await get_admins(), bot)
-            await api.login()
 
             updated_client = await api.client.get_by_email(f"{device}_{unique_id}_{user_name}")
 
@@ -4103,6 +4083,7 @@ async def extend_key(key: str, address: str, bot: Bot, user: Dict, device, uniqu
                 key = key,
                 new_expiry_time=new_expiry_time
             )
+            extended = True
             
             await send_info_for_admins(
                 f"[Контроль ПРОТОКОЛА, Функция: extend_key.\nсервер: {address},\nюзер: {client.email},\nновый протокол: {protocol}]:\n{client}",
@@ -4126,6 +4107,7 @@ async def extend_key(key: str, address: str, bot: Bot, user: Dict, device, uniqu
         logger.error(f"Error creating client: {str(e)}", exc_info=True)
         error_message = f"❌ Обратитесь в поддержку. Ошибка при продлении подписки: {str(e)}"
         await message.answer(error_message)
+    return extended
 
 async def client_pay(current_user_id, price, bot, user, email) -> bool:
     """
@@ -4158,11 +4140,19 @@ async def client_pay(current_user_id, price, bot, user, email) -> bool:
     
     return False
 
-async def connect_key(current_user_id, days, selected_country, selected_protocol, bot, user, device, devices, message, price):
+async def connect_key(current_user_id, days, selected_country, selected_protocol, bot, user, device, devices, message, price) -> bool:
+    """
+    Создает клиента на доступном сервере и сохраняет ключ
+
+    Returns:
+        bool: True, если ключ выдан и сохранен в базе
+    """
     logger.info(f"Attempting to create client for user {current_user_id} for {days} days")
     await send_info_for_admins(f"[Подключение подписки] Попытка создания клиента для пользователя {current_user_id} на {days} дней", await get_admins(), bot, username=user.get("username"))
+    reservation_id = None
+    issued = False
     try:
-        api, address, pbk, sid, sni, port, utls, protocol, country, inbound_id = await get_api_instance(
+        api, address, pbk, sid, sni, port, utls, protocol, country, inbound_id, reservation_id = await get_api_instance(
             country=selected_country,
             use_shadowsocks=(selected_protocol == 'ss') if selected_protocol else None
         )
@@ -4172,10 +4162,8 @@ async def connect_key(current_user_id, days, selected_country, selected_protocol
             bot,
             username=user.get("username")
         )
-        clients_count = await get_server_count_by_address(address, inbound_id, protocol="shadowsocks" if selected_protocol == 'ss' else "vless")
         current_time = datetime.now(timezone.utc).timestamp() * 1000
         expiry_time = int(current_time + (int(days) * 86400000))
-        keys_count = await get_keys_count(current_user_id)
 
         try:
             client_id = str(uuid.uuid4())
@@ -4262,11 +4250,11 @@ async def connect_key(current_user_id, days, selected_country, selected_protocol
                 parse_mode="HTML"
             )
 
-            await add_active_key(current_user_id, vpn_link, device, client.expiry_time, device, price, days)
-            await update_keys_count(current_user_id, keys_count + 1)
-            await update_server_clients_count(address, clients_count + 1, inbound_id)
             expiry_time = datetime.fromtimestamp(expiry_time/1000).strftime('%d.%m.%Y %H:%M')
-            await update_subscription(current_user_id, "Подписка куплена", expiry_time)
+            async with db_pool.transaction():
+                await add_active_key(current_user_id, vpn_link, device, client.expiry_time, device, price, days, reservation_id=reservation_id)
+                await update_subscription(current_user_id, "Подписка куплена", expiry_time)
+            issued = True
             await send_info_for_admins(
                 f"[Контроль ПРОТОКОЛА, Функция: process_email 2.\nсервер: {address},\nюзер: {client.email},\nновый протокол: {protocol}]:\n{client}",
                 await get_admins(),
@@ -4276,7 +4264,6 @@ async def connect_key(current_user_id, days, selected_country, selected_protocol
 
             if selected_protocol == 'vless':    
                 try: 
-                    await api.login()
                     client = await api.client.get_by_email(email)
                     updated_client = Client(
                         email=client.email,
@@ -4287,18 +4274,22 @@ async def connect_key(current_user_id, days, selected_country, selected_protocol
                         flow="xtls-rprx-vision"
                     )
                     await api.client.update(client_uuid=str(client_id), client=updated_client)
-                    await api.login()
                     client = await api.client.get_by_email(email)
                     await send_info_for_admins(f"[Подключение подписки. Проверка Flow] Flow успешно добавлен {current_user_id}", await get_admins(), bot, username=user.get("username"))
                 except Exception as e:
                     await send_info_for_admins(f"[Подключение подписки. Проверка Flow] Ошибка при обновлении подписки: {str(e)}", await get_admins(), bot, username=user.get("username"))
-            
+        else:
+            # Клиент не появился на панели: ключ не выдан, место больше не держим
+            await release_server_slot(reservation_id)
         
     except Exception as e:
         await send_info_for_admins(f"[Подключение подписки ] Ошибка при создании подписки: {str(e)}", await get_admins(), bot, username=user.get("username"))
         error_message = f"❌ 1Ошибка при создании подписки: {str(e)}"
         logger.error(error_message)
         await message.answer(error_message)
+        # Резерв места, который не подтвердил add_active_key, освобождаем сразу
+        await release_server_slot(reservation_id)
+    return issued
 
 
 @router.message(SubscriptionStates.waiting_for_email)
@@ -4333,7 +4324,6 @@ async def process_email(message: Message, state: FSMContext, bot: Bot, existing_
     selected_protocol = data.get('selected_protocol')
 
     user = await get_user(user_id=current_user_id)
-    balance = int(user['balance'])
 
     await send_info_for_admins(f"[Подписка] Обработка email для пользователя {current_user_id}", await get_admins(), bot, username=user.get("username"))
 
@@ -4344,9 +4334,15 @@ async def process_email(message: Message, state: FSMContext, bot: Bot, existing_
     user_name = data.get("user_name")
     key_to_connect = data.get("key_to_connect")
 
+    # Стоимость списывается с баланса до выдачи ключа: условное списание и есть проверка
+    # средств, поэтому параллельные покупки не получат ключ за одни и те же деньги.
+    # Если ключ выдать не удалось, списание возвращается на баланс
+    purchase_id = uuid.uuid4().hex
+
     print(data)
     if unique_id:
-        if balance < int(price):
+        paid_from_balance = await debit_for_subscription(current_user_id, int(price), purchase_id) is not None
+        if not paid_from_balance:
             success_payment = await client_pay(current_user_id=current_user_id, price=price, bot=bot, user=user, email=UserEmail)
             
             if not success_payment:
@@ -4359,34 +4355,24 @@ async def process_email(message: Message, state: FSMContext, bot: Bot, existing_
                 await send_info_for_admins(f"[Продление] Не получилось продлить для пользователя {current_user_id} с помощью сохраненных методов", await get_admins(), bot, username=user.get("username"))
                 await message.answer(answer_message, reply_markup=kb.as_markup())
                 return
-            else:
-                await extend_key(key=key_to_connect,
-                                address=address,
-                                bot=bot,
-                                user=user,
-                                device=device,
-                                unique_id=unique_id,
-                                user_name=user_name,
-                                days=days,
-                                unique_uuid=unique_uuid,
-                                message=message)
-                return
         else:
             logger.info(f"Attempting to continue payment for user {current_user_id}")
             await send_info_for_admins(f"[Продление] Попытка продолжения оплаты для пользователя {current_user_id}", await get_admins(), bot, username=user.get("username"))
             logger.info(f"Key to connect: {key_to_connect}, unique_uuid: {unique_uuid}")
-            await extend_key(key=key_to_connect,
-                            address=address,
-                            bot=bot,
-                            user=user,
-                            device=device,
-                            unique_id=unique_id,
-                            user_name=user_name,
-                            days=days,
-                            unique_uuid=unique_uuid,
-                            message=message)
-            await update_balance(current_user_id, balance - int(price))
-            return
+
+        extended = await extend_key(key=key_to_connect,
+                                    address=address,
+                                    bot=bot,
+                                    user=user,
+                                    device=device,
+                                    unique_id=unique_id,
+                                    user_name=user_name,
+                                    days=days,
+                                    unique_uuid=unique_uuid,
+                                    message=message)
+        if not extended and paid_from_balance:
+            await refund_subscription(current_user_id, int(price), purchase_id, bot, user, message)
+        return
     else:
         await send_info_for_admins(f"[Продление] Не найден уникальный ID для пользователя {current_user_id}", await get_admins(), bot, username=user.get("username"))
         logger.info(f"No unique_id found for user {current_user_id}")
@@ -4397,7 +4383,8 @@ async def process_email(message: Message, state: FSMContext, bot: Bot, existing_
 
     data = await state.get_data()
 
-    if balance < int(price):
+    paid_from_balance = await debit_for_subscription(current_user_id, int(price), purchase_id) is not None
+    if not paid_from_balance:
         success_payment = await client_pay(current_user_id=current_user_id, price=price, bot=bot, user=user, email=UserEmail)
 
         if not success_payment:
@@ -4409,33 +4396,48 @@ async def process_email(message: Message, state: FSMContext, bot: Bot, existing_
             kb.add(InlineKeyboardButton(text="💳 Пополнить баланс", callback_data="add_balance"))
             await message.answer(answer_message, reply_markup=kb.as_markup())
             return
-        else:
-            await connect_key(
-                current_user_id=current_user_id,
-                days=days,
-                selected_country=selected_country,
-                selected_protocol=selected_protocol,
-                bot=bot,
-                user=user,
-                device=device,
-                devices=devices,
-                message=message,
-                price=price
-            )
-    else:
-        await connect_key(
-            current_user_id=current_user_id,
-            days=days,
-            selected_country=selected_country,
-            selected_protocol=selected_protocol,
-            bot=bot,
-            user=user,
-            device=device,
-            devices=devices,
-            message=message,
-            price=price
-        )
-        await update_balance(current_user_id, int(user['balance']) - int(price))
+
+    issued = await connect_key(
+        current_user_id=current_user_id,
+        days=days,
+        selected_country=selected_country,
+        selected_protocol=selected_protocol,
+        bot=bot,
+        user=user,
+        device=device,
+        devices=devices,
+        message=message,
+        price=price
+    )
+    if not issued and paid_from_balance:
+        await refund_subscription(current_user_id, int(price), purchase_id, bot, user, message)
+
+async def debit_for_subscription(user_id, price: int, purchase_id: str) -> int | None:
+    """
+    Списывает стоимость подписки с баланса до ее выдачи.
+
+    Returns:
+        int | None: Новый баланс или None, если средств недостаточно
+    """
+    return await debit_balance(user_id, price, "subscription", idempotency_key=f"subscription:{purchase_id}")
+
+async def refund_subscription(user_id, price: int, purchase_id: str, bot: Bot, user, message):
+    """
+    Возвращает на баланс стоимость подписки, которую не удалось выдать.
+    Возврат по одной покупке проводится только один раз.
+    """
+    new_balance = await credit_balance(
+        user_id, price, "subscription_refund", idempotency_key=f"subscription_refund:{purchase_id}"
+    )
+    if new_balance is None:
+        return None
+    logger.warning(f"Подписка не выдана, {price}₽ возвращены на баланс пользователя {user_id}")
+    await send_info_for_admins(
+        f"[Подписка] Подписка не выдана, {price}₽ возвращены на баланс пользователя {user_id}",
+        await get_admins(), bot, username=user.get("username")
+    )
+    await message.answer(f"💰 Списанные {price}₽ возвращены на ваш баланс.")
+    return new_balance
 
 @router.callback_query(F.data == "process_email")
 async def process_email_handler(callback_query: types.CallbackQuery, state: FSMContext, bot: Bot):
@@ -4468,10 +4470,11 @@ async def delayed_payment_check(bot: Bot, user_id: int, payment_id: str, amount:
         kb.adjust(1)
         
         if payment_success:
-            # Обновляем баланс
-            new_balance = int(user['balance']) + amount
+            # Обновляем баланс; если платеж уже зачислила ручная проверка, ничего не делаем
             await update_transaction_status(transaction_id=payment_id, new_status="succeeded")
-            await update_balance(user_id, new_balance)
+            new_balance = await credit_balance(user_id, int(amount), "deposit", idempotency_key=f"deposit:{payment_id}")
+            if new_balance is None:
+                return
             
 
 
@@ -4516,10 +4519,12 @@ async def delayed_payment_check(bot: Bot, user_id: int, payment_id: str, amount:
             
             # Обработка реферальной системы
             if user['referrer_id']:
-                referrer = await get_user(user_id=user['referrer_id'])
                 first_deposit = await get_is_first_payment_done(user_id)
                 bonus_percentage = 0.5 if first_deposit else 0.3
-                await update_balance(referrer['user_id'], int(referrer['balance']) + int(amount) * bonus_percentage)
+                bonus = int(int(amount) * bonus_percentage)
+                await credit_balance(
+                    user['referrer_id'], bonus, "referral_bonus", idempotency_key=f"referral_bonus:{payment_id}"
+                )
                 
                 try:
                     ref_kb = InlineKeyboardBuilder()
@@ -4528,7 +4533,7 @@ async def delayed_payment_check(bot: Bot, user_id: int, payment_id: str, amount:
                         user['referrer_id'],
                         f"🎉 <b>Поздравляем!</b>\n\n"
                         f"Ваш реферал пополнил баланс на сумму {amount}₽\n"
-                        f"Вам начислен бонус: <b>{int(amount) * bonus_percentage}₽</b> ({bonus_percentage * 100}%)",
+                        f"Вам начислен бонус: <b>{bonus}₽</b> ({bonus_percentage * 100}%)",
                         parse_mode="HTML",
                         reply_markup=ref_kb.as_markup()
                     )
@@ -4562,11 +4567,16 @@ async def check_payment(callback_query: types.CallbackQuery, state: FSMContext,
         if payment_success:
             amount = int(data.get('amount', 0))
             print(amount)
-            new_balance = int(user['balance']) + amount
 
             try:
                 await update_transaction_status(transaction_id=payment_id, new_status="succeeded")
-                await update_balance(callback_query.from_user.id, new_balance)
+                new_balance = await credit_balance(
+                    callback_query.from_user.id, amount, "deposit", idempotency_key=f"deposit:{payment_id}"
+                )
+                if new_balance is None:
+                    # Платеж уже зачислен (отложенной проверкой или повторным нажатием)
+                    await callback_query.answer("✅ Этот платеж уже зачислен на баланс", show_alert=True)
+                    return
                 if saved_payment_method_id:
                     
                     data = await state.get_data()
@@ -4589,10 +4599,12 @@ async def check_payment(callback_query: types.CallbackQuery, state: FSMContext,
                                              payment.payment_method.type,
                                              days_delay=0)
                 if user['referrer_id']:
-                    referrer = await get_user(user_id=user['referrer_id'])
                     first_deposit = await get_is_first_payment_done(user['user_id'])
                     bonus_percentage = 0.5 if first_deposit else 0.3
-                    await update_balance(referrer['user_id'], int(referrer['balance']) + int(amount) * bonus_percentage)
+                    bonus = int(amount * bonus_percentage)
+                    await credit_balance(
+                        user['referrer_id'], bonus, "referral_bonus", idempotency_key=f"referral_bonus:{payment_id}"
+                    )
 
                     try:
                         kb.button(text="◀️ Вернуться в меню", callback_data="back_to_menu")
@@ -4600,7 +4612,7 @@ async def check_payment(callback_query: types.CallbackQuery, state: FSMContext,
                             user['referrer_id'],
                             f"🎉 <b>Поздравляем!</b>\n\n"
                             f"Ваш реферал пополнил баланс на сумму {amount}₽\n"
-                            f"Вам начислен бонус: <b>{int(amount) * bonus_percentage}₽</b> ({bonus_percentage * 100}%)",
+                            f"Вам начислен бонус: <b>{bonus}₽</b> ({bonus_percentage * 100}%)",
                             parse_mode="HTML",
                             reply_markup=kb.as_markup()
                         )
@@ -4637,17 +4649,11 @@ async def check_payment(callback_query: types.CallbackQuery, state: FSMContext,
 
     await callback_query.answer()
 
-@router.message(Command("admin"))
+@router.message(Command("admin"), IsAdmin())
 async def admin_menu(message: types.Message):
     """
     Административное меню
     """
-    user = await get_user(message.from_user.id)
-    
-    if not user or not user.get('is_admin'):
-        await message.answer("⛔️ У вас нет доступа к админ-панели")
-        return
-    
     kb = InlineKeyboardBuilder()
     kb.button(text="➕ Добавить сервер", callback_data="add_server")
     kb.button(text="➖ Удалить сервер", callback_data="remove_server")
@@ -4678,6 +4684,14 @@ async def admin_menu(message: types.Message):
     )
 
 
+@router.message(Command("admin"))
+async def admin_menu_denied(message: types.Message):
+    """
+    Ответ на /admin для пользователей без прав администратора
+    """
+    await message.answer("⛔️ У вас нет доступа к админ-панели")
+
+
 @router.callback_query(F.data == "channels_info")
 async def channels_info(callback: types.CallbackQuery):
     """
@@ -4976,16 +4990,11 @@ async def confirm_inbound_removal(callback: types.CallbackQuery):
 
 
 
-@router.callback_query(F.data == "remove_key")
+@router.callback_query(F.data == "remove_key", IsAdmin())
 async def remove_key_start(callback: types.CallbackQuery, state: FSMContext):
     """
     Начало процесса удаления ключа - запрос ID/username пользователя
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-
     kb = InlineKeyboardBuilder()
     kb.button(text="◀️ Отмена", callback_data="admin_back")
 
@@ -5056,7 +5065,7 @@ async def show_user_keys(message: Message, state: FSMContext):
     }
     
     for key_data in user_keys:
-        key_value, device_id, expiration_date = key_data
+        key_value, device_id, expiration_date = key_data.key, key_data.device_id, key_data.expiration_date
         device_type = determine_device_type(device_id)  
         if device_type in keys_by_device:
             keys_by_device[device_type].append({
@@ -5112,7 +5121,7 @@ async def show_device_keys_2(callback: types.CallbackQuery, state: FSMContext):
         # Фильтруем ключи для выбранного устройства
         device_keys = []
         for key_data in all_keys:
-            key_value, device_id, expiration_date = key_data
+            key_value, device_id, expiration_date = key_data.key, key_data.device_id, key_data.expiration_date
             if determine_device_type(device_id) == device_type:
                 device_keys.append({
                     'key': key_value,
@@ -5212,67 +5221,15 @@ async def final_remove_all_keys(callback: types.CallbackQuery, state: FSMContext
     
     try:
         all_keys = await get_user_keys(target_user_id)
-        deleted_count = 0
-        skipped_count = 0  # Счетчик пропущенных ключей
+        keys = [
+            key_data.key for key_data in all_keys
+            if determine_device_type(key_data.device_id) == device_type
+        ]
         
-        for key_data in all_keys:
-            key_value, device_id, _ = key_data
-            if determine_device_type(device_id) == device_type:
-                try:
-                    device, unique_id, uuid, address, parts = extract_key_data(key_value)
-                    protocol = 'ss' if key_value.startswith('ss://') else 'vless'
-                    
-                    server = await get_server_by_address(
-                        address, 
-                        protocol="shadowsocks" if protocol == 'ss' else "vless"
-                    )
-                    api = AsyncApi(
-                        f"http://{server['address']}",
-                        server['username'],
-                        server['password'],
-                        use_tls_verify=False
-                    )
-                    
-                    await api.login()
-                    client = await api.client.get_by_email(f"{parts[0]}_{parts[1]}_{parts[2]}")
-                    
-                    # Пропускаем если клиент не найден
-                    if not client:
-                        skipped_count += 1
-                        continue
-                        
-                    if protocol == 'ss':
-                        await api.client.delete(
-                            inbound_id=client.inbound_id, 
-                            client_uuid=str(client.email)
-                        )
-                    else:
-                        await api.client.delete(
-                            inbound_id=client.inbound_id,
-                            client_uuid=str(uuid)
-                        )
-                    
-                    # Обновляем счетчик клиентов
-                    try:
-                        clients_count = await get_server_count_by_address(
-                            address, 
-                            client.inbound_id, 
-                            protocol="shadowsocks" if protocol == 'ss' else "vless"
-                        )
-                        await update_server_clients_count(
-                            address, 
-                            clients_count - 1, 
-                            client.inbound_id
-                        )
-                    except Exception as update_error:
-                        logger.error(f"Ошибка обновления счетчика: {update_error}")
-                    
-                    await remove_key_bd(key_value)
-                    deleted_count += 1
-                    
-                except Exception as key_error:
-                    logger.error(f"Ошибка удаления ключа {key_value}: {key_error}")
-                    skipped_count += 1
+        # Клиенты удаляются с панелей параллельно по серверам, ключи из БД — одной транзакцией
+        result = await remove_keys(keys)
+        deleted_count = len(result['deleted'])
+        skipped_count = len(result['failed'])  # Счетчик пропущенных ключей
 
         kb = InlineKeyboardBuilder()
         kb.button(text="◀️ В админ-панель", callback_data="admin_back")
@@ -5325,13 +5282,7 @@ async def remove_key_final(callback: types.CallbackQuery, state: FSMContext):
         device, unique_id, uniquie_uuid, address, parts = extract_key_data(key['key'])
         protocol = 'ss' if key['key'].startswith('ss://') else 'vless'
         server = await get_server_by_address(address, protocol = "shadowsocks" if protocol == 'ss' else "vless")
-        api = AsyncApi(
-                    f"http://{server['address']}",
-                    server['username'],
-                    server['password'],
-                    use_tls_verify=False
-        )
-        await api.login()
+        api = await panel_sessions.get(server['address'], server['username'], server['password'])
 
         email = f"{parts[0]}_{parts[1]}_{parts[2]}"
         client = await api.client.get_by_email(email)
@@ -5359,16 +5310,11 @@ async def remove_key_final(callback: types.CallbackQuery, state: FSMContext):
         logger.error(f"Ошибка при удалении ключа: {e}")
         await callback.answer("Произошла ошибка при удалении ключа", show_alert=True)
 
-@router.message(Command("find"))
+@router.message(Command("find"), IsAdmin())
 async def find_user(message: Message, state: FSMContext):
     """
     Поиск пользователя по ключу, username или user_id и вывод всей информации о клиенте.
     """
-    user = await get_user(message.from_user.id)
-    if not user.get('is_admin'):
-        await message.answer("⛔️ У вас нет доступа")
-        return
-
     args = message.text.split()
     if len(args) != 2:
         await message.answer("❌ Неверный формат команды.\nИспользуйте: /find ключ/username/user_id")
@@ -5403,17 +5349,21 @@ async def find_user(message: Message, state: FSMContext):
     await message.answer(user_text, parse_mode="HTML")
 
 
-@router.message(Command("balance"))
+@router.message(Command("find"))
+async def find_user_denied(message: Message):
+    """
+    Ответ на /find для пользователей без прав администратора
+    """
+    await message.answer("⛔️ У вас нет доступа")
+
+
+@router.message(Command("balance"), IsAdmin())
 async def change_balance(message: Message):
     """
     Изменение баланса пользователя
     Формат: /balance id/username amount
     amount может быть положительным или отрицательным числом
     """
-    admin = await get_user(message.from_user.id)
-    if not admin.get('is_admin'):
-        return
-    
     try:
         args = message.text.split()
         if len(args) != 3:
@@ -5442,20 +5392,20 @@ async def change_balance(message: Message):
             await message.answer("❌ Пользователь не найден")
             return
         
-        # Получаем текущий баланс и вычисляем новый
-        current_balance = int(user['balance'])
-        new_balance = current_balance + amount
+        # Меняем баланс атомарно; списание не проходит, если баланс станет отрицательным
+        if amount >= 0:
+            new_balance = await credit_balance(user['user_id'], amount, f"admin:{message.from_user.id}")
+        else:
+            new_balance = await debit_balance(user['user_id'], -amount, f"admin:{message.from_user.id}")
         
-        if new_balance < 0:
+        if new_balance is None:
+            current_user = await get_user(user['user_id'])
             await message.answer(
                 f"❌ Невозможно установить отрицательный баланс\n"
-                f"Текущий баланс пользователя: {current_balance}₽"
+                f"Текущий баланс пользователя: {int(current_user['balance'])}₽"
             )
             return
         
-        # Обновляем баланс
-        await update_balance(user['user_id'], new_balance)
-        
         # Отправляем уведомление пользователю
         try:
             if amount > 0:
@@ -5498,44 +5448,26 @@ async def change_balance(message: Message):
         logger.error(f"Ошибка при изменении баланса: {e}")
         await message.answer(f"❌ Произошла ошибка: {str(e)}")
 
-@router.callback_query(F.data == "export_data")
-async def export_data(callback: types.CallbackQuery):
+
+@router.message(Command("balance"))
+async def change_balance_denied(message: Message):
     """
-    Экспорт актуальных данных пользователей в Excel файл
+    Ответ на /balance для пользователей без прав администратора
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
+    await message.answer("⛔️ У вас нет доступа")
+
+
+@router.callback_query(F.data == "export_data", IsAdmin())
+async def export_data(callback: types.CallbackQuery):
+    """
+    Экспорт актуальных данных пользователей в Excel файл.
 
+    Пользователи читаются из БД порциями и сразу пишутся в файл (openpyxl в режиме
+    write_only), поэтому память не растет с количеством пользователей.
+    """
     try:
-        # Получаем всех пользователей
-        await update_user_pay_count()
-        users = await get_all_users()
-        
-        # Создаем словарь для хранения дохода с рефералов
-        referral_income = {}
-        
-        # Рассчитываем доход с рефералов для каждого пользователя
-        for user in users:
-            referrer_id = user.get('referrer_id')
-            if referrer_id and referrer_id != 0:
-                # Получаем все успешные транзакции пользователя
-                transactions = await get_user_transactions(user['user_id'])
-                # Суммируем только успешные транзакции
-                total_amount = sum(tx['amount'] for tx in transactions if tx['status'] == 'succeeded')
-                
-                # Добавляем сумму к доходу реферера
-                if referrer_id not in referral_income:
-                    referral_income[referrer_id] = 0
-                referral_income[referrer_id] += total_amount
-        
-        # Добавляем информацию о доходе с рефералов к данным пользователей
-        for user in users:
-            user['referral_income'] = referral_income.get(user['user_id'], 0)
-        
-        # Создаем DataFrame
-        df = pd.DataFrame(users)
+        # Доход с рефералов считается одним запросом: referrer_id -> сумма успешных платежей
+        referral_income = await get_referral_income()
         
         # Преобразуем даты
         def format_date(date_str):
@@ -5550,9 +5482,7 @@ async def export_data(callback: types.CallbackQuery):
                 logger.error(f"Ошибка при форматировании даты: {e}")
                 return str(date_str)
 
-        df['subscription_end'] = df['subscription_end'].apply(format_date)
-        
-        # Переименовываем колонки
+        # Колонки файла и их названия
         column_names = {
             'user_id': 'ID пользователя',
             'username': 'Имя пользователя',
@@ -5569,11 +5499,17 @@ async def export_data(callback: types.CallbackQuery):
             'pay_count': 'Кол-во платежей',
             'referral_income': 'Доход с рефералов'
         }
-        df = df.rename(columns=column_names)
 
-        # Сохраняем в Excel
+        # Сохраняем в Excel построчно (pay_count поддерживается триггерами)
         filename = f"users_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        df.to_excel(filename, index=False, engine='openpyxl')
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Sheet1")
+        sheet.append(list(column_names.values()))
+        async for user in iter_all_users():
+            user['subscription_end'] = format_date(user['subscription_end'])
+            user['referral_income'] = referral_income.get(user['user_id'], 0)
+            sheet.append([user.get(column) for column in column_names])
+        workbook.save(filename)
 
         # Отправляем файл
         await callback.message.answer_document(
@@ -5614,16 +5550,11 @@ def get_group_name(group):
     }
     return group_names.get(group, f"Неизвестная группа ({group})")
 
-@router.callback_query(F.data == "admin_broadcast")
+@router.callback_query(F.data == "admin_broadcast", IsAdmin())
 async def start_broadcast(callback: types.CallbackQuery, state: FSMContext):
     """
     Начало процесса создания рассылки с выбором группы пользователей
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-    
     kb = InlineKeyboardBuilder()
     
     # Добавляем кнопки для выбора группы
@@ -5823,16 +5754,11 @@ async def process_broadcast_media(message: Message, state: FSMContext):
     
     await state.set_state(AdminBroadcastStates.confirm_broadcast)
 
-@router.callback_query(F.data == "confirm_broadcast")
+@router.callback_query(F.data == "confirm_broadcast", IsAdmin())
 async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
     """
     Подтверждение и выполнение рассылки для выбранной группы пользователей
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-    
     data = await state.get_data()
     broadcast_text = data.get('broadcast_text')
     broadcast_media_id = data.get('broadcast_media_id')
@@ -5840,11 +5766,11 @@ async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext, bo
     broadcast_group = data.get('broadcast_group', 'all')
     server_address = data.get('server_address')
     
-    # Получаем список пользователей в зависимости от выбранной группы
+    # Получатели читаются из БД порциями по мере отправки
     if broadcast_group == 'ip_server' and server_address:
-        target_users = await get_users_by_server_address(server_address)
+        target_users = iter_users_by_server_address(server_address)
     else:
-        target_users = await get_target_users(broadcast_group)
+        target_users = iter_target_users(broadcast_group)
     
     success_count = 0
     error_count = 0
@@ -5855,11 +5781,10 @@ async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext, bo
         group_name = f"{group_name} ({server_address})"
         
     progress_message = await callback.message.answer(
-        f"🔄 Начало рассылки для группы '{group_name}'...\n"
-        f"Всего получателей: {len(target_users)}"
+        f"🔄 Начало рассылки для группы '{group_name}'..."
     )
     
-    for user_id in target_users:
+    async for user_id in target_users:
         try:
             # Отправка с медиа
             if broadcast_media_id:
@@ -5900,7 +5825,7 @@ async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext, bo
                 try:
                     await progress_message.edit_text(
                         f"🔄 Рассылка в процессе...\n"
-                        f"Отправлено: {success_count}/{len(target_users)}"
+                        f"Отправлено: {success_count}"
                     )
                 except Exception:
                     pass
@@ -5924,68 +5849,52 @@ async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext, bo
     
     await state.clear()
 
-async def get_target_users(group):
+async def iter_target_users(group):
     """
-    Получает список ID пользователей для рассылки в зависимости от выбранной группы
+    Потоково отдает ID пользователей для рассылки в зависимости от выбранной группы
     
     Args:
         group (str): Идентификатор группы
         
-    Returns:
-        list: Список ID пользователей
+    Yields:
+        int: ID пользователя
     """
     if group == 'all':
-        # Получаем всех пользователей
-        users = await get_all_users()
-        return [user['user_id'] for user in users]
-    
-    # Для группы неактивированных бесплатных ключей используем прямой запрос
-    if group == 'unused_free_keys':
-        return await get_users_with_unused_free_keys()
-    
-    # Получаем сегменты пользователей для остальных групп
-    segments = await get_user_segments()
-    
-    if group == 'zero_traffic':
+        users = iter_user_ids()
+    elif group == 'unused_free_keys':
+        users = iter_users_with_unused_free_keys()
+    elif group == 'zero_traffic':
         # Для zero_traffic у нас кортежи (user_id, key), нам нужны только user_id
-        return [user_id for user_id, _ in segments['zero_traffic']]
+        users = (user_id async for user_id, _ in iter_users_with_zero_traffic_keys())
     elif group == 'balance_99':
-        return segments['balance_99']
+        users = iter_users_with_specific_balance(99)
     elif group == 'expiring_subscriptions':
-        return segments['expiring_subscriptions']
+        users = iter_users_with_expiring_subscriptions(3)
+    else:
+        # Если группа не распознана, никого не возвращаем
+        return
     
-    # Если группа не распознана, возвращаем пустой список
-    return []
+    async for user_id in users:
+        yield user_id
 
-@router.callback_query(F.data.startswith("promocodes_info"))
+@router.callback_query(F.data.startswith("promocodes_info"), IsAdmin())
 async def promocodes_info(callback: types.CallbackQuery):
     """
     Показывает информацию о промокодах и действия с ними с пагинацией
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-    
-    # Получаем номер страницы из callback_data
-    page = int(callback.data.split('_')[-1]) if callback.data != "promocodes_info" else 1
+    # Получаем курсор страницы из callback_data
+    after, before = parse_page_cursor(callback.data, "promocodes_info")
     items_per_page = 5  # Количество промокодов на странице
     
-    # Получаем список всех промокодов
-    promocodes = await get_all_promocodes()
+    promocodes, prev_cursor, next_cursor = await get_promocodes_page(items_per_page, after=after, before=before)
     
     kb = InlineKeyboardBuilder()
     
     # Формируем текст со списком промокодов для текущей страницы
     if promocodes:
-        total_pages = (len(promocodes) + items_per_page - 1) // items_per_page
-        start_idx = (page - 1) * items_per_page
-        end_idx = start_idx + items_per_page
-        current_page_promocodes = promocodes[start_idx:end_idx]
+        promo_text = "📋 <b>Список активных промокодов:</b>\n\n"
         
-        promo_text = f"📋 <b>Список активных промокодов (стр. {page}/{total_pages}):</b>\n\n"
-        
-        for promo in current_page_promocodes:
+        for promo in promocodes:
             promo_id, code, user_id, amount, gift_balance, gift_days, expiration_date = promo
             promo_text += (
                 f"🔑 <b>{code}</b>\n"
@@ -5996,17 +5905,7 @@ async def promocodes_info(callback: types.CallbackQuery):
             )
         
         # Добавляем кнопки навигации
-        nav_buttons = []
-        if page > 1:
-            nav_buttons.append(InlineKeyboardButton(
-                text="◀️", 
-                callback_data=f"promocodes_info_{page-1}"
-            ))
-        if page < total_pages:
-            nav_buttons.append(InlineKeyboardButton(
-                text="▶️", 
-                callback_data=f"promocodes_info_{page+1}"
-            ))
+        nav_buttons = page_nav_buttons("promocodes_info", prev_cursor, next_cursor)
         if nav_buttons:
             kb.row(*nav_buttons)
     else:
@@ -6031,36 +5930,36 @@ async def promocodes_info(callback: types.CallbackQuery):
             raise e
 
 
-@router.callback_query(F.data == "delete_promocode")
+@router.callback_query(F.data.startswith("delete_promocode"), IsAdmin())
 async def start_delete_promocode(callback: types.CallbackQuery, state: FSMContext):
     """
-    Начало процесса удаления промокода
+    Начало процесса удаления промокода (список с пагинацией)
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-    
-    # Получаем список всех промокодов
-    promocodes = await get_all_promocodes()
+    after, before = parse_page_cursor(callback.data, "delete_promocode")
+    promocodes, prev_cursor, next_cursor = await get_promocodes_page(10, after=after, before=before)
     
     kb = InlineKeyboardBuilder()
     for promo in promocodes:
         promo_id, code, _, amount, gift_balance, gift_days, expiration_date = promo
         kb.button(
             text=f"🗑 {code} ({amount} исп.)", 
-            callback_data="confirm_delete_promo"
+            callback_data=f"confirm_delete_promo_{promo_id}"
         )
+        # Данные сохраняются для каждой кнопки отдельно
         await state.update_data({
-            "promo_id": promo_id,
-            "promo_code": code,
-            "amount": amount,
-            "gift_balance": gift_balance,
-            "gift_days": gift_days,
-            "expiration_date": expiration_date
+            f"delete_promo_{promo_id}": {
+                "promo_code": code,
+                "amount": amount,
+                "gift_balance": gift_balance,
+                "gift_days": gift_days,
+                "expiration_date": expiration_date
+            }
         })
-    kb.button(text="◀️ Назад", callback_data="promocodes_info")
     kb.adjust(1)
+    nav_buttons = page_nav_buttons("delete_promocode", prev_cursor, next_cursor)
+    if nav_buttons:
+        kb.row(*nav_buttons)
+    kb.row(InlineKeyboardButton(text="◀️ Назад", callback_data="promocodes_info"))
     
     await callback.message.edit_text(
         "🗑 <b>Выберите промокод для удаления:</b>",
@@ -6068,18 +5967,14 @@ async def start_delete_promocode(callback: types.CallbackQuery, state: FSMContex
         parse_mode="HTML"
     )
 
-@router.callback_query(F.data == "confirm_delete_promo")
+@router.callback_query(F.data.startswith("confirm_delete_promo_"), IsAdmin())
 async def confirm_delete_promocode(callback: types.CallbackQuery, state: FSMContext):
     """
     Подтверждение удаления промокода
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-    
-    # Получаем данные о промокоде из state
-    data = await state.get_data()
+    # Получаем данные о выбранном промокоде из state
+    promo_id = callback.data.split("_")[-1]
+    data = (await state.get_data()).get(f"delete_promo_{promo_id}", {})
     
     promo_code = data.get('promo_code')
     amount = data.get('amount')
@@ -6113,16 +6008,11 @@ async def confirm_delete_promocode(callback: types.CallbackQuery, state: FSMCont
     else:
         await callback.answer("❌ Промокод не найден", show_alert=True)
 
-@router.callback_query(F.data == "create_promocode")
+@router.callback_query(F.data == "create_promocode", IsAdmin())
 async def start_create_promocode(callback: types.CallbackQuery, state: FSMContext):
     """
     Начало процесса создания промокода
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-    
     kb = InlineKeyboardBuilder()
     kb.button(text="◀️ Отмена", callback_data="promocodes_info")
     
@@ -6269,16 +6159,11 @@ async def process_promo_expiration_date(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введите дату в формате ГГГГ-ММ-ДД:")
 
-@router.callback_query(F.data == "remove_server")
+@router.callback_query(F.data == "remove_server", IsAdmin())
 async def show_servers_to_remove(callback: types.CallbackQuery):
     """
     Показывает список серверов для удаления
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-        
     servers = await get_all_servers()
     
     if not servers:
@@ -6319,16 +6204,11 @@ async def show_servers_to_remove(callback: types.CallbackQuery):
         parse_mode="HTML"
     )
 
-@router.callback_query(F.data.startswith("del_server_"))
+@router.callback_query(F.data.startswith("del_server_"), IsAdmin())
 async def remove_server_confirm(callback: types.CallbackQuery):
     """
     Подтверждение удаления сервера
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-        
     server_id = int(callback.data.split("_")[2])
     servers = await get_all_servers()
     server_inbounds = [s for s in servers if s['id'] == server_id]
@@ -6366,16 +6246,11 @@ async def remove_server_confirm(callback: types.CallbackQuery):
         parse_mode="HTML"
     )
 
-@router.callback_query(F.data.startswith("confirm_del_"))
+@router.callback_query(F.data.startswith("confirm_del_"), IsAdmin())
 async def remove_server_final(callback: types.CallbackQuery):
     """
     Финальное удаление сервера
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-        
     server_id = int(callback.data.split("_")[2])
     await delete_server(server_id)
     
@@ -6387,20 +6262,15 @@ async def remove_server_final(callback: types.CallbackQuery):
         reply_markup=kb.as_markup()
     )
 
-@router.callback_query(F.data.startswith("servers_info"))
+@router.callback_query(F.data.startswith("servers_info"), IsAdmin())
 async def show_servers_info(callback: types.CallbackQuery):
     """
     Показывает информацию о всех серверах с пагинацией
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-        
-    page = int(callback.data.split('_')[-1]) if len(callback.data.split('_')) > 2 else 1
+    after, before = parse_page_cursor(callback.data, "servers_info")
     SERVERS_PER_PAGE = 3
     
-    servers = await get_all_servers()
+    servers, prev_cursor, next_cursor = await get_servers_page(SERVERS_PER_PAGE, after=after, before=before)
     
     if not servers:
         kb = InlineKeyboardBuilder()
@@ -6411,67 +6281,41 @@ async def show_servers_info(callback: types.CallbackQuery):
         )
         return
     
-    # Группируем серверы по ID
-    grouped_servers = {}
-    for server in servers:
-        if server['id'] not in grouped_servers:
-            grouped_servers[server['id']] = []
-        grouped_servers[server['id']].append(server)
-    
-    total_servers = len(grouped_servers)
-    total_pages = (total_servers + SERVERS_PER_PAGE - 1) // SERVERS_PER_PAGE
-    start_idx = (page - 1) * SERVERS_PER_PAGE
-    end_idx = min(start_idx + SERVERS_PER_PAGE, total_servers)
-    
-    current_page_server_ids = list(grouped_servers.keys())[start_idx:end_idx]
-    
-    info_text = f"📊 <b>Информация о серверах (стр. {page}/{total_pages}):</b>\n\n"
+    info_text = "📊 <b>Информация о серверах:</b>\n\n"
     
-    for server_id in current_page_server_ids:
-        server_group = grouped_servers[server_id]
-        first_server = server_group[0]
-        status = "🟢 Активен" if first_server['is_active'] else "🔴 Отключен"
+    for server in servers:
+        status = "🟢 Активен" if server['is_active'] else "🔴 Отключен"
+        inbounds = [inbound for inbound in server['inbounds'] if inbound['protocol']]
         
         # Считаем общее количество клиентов и максимум для сервера
-        total_clients = sum(s['clients_count'] for s in server_group if s['protocol'])
-        total_max = sum(s['max_clients'] for s in server_group if s['protocol'])
+        total_clients = sum(inbound['clients_count'] for inbound in inbounds)
+        total_max = sum(inbound['max_clients'] for inbound in inbounds)
         total_load = (total_clients / total_max * 100) if total_max > 0 else 0
         
         info_text += (
-            f"🖥 <b>Сервер #{first_server['id']}</b>\n"
-            f"├ 📍 Адрес: {first_server['address']}\n"
+            f"🖥 <b>Сервер #{server['id']}</b>\n"
+            f"├ 📍 Адрес: {server['address']}\n"
             f"├ 🔌 Порт: 2053\n"
-            f"├ 🌍 Страна: {first_server['country'] or 'Не указана'}\n"
+            f"├ 🌍 Страна: {server['country'] or 'Не указана'}\n"
             f"├ 📡 Статус: {status}\n"
             f"├ 👥 Всего клиентов: {total_clients}/{total_max}\n"
             f"└ 📊 Общая загрузка: {total_load:.1f}%\n"
         )
         info_text += "    Протоколы сервера:\n"
-        for server in server_group:
-            if server['protocol']:
-                load_percent = (server['clients_count'] / server['max_clients'] * 100) if server['max_clients'] > 0 else 0
-                info_text += (
-                    f"   ┌ 📡 Протокол: {server['protocol']}\n"
-                    f"   ├ 👥 Клиентов: {server['clients_count']}/{server['max_clients']}\n"
-                    f"   ├ 📊 Загрузка: {load_percent:.1f}%\n"
-                    f"   └ 🔢 ID: {server['inbound_id']}\n"
-                )
+        for inbound in inbounds:
+            load_percent = (inbound['clients_count'] / inbound['max_clients'] * 100) if inbound['max_clients'] > 0 else 0
+            info_text += (
+                f"   ┌ 📡 Протокол: {inbound['protocol']}\n"
+                f"   ├ 👥 Клиентов: {inbound['clients_count']}/{inbound['max_clients']}\n"
+                f"   ├ 📊 Загрузка: {load_percent:.1f}%\n"
+                f"   └ 🔢 ID: {inbound['inbound_id']}\n"
+            )
         info_text += "\n"
     
     kb = InlineKeyboardBuilder()
     
     # Навигация
-    nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton(
-            text="◀️",
-            callback_data=f"servers_info_{page-1}"
-        ))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton(
-            text="▶️",
-            callback_data=f"servers_info_{page+1}"
-        ))
+    nav_buttons = page_nav_buttons("servers_info", prev_cursor, next_cursor)
     if nav_buttons:
         kb.row(*nav_buttons)
     
@@ -6491,16 +6335,11 @@ async def show_servers_info(callback: types.CallbackQuery):
             raise e
 
 
-@router.callback_query(F.data == "update_server_info")
+@router.callback_query(F.data == "update_server_info", IsAdmin())
 async def update_server_info_row(callback: types.CallbackQuery):
     """
     Показывает список серверов для обновления информации
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-    
     servers = await get_all_servers()
 
     if not servers:
@@ -7171,16 +7010,11 @@ async def set_country(callback: types.CallbackQuery, state: FSMContext):
         reply_markup=kb.as_markup()
     )
 
-@router.callback_query(F.data == "update_servers")
+@router.callback_query(F.data == "update_servers", IsAdmin())
 async def update_servers(callback: types.CallbackQuery):
     """
     Показывает список серверов для обновления количества клиентов
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-        
     servers = await get_servers_with_total_clients()
     
     if not servers:
@@ -7437,16 +7271,11 @@ async def process_server_max_clients_update(message: Message, state: FSMContext)
     except ValueError:
         await message.answer("❌ Пожалуйста, введите корректное число")    
 
-@router.callback_query(F.data == "add_server")
+@router.callback_query(F.data == "add_server", IsAdmin())
 async def add_server_start(callback: types.CallbackQuery, state: FSMContext):
     """
     Начало процесса добавления сервера
     """
-    user = await get_user(callback.from_user.id)
-    if not user.get('is_admin'):
-        await callback.answer("⛔️ У вас нет доступа", show_alert=True)
-        return
-        
     kb = InlineKeyboardBuilder()
     kb.button(text="◀️ Отмена", callback_data="admin_back")
     
@@ -7737,7 +7566,7 @@ async def continue_sub(callback: types.CallbackQuery, state: FSMContext, bot: Bo
 
 @router.callback_query(F.data.startswith("cancel_after_question"))
 async def cancel_sub(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
-    from handlers.database import server_remove_key, update_multiple_keys_count
+    from handlers.database import server_remove_key
     from handlers.scheduler import remove_job
 
     await callback.answer()
@@ -7751,7 +7580,6 @@ async def cancel_sub(callback: types.CallbackQuery, state: FSMContext, bot: Bot)
     try:
         await server_remove_key(key_str, user_id)
         await remove_active_key(key_str)
-        await update_multiple_keys_count([user_id])
 
         job_key = f'remove_{key_str}'
         remove_job(job_key)
@@ -7907,7 +7735,8 @@ async def send_vpn_reminder(user_id: int | str, bot: Bot):
 
     logger.info(f"Отправили напоминание о сервисе для пользователя {user_id}")
     
-    username = await get_user_info(user_id=user_id)
+    user_info = await get_user_info(user_id=user_id)
+    username = user_info.username if user_info else None
     admins = await get_admins()
     await send_info_for_admins(
         "Отправили пользователю напоминание о нашем существовании",
@@ -7917,3 +7746,26 @@ async def send_vpn_reminder(user_id: int | str, bot: Bot):
     )
 
 # ------------------------------------------------
+
+
+# callback_data кнопок админ-панели: точные значения и префиксы
+ADMIN_CALLBACKS = {
+    "remove_key", "export_data", "admin_broadcast", "confirm_broadcast", "create_promocode",
+    "remove_server", "update_server_info", "update_servers", "add_server",
+}
+ADMIN_CALLBACK_PREFIXES = (
+    "promocodes_info", "delete_promocode", "confirm_delete_promo_",
+    "del_server_", "confirm_del_", "servers_info",
+)
+
+
+# Регистрируется после всех обработчиков с IsAdmin(), поэтому получает только
+# нажатия кнопок админ-панели пользователями без прав администратора
+@router.callback_query(
+    F.data.in_(ADMIN_CALLBACKS) | F.data.startswith(ADMIN_CALLBACK_PREFIXES), ~IsAdmin()
+)
+async def admin_callback_denied(callback: types.CallbackQuery):
+    """
+    Ответ на кнопки админ-панели для пользователей без прав администратора
+    """
+    await callback.answer("⛔️ У вас нет доступа", show_alert=True)
@@ -0,0 +1,73 @@
+# handlers.http_client.py
+"""
+Общий HTTP-клиент для внешних запросов (кроме Telegram).
+
+Раньше проверка серверов, курсы CoinGecko и запросы к CryptoCloud создавали
+новый aiohttp.ClientSession на каждый вызов, то есть каждый запрос заново
+устанавливал TCP- и TLS-соединение и резолвил DNS. Теперь одна сессия
+создается в main() (http_client.start()) и закрывается при остановке бота;
+соединения переиспользуются (keep-alive), результаты DNS кэшируются.
+
+Панели 3x-ui сюда не относятся: py3xui работает через собственный httpx-клиент
+(см. handlers.api).
+"""
+import asyncio
+import logging
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Ограничения пула соединений: всего и на один хост
+HTTP_CONNECTIONS_LIMIT = 100
+HTTP_CONNECTIONS_PER_HOST = 10
+# Сколько секунд держать простаивающее соединение и результат DNS
+HTTP_KEEPALIVE_TIMEOUT = 30
+HTTP_DNS_CACHE_TTL = 300
+# Таймауты по умолчанию (в секундах); отдельный запрос может передать свой timeout
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10, sock_read=20)
+
+
+class HttpClient:
+    """
+    Фабрика общей aiohttp-сессии приложения.
+
+    session возвращает открытую сессию; если start() еще не вызывался
+    (скрипты, ручной запуск функций), сессия создается при первом обращении.
+    """
+
+    def __init__(self):
+        self._session: aiohttp.ClientSession | None = None
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONNECTIONS_LIMIT,
+            limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+
+    async def start(self):
+        """Создает сессию (вызывается при запуске бота)."""
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+            logger.info("HTTP-клиент запущен")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    async def close(self):
+        """Закрывает сессию и ее соединения (вызывается при остановке бота)."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            # Даем SSL-соединениям корректно закрыться, иначе aiohttp предупреждает о незакрытом транспорте
+            await asyncio.sleep(0.25)
+        self._session = None
+        logger.info("HTTP-клиент остановлен")
+
+
+http_client = HttpClient()
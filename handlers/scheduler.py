@@ -18,7 +18,7 @@ from config import API_TOKEN, SUPPORT_URI
 from handlers.database import (
     update_transaction_status,
     add_transaction,
-    update_balance,
+    debit_balance,
     update_key_expriration_date,
     get_all_users_with_subscription,
     get_user_payment_methods,
@@ -199,7 +199,7 @@ async def process_key_payment(key: Dict, bot: Bot, email: str) -> bool:
 
         if int(user_info["balance"]) >= key_price:
             payment_attempts += 1
-            await pay_with_int_balance(user_id, int(user_info["balance"]), key_price)
+            await pay_with_int_balance(user_id, key_price, key)
             successful_method = { "id": "Внутренний баланс" }
             successful_type = "Внутренний баланс"
             payment_success = True
@@ -333,10 +333,14 @@ async def process_key_payment(key: Dict, bot: Bot, email: str) -> bool:
     
         return False
 
-async def pay_with_int_balance(user_id, balance, price):
-    """Проводит оплату у пользователя засчет его баланса"""
-    new_balance = balance - price
-    if new_balance < 0:
+async def pay_with_int_balance(user_id, price, key: Dict):
+    """
+    Проводит оплату у пользователя засчет его баланса.
+    Списание за продление ключа на текущий срок проводится только один раз.
+    """
+    new_balance = await debit_balance(
+        user_id, price, "renewal", idempotency_key=f"renewal:{key['key']}:{key['expiration_date']}"
+    )
+    if new_balance is None:
         raise ValueError("Указанная цена оплаты превышает баланс пользователя!!")
-    
-    await update_balance(user_id, new_balance)
+    return new_balance
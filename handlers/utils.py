@@ -4,6 +4,7 @@ import random
 import re
 import string
 from aiogram import Bot
+from aiogram.types import InlineKeyboardButton
 import asyncio
 import aiofiles
 
@@ -115,6 +116,96 @@ def extract_key_data(key: str):
         logger.error(f"Полный ключ: {key}")
         return None, None, None, None, None
 
+def normalize_server_host(address: str) -> str:
+    """
+    Приводит адрес сервера к каноническому виду: хост без порта панели в нижнем регистре.
+    По нему связываются servers.host и keys.server_ip
+    """
+    return address.split(':')[0].strip().lower() if address else ""
+
+KEY_HOST_PATTERN = re.compile(r"@([^@:/?#]+):([0-9]+)")
+VLESS_UUID_PATTERN = re.compile(r"vless://([0-9a-fA-F-]+)@")
+
+def parse_key_fields(key: str) -> dict:
+    """
+    Разбирает VPN ключ на поля, которые хранятся в отдельных колонках таблицы keys
+
+    В отличие от extract_key_data ничего не пишет в лог и не бросает исключений,
+    поэтому подходит для разбора всех ключей базы при миграции.
+
+    Args:
+        key (str): VPN ключ (vless:// или ss://)
+
+    Returns:
+        dict: protocol ('vless' или 'shadowsocks', как в таблице inbounds), server_ip, port,
+            client_uuid (UUID клиента VLESS; клиент Shadowsocks на панели ищется по email),
+            panel_email, unique_id, device_type. Поля, которые не удалось извлечь, равны None
+    """
+    fields = {
+        "protocol": None,
+        "server_ip": None,
+        "port": None,
+        "client_uuid": None,
+        "panel_email": None,
+        "unique_id": None,
+        "device_type": None,
+    }
+    if not key:
+        return fields
+
+    if key.startswith("vless://"):
+        fields["protocol"] = "vless"
+        uuid_match = VLESS_UUID_PATTERN.match(key)
+        if uuid_match:
+            fields["client_uuid"] = uuid_match.group(1).lower()
+    elif key.startswith("ss://"):
+        fields["protocol"] = "shadowsocks"
+
+    # Адрес и порт ищем только до имени ключа, чтобы не зацепить символы из email
+    host_match = KEY_HOST_PATTERN.search(key.split("#")[0])
+    if host_match:
+        fields["server_ip"] = normalize_server_host(host_match.group(1))
+        fields["port"] = int(host_match.group(2))
+
+    if "#" in key:
+        name_part = key.split("#")[-1].replace("%20", " ")
+        email = name_part.split("VPN-", 1)[1] if "VPN-" in name_part else name_part
+        parts = email.split("_", 2)
+        # Email клиента на панели имеет вид device_uniqueid_username
+        if len(parts) == 3:
+            fields["panel_email"] = email
+            fields["device_type"] = parts[0]
+            fields["unique_id"] = parts[1]
+
+    return fields
+
+def parse_page_cursor(data: str, prefix: str) -> tuple:
+    """
+    Разбирает курсор страницы из callback_data.
+
+    "{prefix}_a_{id}" — страница после id, "{prefix}_b_{id}" — страница перед id,
+    все остальное (в том числе "{prefix}" и старые кнопки с номером страницы) — первая страница.
+
+    Returns:
+        tuple: (after, before)
+    """
+    parts = data[len(prefix):].strip("_").split("_")
+    if len(parts) == 2 and parts[0] in ("a", "b") and parts[1].lstrip("-").isdigit():
+        value = int(parts[1])
+        return (value, None) if parts[0] == "a" else (None, value)
+    return None, None
+
+def page_nav_buttons(prefix: str, prev_cursor, next_cursor) -> list:
+    """
+    Кнопки ◀️/▶️ для страниц, полученных по курсору (см. parse_page_cursor).
+    """
+    buttons = []
+    if prev_cursor is not None:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"{prefix}_b_{prev_cursor}"))
+    if next_cursor is not None:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"{prefix}_a_{next_cursor}"))
+    return buttons
+
 def generate_random_string(length=4):
     """
     Генерирует случайную строку заданной длины
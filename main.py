@@ -21,11 +21,16 @@ import redis.asyncio as redis
 
 from config import API_TOKEN
 from handlers.database import (
+    aux_batch_writer,
+    aux_pool,
+    batch_writer,
+    db_pool,
+    user_cache,
     init_db,
     get_next_expiration_date,
     setup_scheduler,
     delete_all_payment_methods,
-    get_users_without_payment_methods,
+    iter_users_without_payment_methods,
     get_user_transactions,
     get_user_keys
 )
@@ -37,6 +42,7 @@ from handlers.handlers import (
     setup_dp_instance
 )
 from handlers.database import set_bot_instance
+from handlers.http_client import http_client
 from handlers.payments import get_payment_info, create_auto_payment
 from handlers.utils import once_per_string
 
@@ -180,6 +186,12 @@ async def bot_lifecycle(bot: Bot, dp: Dispatcher):
         # await notification_scheduler.shutdown()
         scheduler.shutdown()
         await bot.session.close()
+        await http_client.close()
+        logger.info(f"Статистика кэша пользователей: {user_cache.get_stats()}")
+        await batch_writer.close()
+        await aux_batch_writer.close()
+        await db_pool.close()
+        await aux_pool.close()
 
 def setup_signal_handlers(loop: asyncio.AbstractEventLoop) -> None:
     """
@@ -220,6 +232,8 @@ class DatabaseConnection:
         """
         try:
             logger.info("Подключаюсь к базе данных...")
+            await aux_pool.open()
+            await db_pool.open()
             await init_db()
             logger.info("Подключение к базе данных успешно установлено")
         except Exception as e:
@@ -236,9 +250,7 @@ async def payment_method_migration(bot: Bot):
     """
     await delete_all_payment_methods() # чистим методы оплаты
 
-    users = await get_users_without_payment_methods()
-
-    for user in users: # 1 - кто зареган, но без методов оплаты
+    async for user in iter_users_without_payment_methods(): # 1 - кто зареган, но без методов оплаты
         user_id = user["user_id"]
         transactions = await get_user_transactions(user_id)
 
@@ -304,6 +316,7 @@ async def main() -> None:
     setup_dp_instance(dp)
 
     await DatabaseConnection.initialize()
+    await http_client.start()
 
     async with bot_lifecycle(bot, dp):
         await start_bot(bot, dp)
@@ -0,0 +1,84 @@
+# tests.test_expiry_query_plans.py
+"""
+Запросы по сроку действия ключей после миграций должны читать keys по индексам.
+Проверяется и новая база, и база со старой схемой (expiration_date TEXT),
+которую миграция 7 пересоздает.
+"""
+import asyncio
+
+import aiosqlite
+import pytest
+
+from handlers.db_utils.migrations import run_migrations
+from handlers.db_utils.query_plans import EXPIRY_QUERIES, explain_query_plan, reads_keys_by_index
+
+# Таблицы основной базы в том виде, в котором их создавали до миграций;
+# недостающие колонки добавляет миграция 1
+LEGACY_SCHEMA = """
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        email TEXT,
+        balance INTEGER DEFAULT 0,
+        referrer_id INTEGER DEFAULT 0,
+        keys_count INTEGER DEFAULT 0
+    );
+    CREATE TABLE keys (
+        key TEXT PRIMARY KEY,
+        user_id INTEGER,
+        device_id TEXT,
+        expiration_date {expiration_type},
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    );
+    CREATE TABLE servers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        address TEXT NOT NULL,
+        username TEXT,
+        password TEXT,
+        country TEXT,
+        max_clients INTEGER,
+        is_active INTEGER DEFAULT 1
+    );
+    CREATE TABLE user_transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount INTEGER,
+        transaction_id TEXT,
+        status TEXT
+    );
+    CREATE TABLE user_payment_methods (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        payment_method_id TEXT
+    );
+    CREATE TABLE promocodes (code TEXT PRIMARY KEY);
+    CREATE TABLE used_promocodes (user_id INTEGER, promocode TEXT);
+    CREATE TABLE forum_topics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE,
+        topic_id INTEGER NOT NULL
+    );
+"""
+
+
+async def _migrated_plans(path: str, expiration_type: str) -> dict:
+    async with aiosqlite.connect(path) as db:
+        await db.executescript(LEGACY_SCHEMA.format(expiration_type=expiration_type))
+        await db.executemany(
+            "INSERT INTO keys (key, user_id, device_id, expiration_date) VALUES (?, ?, ?, ?)",
+            [(f"vless://{n}@10.0.0.1:443#k{n}", n % 10, 'ios', str(1700000000000 + n)) for n in range(100)]
+        )
+        await db.commit()
+        await run_migrations(db)
+
+    # Планы строятся на новом соединении, как у работающего бота после перезапуска
+    async with aiosqlite.connect(path) as db:
+        return {name: await explain_query_plan(db, query) for name, (query, _) in EXPIRY_QUERIES.items()}
+
+
+@pytest.mark.parametrize("expiration_type", ["TEXT", "INTEGER"])
+def test_expiry_queries_use_indexes(tmp_path, expiration_type):
+    plans = asyncio.run(_migrated_plans(str(tmp_path / "db.sqlite"), expiration_type))
+
+    for name, (_, index) in EXPIRY_QUERIES.items():
+        assert reads_keys_by_index(plans[name], index), f"{name}: {plans[name]}"
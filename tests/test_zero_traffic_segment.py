@@ -0,0 +1,65 @@
+# tests.test_zero_traffic_segment.py
+"""
+Сегмент рассылки "ключи с нулевым трафиком" строится по свежему сбору key_traffic,
+а пока сбора нет — по key_usage_reminders.last_traffic, как раньше.
+"""
+import asyncio
+import time
+
+from handlers import database
+
+
+async def _zero_traffic_segments() -> tuple[list, list]:
+    await database.db_pool.open()
+    await database.aux_pool.open()
+    try:
+        await database.init_db()
+        expiration = int((time.time() + 86400) * 1000)
+        async with database.db_pool.writer() as db:
+            await db.executemany(
+                "INSERT INTO users (user_id, username) VALUES (?, ?)", [(1, 'alice'), (2, 'bob')]
+            )
+            await db.executemany(
+                """
+                INSERT INTO keys (key, user_id, device_id, expiration_date, price, days, server_ip, panel_email)
+                VALUES (?, ?, 'ios', ?, 100, 30, '10.0.0.1', ?)
+                """,
+                [('key-idle', 1, expiration, 'idle'), ('key-used', 2, expiration, 'used')]
+            )
+            await db.commit()
+        async with database.aux_pool.writer() as db:
+            # Записи, которые создает add_active_key
+            await db.executemany(
+                "INSERT INTO key_usage_reminders (key, last_traffic) VALUES (?, 0)",
+                [('key-idle',), ('key-used',)]
+            )
+            await db.commit()
+
+        before_collection = await database.get_users_with_zero_traffic_keys()
+
+        collected_at = int(time.time() * 1000)
+        async with database.aux_pool.writer() as db:
+            await db.executemany(
+                """
+                INSERT INTO key_traffic (server_host, panel_email, inbound_id, up, down, updated_at)
+                VALUES ('10.0.0.1', ?, 1, ?, ?, ?)
+                """,
+                [('idle', 0, 0, collected_at), ('used', 1024, 4096, collected_at)]
+            )
+            await db.commit()
+
+        after_collection = await database.get_users_with_zero_traffic_keys()
+        return before_collection, after_collection
+    finally:
+        await database.batch_writer.close()
+        await database.aux_batch_writer.close()
+        await database.db_pool.close()
+        await database.aux_pool.close()
+
+
+def test_zero_traffic_segment(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    before_collection, after_collection = asyncio.run(_zero_traffic_segments())
+
+    assert sorted(before_collection) == [(1, 'key-idle'), (2, 'key-used')]
+    assert after_collection == [(1, 'key-idle')]